@@ -0,0 +1,181 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import time
+
+import redis
+
+SECOND_LEVEL_LABELS = ("com", "net", "org", "gov", "edu", "co", "ac")
+
+
+def registered_domain(domain):
+    """
+    Returns the domain registered under a public suffix, which is the unit
+    ACME CAs use to limit issued certificates. Two-letter country code
+    suffixes with a generic second level (e.g. com.br) are handled, other
+    public suffixes are not.
+    """
+    labels = domain.lower().strip(".").split(".")
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in SECOND_LEVEL_LABELS:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+
+class AcmeScheduler(object):
+    """
+    AcmeScheduler spaces certificate orders so they stay within the rate
+    limits of the ACME CA.
+
+    Each limit is a token bucket on Redis: orders per account, certificates
+    per registered domain and failed validations per account and hostname.
+    An order is only granted when all of its buckets have tokens, otherwise
+    the caller is told how long to wait before trying again, so orders for
+    other domains go ahead of the deferred ones.
+
+    Queued orders are scored by the time their task is due to try again.
+    Orders still queued ACME_ORDER_TTL seconds after that belong to tasks
+    that are gone (e.g. lost or revoked) and are dropped.
+    """
+
+    def __init__(self, conn, config=None):
+        config = config or {}
+        self.conn = conn
+        self.prefix = config.get("ACME_SCHEDULER_PREFIX", "acme_scheduler")
+        self.account_limit = (int(config.get("ACME_ACCOUNT_ORDERS", 300)),
+                              int(config.get("ACME_ACCOUNT_PERIOD", 10800)))
+        self.domain_limit = (int(config.get("ACME_DOMAIN_CERTIFICATES", 50)),
+                             int(config.get("ACME_DOMAIN_PERIOD", 604800)))
+        self.failure_limit = (int(config.get("ACME_FAILED_VALIDATIONS", 5)),
+                              int(config.get("ACME_FAILED_VALIDATIONS_PERIOD", 3600)))
+        self.order_ttl = int(config.get("ACME_ORDER_TTL", 3600))
+
+    def enqueue(self, name, domain, email):
+        order = {"domain": domain, "email": email, "enqueued": time.time()}
+        self._prune(order["enqueued"])
+        if self.conn.zscore(self._queue_key(), name) is None:
+            with self.conn.pipeline() as pipe:
+                pipe.hset(self._orders_key(), name, json.dumps(order))
+                pipe.zadd(self._queue_key(), **{name: order["enqueued"]})
+                pipe.execute()
+
+    def acquire(self, name, domain, email):
+        """
+        Takes one token from the account and domain buckets, returning 0, or
+        returns how many seconds to wait before trying again.
+        """
+        consumed = self._consumed_buckets(domain, email)
+        failure = self._failure_bucket(domain, email)
+        with self.conn.pipeline() as pipe:
+            try:
+                pipe.watch(*[key for key, _ in consumed + [failure]])
+                now = time.time()
+                tokens = {}
+                wait = 0
+                for key, limit in consumed + [failure]:
+                    tokens[key] = self._tokens(pipe, key, limit, now)
+                    wait = max(wait, self._wait(tokens[key], 1, limit))
+                if wait > 0:
+                    pipe.unwatch()
+                    self.conn.zadd(self._queue_key(), **{name: now + wait})
+                    return wait
+                pipe.multi()
+                for key, limit in consumed:
+                    self._store_tokens(pipe, key, limit, tokens[key] - 1, now)
+                pipe.zrem(self._queue_key(), name)
+                pipe.hdel(self._orders_key(), name)
+                pipe.execute()
+                return 0
+            except redis.WatchError:
+                return 1
+
+    def record_failure(self, domain, email):
+        key, limit = self._failure_bucket(domain, email)
+        with self.conn.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                now = time.time()
+                tokens = self._tokens(pipe, key, limit, now)
+                pipe.multi()
+                self._store_tokens(pipe, key, limit, max(tokens - 1, 0), now)
+                pipe.execute()
+            except redis.WatchError:
+                pass
+
+    def cancel(self, name):
+        with self.conn.pipeline() as pipe:
+            pipe.zrem(self._queue_key(), name)
+            pipe.hdel(self._orders_key(), name)
+            pipe.execute()
+
+    def status(self, name):
+        """
+        Returns the position of the order of name in the queue, the queue
+        depth and the estimated wait in seconds, or None when name has no
+        order queued.
+        """
+        order = self.conn.hget(self._orders_key(), name)
+        if order is None:
+            return None
+        order = json.loads(order)
+        now = time.time()
+        self._prune(now)
+        queue = self.conn.zrange(self._queue_key(), 0, -1, withscores=True)
+        names = [queued for queued, _ in queue]
+        if name not in names:
+            return None
+        position = names.index(name)
+        orders = self.conn.hmget(self._orders_key(), names[:position]) if position else []
+        ahead = [json.loads(o) for o in orders if o]
+        eta = max(dict(queue)[name] - now, 0)
+        for key, limit in self._consumed_buckets(order["domain"], order["email"]):
+            if key == self._account_key(order["email"]):
+                count = len([o for o in ahead if o["email"] == order["email"]])
+            else:
+                domain = registered_domain(order["domain"])
+                count = len([o for o in ahead if registered_domain(o["domain"]) == domain])
+            eta = max(eta, self._wait(self._tokens(self.conn, key, limit, now), count + 1, limit))
+        return {"position": position + 1, "queue_depth": len(names), "eta": int(round(eta))}
+
+    def _prune(self, now):
+        stale = self.conn.zrangebyscore(self._queue_key(), "-inf", now - self.order_ttl)
+        if stale:
+            with self.conn.pipeline() as pipe:
+                pipe.zrem(self._queue_key(), *stale)
+                pipe.hdel(self._orders_key(), *stale)
+                pipe.execute()
+
+    def _tokens(self, conn, key, limit, now):
+        size, period = limit
+        tokens, updated = conn.hmget(key, "tokens", "updated")
+        if tokens is None or updated is None:
+            return float(size)
+        elapsed = max(now - float(updated), 0)
+        return min(float(size), float(tokens) + elapsed * size / period)
+
+    def _store_tokens(self, pipe, key, limit, tokens, now):
+        pipe.hmset(key, {"tokens": tokens, "updated": now})
+        pipe.expire(key, limit[1])
+
+    def _wait(self, tokens, needed, limit):
+        size, period = limit
+        if tokens >= needed:
+            return 0
+        return (needed - tokens) * period / float(size)
+
+    def _consumed_buckets(self, domain, email):
+        return [(self._account_key(email), self.account_limit),
+                ("{}:domain:{}".format(self.prefix, registered_domain(domain)), self.domain_limit)]
+
+    def _failure_bucket(self, domain, email):
+        return ("{}:failures:{}:{}".format(self.prefix, email, domain.lower()), self.failure_limit)
+
+    def _account_key(self, email):
+        return "{}:account:{}".format(self.prefix, email)
+
+    def _queue_key(self):
+        return "{}:queue".format(self.prefix)
+
+    def _orders_key(self):
+        return "{}:orders".format(self.prefix)
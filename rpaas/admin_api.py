@@ -7,7 +7,7 @@ from bson import json_util
 
 from flask import request
 
-from rpaas import auth, get_manager, storage, plan
+from rpaas import auth, consul_manager, get_manager, manager, storage, plan
 
 
 @auth.required
@@ -20,6 +20,64 @@ def healings():
     return json.dumps(healing_list, default=json_util.default)
 
 
+@auth.required
+def gc_reports():
+    manager = get_manager()
+    quantity = request.args.get("quantity", type=int)
+    if quantity is None or quantity <= 0:
+        quantity = 20
+    report_list = manager.storage.list_gc_reports(quantity)
+    return json.dumps(report_list, default=json_util.default)
+
+
+@auth.required
+def consul_stats():
+    return json.dumps(consul_manager.connection_stats())
+
+
+@auth.required
+def collect_garbage():
+    dry_run = request.form.get("dry_run", "false") in ("True", "true", "1")
+    manager = get_manager()
+    manager.collect_garbage(dry_run=dry_run)
+    return "", 202
+
+
+@auth.required
+def start_batch():
+    operation = request.form.get("operation")
+    if not operation:
+        return "missing operation", 400
+    selector = {}
+    for key in ("team", "plan"):
+        if request.form.get(key):
+            selector[key] = request.form.get(key)
+    instances = request.form.get("instances")
+    if instances:
+        selector["instances"] = [name.strip() for name in instances.split(",") if name.strip()]
+    params = {}
+    for key in ("quantity", "path"):
+        if request.form.get(key):
+            params[key] = request.form.get(key)
+    concurrency = request.form.get("concurrency")
+    try:
+        batch_id = get_manager().start_batch(operation, selector, params, concurrency)
+    except manager.BatchError as e:
+        return str(e), 400
+    except ValueError:
+        return "concurrency must be an integer value greather than 0", 400
+    return json.dumps({"id": batch_id}), 201
+
+
+@auth.required
+def batch_status(id):
+    try:
+        status = get_manager().batch_status(id)
+    except storage.BatchNotFoundError:
+        return "batch not found", 404
+    return json.dumps(status)
+
+
 @auth.required
 def create_plan():
     name = request.form.get("name")
@@ -92,6 +150,16 @@ def set_team_quota(team_name):
 def register_views(app, list_plans):
     app.add_url_rule("/admin/healings", methods=["GET"],
                      view_func=healings)
+    app.add_url_rule("/admin/gc", methods=["GET"],
+                     view_func=gc_reports)
+    app.add_url_rule("/admin/gc", methods=["POST"],
+                     view_func=collect_garbage)
+    app.add_url_rule("/admin/consul/stats", methods=["GET"],
+                     view_func=consul_stats)
+    app.add_url_rule("/admin/batches", methods=["POST"],
+                     view_func=start_batch)
+    app.add_url_rule("/admin/batches/<id>", methods=["GET"],
+                     view_func=batch_status)
     app.add_url_rule("/admin/plans", methods=["GET"],
                      view_func=list_plans)
     app.add_url_rule("/admin/plans", methods=["POST"],
@@ -13,7 +13,7 @@ from flask import Flask, Response, request
 from raven.contrib.flask import Sentry
 import hm.log
 
-from rpaas import (admin_api, admin_plugin, auth, get_manager, manager,
+from rpaas import (admin_api, admin_plugin, auth, get_manager, idempotency, manager,
                    plugin, storage, tasks, check_option_enable)
 
 api = Flask(__name__)
@@ -27,24 +27,11 @@ else:
 api.logger.addHandler(handler)
 hm.log.set_handler(handler)
 
-if check_option_enable(os.environ.get("RUN_LE_RENEWER")):
-    from rpaas.ssl_plugins import le_renewer
-    le_renewer.LeRenewer().start()
-
 SENTRY_DSN = os.environ.get("SENTRY_DSN")
 if SENTRY_DSN:
     api.config['SENTRY_DSN'] = SENTRY_DSN
     sentry = Sentry(api)
 
-if check_option_enable(os.environ.get("RUN_RESTORE_MACHINE")):
-    from rpaas.healing import RestoreMachine
-    RestoreMachine().start()
-
-if check_option_enable(os.environ.get("RUN_RESTORE_MACHINE")) and \
-   check_option_enable(os.environ.get("RUN_CHECK_MACHINE")):
-    from rpaas.healing import CheckMachine
-    CheckMachine().start()
-
 
 @api.route("/resources/plans", methods=["GET"])
 @auth.required
@@ -55,6 +42,7 @@ def plans():
 
 @api.route("/resources", methods=["POST"])
 @auth.required
+@idempotency.idempotent
 def add_instance():
     if "RPAAS_NEW_SERVICE" in os.environ:
         return "New instance disabled. Use {} service instead".format(os.environ["RPAAS_NEW_SERVICE"]), 405
@@ -168,8 +156,20 @@ def status(name):
     return status, 204
 
 
+@api.route("/resources/<name>/tasks/current", methods=["GET"])
+@auth.required
+def current_task(name):
+    try:
+        task = get_manager().current_task(name)
+    except tasks.TaskNotFoundError as e:
+        return str(e), 404
+    return Response(response=json.dumps(task), status=200,
+                    mimetype="application/json")
+
+
 @api.route("/resources/<name>/scale", methods=["POST"])
 @auth.required
+@idempotency.idempotent
 def scale_instance(name):
     quantity = request.form.get("quantity")
     if not quantity:
@@ -248,6 +248,7 @@ def update_certificate(name):
 
 @api.route("/resources/<name>/route", methods=["POST"])
 @auth.required
+@idempotency.idempotent
 def add_route(name):
     path = request.form.get('path')
     if not path:
@@ -347,6 +348,7 @@ def purge_location(name):
 
 @api.route("/resources/<name>/ssl", methods=["POST"])
 @auth.required
+@idempotency.idempotent
 def add_https(name):
     domain = request.form.get('domain')
     if not domain:
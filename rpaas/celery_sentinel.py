@@ -12,22 +12,188 @@ To use it::
     celery = Celery(..., broker="redis-sentinel://...", backend="redis-sentinel://...")
 """
 import logging
+import os
+import threading
+import time
+import weakref
 
 from celery.backends import BACKEND_ALIASES
 from kombu.transport import TRANSPORT_ALIASES
 from celery.backends.redis import RedisBackend
 from kombu.transport.redis import Transport, Channel
-from redis import Redis
+from redis import Redis, StrictRedis
+from redis.exceptions import ConnectionError, TimeoutError
 from redis.sentinel import Sentinel, SentinelManagedConnection
 
 
+class SentinelClient(Sentinel):
+    """
+    SentinelClient is the Sentinel shared by the result backend, the broker
+    channels and flower of a process (see shared_sentinel).
+
+    The master address is discovered once and cached for master_cache_ttl
+    seconds. A watcher thread subscribes to +switch-master on the sentinels
+    and, on failover, updates the cached address and disconnects every pool
+    built by the client, so the next command goes to the new master instead
+    of failing on the old one first.
+    """
+
+    def __init__(self, sentinels, service_name, min_other_sentinels=0, master_cache_ttl=10,
+                 **connection_kwargs):
+        super(SentinelClient, self).__init__(sentinels, min_other_sentinels=min_other_sentinels,
+                                             **connection_kwargs)
+        self.service_name = service_name
+        self.master_cache_ttl = master_cache_ttl
+        self.master_address = None
+        self.master_discovered = 0
+        self.pools = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.pid = None
+
+    def discover_master(self, service_name):
+        if service_name != self.service_name:
+            return super(SentinelClient, self).discover_master(service_name)
+        self._ensure_watcher()
+        with self.lock:
+            if self.master_address is not None and \
+               time.time() - self.master_discovered < self.master_cache_ttl:
+                return self.master_address
+        return self.refresh_master()
+
+    def refresh_master(self):
+        address = super(SentinelClient, self).discover_master(self.service_name)
+        self._set_master(address)
+        return address
+
+    def master_for(self, service_name, *args, **kwargs):
+        client = super(SentinelClient, self).master_for(service_name, *args, **kwargs)
+        self.pools.add(client.connection_pool)
+        return client
+
+    def slave_for(self, service_name, *args, **kwargs):
+        client = super(SentinelClient, self).slave_for(service_name, *args, **kwargs)
+        self.pools.add(client.connection_pool)
+        return client
+
+    def switch_master(self, message):
+        """
+        Handles a +switch-master message ("<name> <old ip> <old port> <new
+        ip> <new port>"), returning whether it was about the service.
+        """
+        parts = message.split()
+        if len(parts) != 5 or parts[0] != self.service_name:
+            return False
+        address = (parts[3], int(parts[4]))
+        logging.warning("sentinel: master of {} switched from {}:{} to {}:{}".format(
+            self.service_name, parts[1], parts[2], address[0], address[1]))
+        self._set_master(address)
+        return True
+
+    def _set_master(self, address):
+        with self.lock:
+            changed = self.master_address is not None and self.master_address != address
+            self.master_address = address
+            self.master_discovered = time.time()
+            pools = list(self.pools) if changed else []
+        for pool in pools:
+            try:
+                pool.disconnect()
+            except Exception as e:
+                logging.error("sentinel: error disconnecting pool {}: {}".format(pool, e))
+
+    def _ensure_watcher(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.master_address = None
+            self.watcher = watcher = SwitchMasterWatcher(self)
+        watcher.start()
+
+
+class SwitchMasterWatcher(threading.Thread):
+    """
+    SwitchMasterWatcher listens to +switch-master on the first sentinel
+    that accepts the subscription, moving to the next one when it fails.
+    The master is rediscovered after each subscription, as failovers may
+    have happened while it wasn't listening.
+
+    Subscriptions use their own connections, with keepalive instead of the
+    sentinel socket timeout, as they're idle until a failover.
+    """
+
+    retry_interval = 1
+
+    def __init__(self, client):
+        super(SwitchMasterWatcher, self).__init__()
+        self.daemon = True
+        self.client = client
+
+    def run(self):
+        while True:
+            for sentinel in list(self.client.sentinels):
+                try:
+                    self._listen(sentinel)
+                except (ConnectionError, TimeoutError) as e:
+                    logging.warning("sentinel: lost +switch-master subscription: {}".format(e))
+                except Exception as e:
+                    logging.error("sentinel: error watching +switch-master: {}".format(e))
+            time.sleep(self.retry_interval)
+
+    def _listen(self, sentinel):
+        connection_kwargs = dict(sentinel.connection_pool.connection_kwargs,
+                                 socket_timeout=None, socket_keepalive=True)
+        pubsub = StrictRedis(**connection_kwargs).pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe("+switch-master")
+            self.client.refresh_master()
+            for message in pubsub.listen():
+                if message["type"] == "message":
+                    self.client.switch_master(message["data"])
+        finally:
+            pubsub.close()
+
+
+_sentinels = {}
+_sentinels_lock = threading.Lock()
+
+
+def shared_sentinel(sentinels, service_name, password=None, min_other_sentinels=0,
+                    sentinel_timeout=None):
+    """
+    Returns the SentinelClient of the process for service_name.
+    """
+    key = (tuple(tuple(sentinel) for sentinel in sentinels), service_name, password)
+    with _sentinels_lock:
+        client = _sentinels.get(key)
+        if client is None:
+            client = _sentinels[key] = SentinelClient(sentinels, service_name,
+                                                      min_other_sentinels=min_other_sentinels,
+                                                      password=password, socket_timeout=sentinel_timeout)
+        return client
+
+
 class RedisSentinelBackend(RedisBackend):
+    """
+    RedisSentinelBackend stores results on the master of the sentinel
+    service. With the read_from_slaves setting, results are read from its
+    replicas instead (e.g. the task states polled by Manager._get_address),
+    falling back to the master only when no replica can be reached.
+
+    A result missing on the replica is reported as missing, not read again
+    from the master: most polled tasks ignore their results and only store
+    one on failure, and a result not replicated yet is seen by the next poll
+    after the replication delay.
+    """
 
     _redis_shared_connection = []
+    _redis_shared_slave_connection = []
 
     def __new__(cls, *args, **kwargs):
         obj = super(RedisSentinelBackend, cls).__new__(cls, *args, **kwargs)
         obj._redis_connection = cls._redis_shared_connection
+        obj._redis_slave_connection = cls._redis_shared_slave_connection
         return obj
 
     def __init__(self, sentinels=None, sentinel_timeout=None, socket_timeout=None,
@@ -38,17 +204,48 @@ class RedisSentinelBackend(RedisBackend):
     @property
     def client(self):
         if not self._redis_connection:
-            sentinel = Sentinel(
-                self.sentinel_conf.get('sentinels'),
-                min_other_sentinels=self.sentinel_conf.get("min_other_sentinels", 0),
-                password=self.sentinel_conf.get("password"),
-                socket_timeout=self.sentinel_conf.get("sentinel_timeout", None)
-            )
-            redis_connection = sentinel.master_for(self.sentinel_conf.get("service_name"), Redis,
-                                                   socket_timeout=self.sentinel_conf.get("socket_timeout"))
+            redis_connection = self._sentinel().master_for(
+                self.sentinel_conf.get("service_name"), Redis,
+                socket_timeout=self.sentinel_conf.get("socket_timeout"))
             self._redis_connection.append(redis_connection)
         return self._redis_connection[0]
 
+    @property
+    def slave_client(self):
+        if not self._redis_slave_connection:
+            redis_connection = self._sentinel().slave_for(
+                self.sentinel_conf.get("service_name"), Redis,
+                socket_timeout=self.sentinel_conf.get("socket_timeout"))
+            self._redis_slave_connection.append(redis_connection)
+        return self._redis_slave_connection[0]
+
+    def get(self, key):
+        if not self.sentinel_conf.get("read_from_slaves"):
+            return super(RedisSentinelBackend, self).get(key)
+        return self._slave_read("get", key)
+
+    def mget(self, keys):
+        keys = list(keys)
+        if not self.sentinel_conf.get("read_from_slaves"):
+            return super(RedisSentinelBackend, self).mget(keys)
+        return self._slave_read("mget", keys)
+
+    def _slave_read(self, command, *args):
+        try:
+            return getattr(self.slave_client, command)(*args)
+        except (ConnectionError, TimeoutError) as e:
+            logging.warning("sentinel: error reading results from replica, using master: {}".format(e))
+            return getattr(super(RedisSentinelBackend, self), command)(*args)
+
+    def _sentinel(self):
+        return shared_sentinel(
+            self.sentinel_conf.get('sentinels'),
+            self.sentinel_conf.get("service_name"),
+            min_other_sentinels=self.sentinel_conf.get("min_other_sentinels", 0),
+            password=self.sentinel_conf.get("password"),
+            sentinel_timeout=self.sentinel_conf.get("sentinel_timeout", None)
+        )
+
 
 class SentinelChannel(Channel):
 
@@ -62,11 +259,12 @@ class SentinelChannel(Channel):
     )
 
     def _sentinel_managed_pool(self, connection_class, async=False):
-        sentinel = Sentinel(
+        sentinel = shared_sentinel(
             self.sentinels,
+            self.service_name,
             min_other_sentinels=getattr(self, "min_other_sentinels", 0),
             password=getattr(self, "password", None),
-            socket_timeout=getattr(self, "sentinel_timeout", None)
+            sentinel_timeout=getattr(self, "sentinel_timeout", None)
         )
         return sentinel.master_for(self.service_name, self.Client,
                                    socket_timeout=self.socket_timeout,
@@ -109,10 +307,7 @@ def patch_flower_broker():
         if scheme == 'redis-sentinel':
             from rpaas.tasks import app
             opts = app.conf.BROKER_TRANSPORT_OPTIONS
-            s = Sentinel(
-                opts['sentinels'],
-                password=opts['password'],
-            )
+            s = shared_sentinel(opts['sentinels'], opts['service_name'], password=opts['password'])
             host, port = s.discover_master(opts['service_name'])
             return RedisBroker('redis://:{}@{}:{}'.format(opts['password'], host, port))
         else:
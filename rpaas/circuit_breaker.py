@@ -0,0 +1,77 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import logging
+import time
+import uuid
+
+
+class CircuitBreaker(object):
+    """
+    CircuitBreaker pauses healing when too many restores fail.
+
+    Restore outcomes of the last RESTORE_BREAKER_WINDOW seconds are kept on
+    Redis. Once RESTORE_BREAKER_MIN_FAILURES of them failed, amounting to at
+    least RESTORE_BREAKER_FAILURE_RATE of them, the breaker opens and no
+    restores are admitted for RESTORE_BREAKER_COOLDOWN seconds. It's half
+    open afterwards: the first restore that fails opens it again and the
+    first one that succeeds closes it.
+    """
+
+    def __init__(self, conn, config=None):
+        config = config or {}
+        self.conn = conn
+        self.prefix = config.get("RESTORE_BREAKER_PREFIX", "restore_breaker")
+        self.window = int(config.get("RESTORE_BREAKER_WINDOW", 600))
+        self.min_failures = int(config.get("RESTORE_BREAKER_MIN_FAILURES", 3))
+        self.failure_rate = float(config.get("RESTORE_BREAKER_FAILURE_RATE", 0.5))
+        self.cooldown = int(config.get("RESTORE_BREAKER_COOLDOWN", 900))
+
+    def allow(self):
+        return not self.conn.exists(self._open_key())
+
+    def state(self):
+        if self.conn.exists(self._open_key()):
+            return "open"
+        if self.conn.exists(self._half_open_key()):
+            return "half_open"
+        return "closed"
+
+    def record(self, success):
+        state = self.state()
+        if state == "open":
+            return
+        if state == "half_open":
+            if success:
+                self.conn.delete(self._half_open_key())
+            else:
+                self._open("restore failed while half open")
+            return
+        now = time.time()
+        with self.conn.pipeline() as pipe:
+            pipe.zadd(self._outcomes_key(), **{"{}:{}".format(uuid.uuid4().hex, int(success)): now})
+            pipe.zremrangebyscore(self._outcomes_key(), "-inf", now - self.window)
+            pipe.expire(self._outcomes_key(), self.window)
+            pipe.zrange(self._outcomes_key(), 0, -1)
+            outcomes = pipe.execute()[-1]
+        failures = len([outcome for outcome in outcomes if outcome.endswith(":0")])
+        if failures >= self.min_failures and failures >= self.failure_rate * len(outcomes):
+            self._open("{} of the last {} restores failed".format(failures, len(outcomes)))
+
+    def _open(self, reason):
+        logging.error("restore_machine: pausing healing for {} seconds, {}".format(self.cooldown, reason))
+        with self.conn.pipeline() as pipe:
+            pipe.set(self._open_key(), "1", ex=self.cooldown)
+            pipe.set(self._half_open_key(), "1", ex=self.cooldown + self.window)
+            pipe.delete(self._outcomes_key())
+            pipe.execute()
+
+    def _open_key(self):
+        return "{}:open".format(self.prefix)
+
+    def _half_open_key(self):
+        return "{}:half_open".format(self.prefix)
+
+    def _outcomes_key(self):
+        return "{}:outcomes".format(self.prefix)
@@ -0,0 +1,120 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+
+from rpaas import storage
+
+EXTRA_KEYS = ("HOST_TAGS",)
+MAX_CACHED_VERSIONS = 64
+
+_versions = {}
+_published = {}
+_indexed = set()
+_lock = threading.Lock()
+
+
+class ConfigNotFoundError(Exception):
+    pass
+
+
+def version(config):
+    data = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(data).hexdigest()
+
+
+def reference(config, plan_name=None):
+    """
+    Returns a compact reference to config, to be sent in task messages
+    instead of the config itself.
+
+    The config is stored once per version on Mongo, so workers are able to
+    resolve it. Only the values that differ from the environment of the
+    process are stored (e.g. the plan config): for the others, secrets and
+    per container variables included, only the name is stored and workers
+    take the value from their own environment. Keys listed in EXTRA_KEYS
+    change for every instance, so they are kept out of the version and sent
+    along with the reference.
+
+    Stored versions expire CONFIG_VERSION_TTL seconds after they were last
+    published, and the processes using them publish them again every half
+    of that.
+    """
+    config = dict(config)
+    extra = dict((key, config.pop(key)) for key in EXTRA_KEYS if key in config)
+    environ = sorted(key for key, value in config.iteritems() if os.environ.get(key) == value)
+    for key in environ:
+        del config[key]
+    config_version = version({"config": config, "environ": environ})
+    _publish(config_version, config, environ, plan_name)
+    ref = {"config_version": config_version, "plan_name": plan_name}
+    if extra:
+        ref["extra"] = extra
+    return ref
+
+
+def resolve(config):
+    """
+    Returns the config a task message refers to, taking the values not
+    stored from the environment of the process. Configs sent in full, as
+    tasks queued by older versions do, are returned untouched.
+    """
+    if not is_reference(config):
+        return config
+    config_version = config["config_version"]
+    with _lock:
+        resolved = _versions.get(config_version)
+    if resolved is None:
+        data = storage.MongoDBStorage(dict(os.environ)).find_config_version(config_version)
+        if data is None:
+            raise ConfigNotFoundError("config version {} not found".format(config_version))
+        resolved = (data["config"], data.get("environ") or [])
+        _cache(config_version, *resolved)
+    stored, environ = resolved
+    resolved = dict((key, os.environ[key]) for key in environ if key in os.environ)
+    resolved.update(copy.deepcopy(stored))
+    resolved.update(config.get("extra") or {})
+    return resolved
+
+
+def is_reference(config):
+    return isinstance(config, dict) and "config_version" in config
+
+
+def reset():
+    with _lock:
+        _versions.clear()
+        _published.clear()
+        _indexed.clear()
+
+
+def _publish(config_version, config, environ, plan_name):
+    ttl = int(os.environ.get("CONFIG_VERSION_TTL", 604800))
+    now = time.time()
+    with _lock:
+        if config_version in _published and now - _published[config_version] < ttl / 2:
+            return
+    db = storage.MongoDBStorage(dict(os.environ, **config))
+    with _lock:
+        indexed = db.db.name in _indexed
+    if not indexed:
+        db.ensure_config_versions_index(ttl)
+        with _lock:
+            _indexed.add(db.db.name)
+    db.store_config_version(config_version, config, plan_name, environ)
+    _cache(config_version, config, environ)
+    with _lock:
+        _published[config_version] = now
+
+
+def _cache(config_version, config, environ):
+    with _lock:
+        if len(_versions) >= MAX_CACHED_VERSIONS:
+            _versions.clear()
+        _versions[config_version] = (copy.deepcopy(config), list(environ))
@@ -2,7 +2,12 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import threading
+import time
+
 import consul
+from consul import std
+from requests import adapters
 
 from . import nginx
 
@@ -19,16 +24,109 @@ service "nginx" {{
 }}
 """
 
+_clients = {}
+_clients_lock = threading.Lock()
+
+_node_status_cache = {}
+_node_status_cache_lock = threading.Lock()
+
+
+class PooledHTTPClient(std.HTTPClient):
+    """
+    HTTP client for the Consul API that keeps its connections alive in a
+    bounded pool, so every request made by the process reuses them instead of
+    opening new TCP connections to the agent.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8500, scheme='http', verify=True,
+                 pool_size=10, timeout=None):
+        super(PooledHTTPClient, self).__init__(host, port, scheme, verify)
+        self.timeout = timeout
+        self.adapter = adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                            pool_block=True)
+        self.session.mount("{}://".format(scheme), self.adapter)
+
+    def get(self, callback, path, params=None):
+        return self._request("get", callback, path, params)
+
+    def put(self, callback, path, params=None, data=''):
+        return self._request("put", callback, path, params, data=data)
+
+    def delete(self, callback, path, params=None):
+        return self._request("delete", callback, path, params)
+
+    def post(self, callback, path, params=None, data=''):
+        return self._request("post", callback, path, params, data=data)
+
+    def _request(self, method, callback, path, params=None, **kwargs):
+        uri = self.uri(path, params)
+        response = self.session.request(method, uri, verify=self.verify,
+                                        timeout=self.timeout, **kwargs)
+        return callback(self.response(response))
+
+    def stats(self):
+        connections, requests = 0, 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests += pool.num_requests
+        return {"connections": connections, "requests": requests}
+
+
+class PooledConsul(consul.Consul):
+
+    def __init__(self, pool_size=10, timeout=None, *args, **kwargs):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        super(PooledConsul, self).__init__(*args, **kwargs)
+
+    def connect(self, host, port, scheme, verify=True):
+        return PooledHTTPClient(host, port, scheme, verify, pool_size=self.pool_size,
+                                timeout=self.timeout)
+
+
+def get_client(config):
+    host = config.get("CONSUL_HOST")
+    port = int(config.get("CONSUL_PORT", "8500"))
+    token = config.get("CONSUL_TOKEN")
+    key = (host, port, token)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            timeout = (float(config.get("CONSUL_CONNECT_TIMEOUT", "3")),
+                       float(config.get("CONSUL_READ_TIMEOUT", "330")))
+            client = PooledConsul(host=host, port=port, token=token,
+                                  pool_size=int(config.get("CONSUL_POOL_SIZE", "10")),
+                                  timeout=timeout)
+            _clients[key] = client
+        return client
+
+
+def connection_stats():
+    stats = {"clients": 0, "connections": 0, "requests": 0, "reused": 0}
+    with _clients_lock:
+        clients = list(_clients.values())
+    for client in clients:
+        client_stats = client.http.stats()
+        stats["clients"] += 1
+        stats["connections"] += client_stats["connections"]
+        stats["requests"] += client_stats["requests"]
+    stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+    return stats
+
 
 class ConsulManager(object):
 
     def __init__(self, config):
-        host = config.get("CONSUL_HOST")
-        port = int(config.get("CONSUL_PORT", "8500"))
-        token = config.get("CONSUL_TOKEN")
-        self.client = consul.Consul(host=host, port=port, token=token)
+        self.client = get_client(config)
         self.config_manager = nginx.ConfigManager(config)
         self.service_name = config.get("RPAAS_SERVICE_NAME", "rpaas")
+        self.node_status_mode = config.get("CONSUL_NODE_STATUS_MODE", "kv")
+        self.node_status_check = config.get("CONSUL_NODE_STATUS_CHECK", "rpaas-status")
+        self.node_status_cache_ttl = float(config.get("CONSUL_NODE_STATUS_CACHE_TTL", 0))
 
     def generate_token(self, instance_name):
         rules = ACL_TEMPLATE.format(service_name=self.service_name,
@@ -39,8 +137,28 @@ class ConsulManager(object):
     def destroy_token(self, acl_id):
         self.client.acl.destroy(acl_id)
 
+    def list_tokens(self):
+        tokens = {}
+        prefix = self.service_name + "/"
+        for token in self.client.acl.list():
+            name = token.get("Name") or ""
+            if name.startswith(prefix) and name.endswith("/token"):
+                tokens[name[len(prefix):-len("/token")]] = token["ID"]
+        return tokens
+
+    def list_instances(self):
+        prefix = self.service_name + "/"
+        _, keys = self.client.kv.get(prefix, keys=True, separator="/")
+        instances = set()
+        for key in keys or []:
+            name = key[len(prefix):].strip("/")
+            if name:
+                instances.add(name)
+        return instances
+
     def destroy_instance(self, instance_name):
         self.client.kv.delete(self._key(instance_name), recurse=True)
+        self._invalidate_node_status(instance_name)
 
     def write_healthcheck(self, instance_name):
         self.client.kv.put(self._key(instance_name, "healthcheck"), "true")
@@ -52,13 +170,54 @@ class ConsulManager(object):
         _, instances = self.client.health.service("nginx", tag=self.service_name)
         return instances
 
+    def service_nodes(self):
+        _, instances = self.client.catalog.service("nginx", tag=self.service_name)
+        nodes = {}
+        for instance in instances:
+            nodes[instance["Node"]] = {"address": instance["Address"],
+                                       "instance": self.instance_from_tags(instance["ServiceTags"])}
+        return nodes
+
+    def critical_nodes(self, index=None, wait=None):
+        """
+        Returns the nodes with any check not passing among the checks
+        service_healthcheck looks at: the checks of the node itself (e.g.
+        serfHealth, which fails when the machine is down) and the checks of
+        the nginx service of rpaas. Checks of other services are ignored.
+        """
+        index, checks = self.client.health.state("any", index=index, wait=wait)
+        nodes = set()
+        for check in checks:
+            if check["Status"] == "passing" or not self._is_service_check(check):
+                continue
+            nodes.add(check["Node"])
+        return index, nodes
+
+    def _is_service_check(self, check):
+        if not check.get("ServiceID"):
+            return True
+        if check.get("ServiceName") != "nginx":
+            return False
+        tags = check.get("ServiceTags")
+        return tags is None or self.service_name in tags
+
+    def instance_from_tags(self, tags):
+        instance = self.service_name
+        for tag in tags or []:
+            if self.service_name in tag:
+                continue
+            instance = tag
+        return instance
+
     def list_node(self):
         _, nodes = self.client.catalog.nodes()
         return nodes
 
     def remove_node(self, instance_name, server_name):
-        self.client.kv.delete(self._server_status_key(instance_name, server_name))
+        if self.node_status_mode != "check":
+            self.client.kv.delete(self._server_status_key(instance_name, server_name))
         self.client.agent.force_leave(server_name)
+        self._invalidate_node_status(instance_name)
 
     def node_hostname(self, host):
         for node in self.list_node():
@@ -67,21 +226,100 @@ class ConsulManager(object):
         return None
 
     def node_status(self, instance_name):
+        """
+        Returns the status reported by each node of the instance.
+
+        By default nodes report their status writing one key per node under
+        <service>/<instance>/status. With CONSUL_NODE_STATUS_MODE set to
+        "check", nodes report it as the output of the CONSUL_NODE_STATUS_CHECK
+        check of their nginx service, and the status of the whole instance is
+        read with a single health query. Results are cached by the process
+        for CONSUL_NODE_STATUS_CACHE_TTL seconds.
+        """
+        cache_key = (self.service_name, instance_name)
+        if self.node_status_cache_ttl > 0:
+            with _node_status_cache_lock:
+                cached = _node_status_cache.get(cache_key)
+            if cached and cached[0] > time.time():
+                return dict(cached[1])
+        if self.node_status_mode == "check":
+            node_status_list = self._node_status_from_checks(instance_name)
+        else:
+            node_status_list = self._node_status_from_kv(instance_name)
+        if self.node_status_cache_ttl > 0:
+            with _node_status_cache_lock:
+                _node_status_cache[cache_key] = (time.time() + self.node_status_cache_ttl,
+                                                 dict(node_status_list))
+        return node_status_list
+
+    def _node_status_from_kv(self, instance_name):
         node_status = self.client.kv.get(self._server_status_key(instance_name), recurse=True)
         node_status_list = {}
-        if node_status is not None:
+        if node_status is not None and node_status[1]:
             for node in node_status[1]:
                 node_server_name = node['Key'].split('/')[-1]
                 node_status_list[node_server_name] = node['Value']
         return node_status_list
 
+    def _node_status_from_checks(self, instance_name):
+        _, instances = self.client.health.service("nginx", tag=instance_name)
+        node_status_list = {}
+        for instance in instances:
+            if self.service_name not in (instance["Service"].get("Tags") or []):
+                continue
+            for check in instance["Checks"]:
+                if self.node_status_check in (check.get("CheckID"), check.get("Name")):
+                    node_status_list[instance["Node"]["Node"]] = check["Output"]
+        return node_status_list
+
+    def _invalidate_node_status(self, instance_name):
+        with _node_status_cache_lock:
+            _node_status_cache.pop((self.service_name, instance_name), None)
+
     def write_location(self, instance_name, path, destination=None, content=None):
-        if content:
-            content = content.strip()
-        else:
-            content = self.config_manager.generate_host_config(path, destination)
+        content = self._location_content(path, destination, content)
         self.client.kv.put(self._location_key(instance_name, path), content)
 
+    def _location_content(self, path, destination=None, content=None):
+        if content:
+            return content.strip()
+        return self.config_manager.generate_host_config(path, destination)
+
+    def binding_entries(self, instance_name, binding, with_certificate=True):
+        """
+        Returns the keys and values the given binding should have on Consul:
+        one key per location and, when with_certificate is True and the
+        binding has a certificate, its ssl keys.
+        """
+        entries = {}
+        for path_data in binding.get("paths") or []:
+            key = self._location_key(instance_name, path_data["path"])
+            entries[key] = self._location_content(path_data["path"], path_data.get("destination"),
+                                                  path_data.get("content"))
+        if with_certificate and binding.get("cert") and binding.get("key"):
+            entries[self._ssl_cert_key(instance_name)] = binding["cert"].replace("\r\n", "\n")
+            entries[self._ssl_key_key(instance_name)] = binding["key"].replace("\r\n", "\n")
+        return entries
+
+    def instance_entries(self, instance_name):
+        """
+        Returns the location and ssl keys of the instance with a single
+        recursive read.
+        """
+        prefixes = (self._key(instance_name, "locations/"), self._key(instance_name, "ssl/"))
+        _, items = self.client.kv.get(self._key(instance_name) + "/", recurse=True)
+        return dict((item["Key"], item["Value"]) for item in items or []
+                    if item["Key"].startswith(prefixes))
+
+    def put_key(self, key, value):
+        self.client.kv.put(key, value)
+
+    def delete_key(self, key):
+        self.client.kv.delete(key)
+
+    def is_location_key(self, instance_name, key):
+        return key.startswith(self._key(instance_name, "locations/"))
+
     def remove_location(self, instance_name, path):
         self.client.kv.delete(self._location_key(instance_name, path))
 
@@ -0,0 +1,98 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import logging
+import time
+
+
+class FlapDamping(object):
+    """
+    FlapDamping decides which failing machines have been failing for long
+    enough to be restored.
+
+    Checks of each machine are recorded on Redis as samples, at most one per
+    FLAP_SAMPLE_INTERVAL seconds (later checks in the same interval replace
+    the sample). A failure is confirmed once FLAP_CONFIRM_FAILURES of the last
+    FLAP_CONFIRM_WINDOW samples failed and the machine is still failing.
+
+    Every time a machine starts failing its penalty is increased by
+    FLAP_PENALTY, decaying exponentially with a half-life of FLAP_HALF_LIFE
+    seconds. Machines whose penalty reaches FLAP_SUPPRESS_LIMIT are flapping
+    and aren't restored until it decays below FLAP_REUSE_LIMIT. Penalties are
+    capped at FLAP_MAX_PENALTY, so machines that stop flapping and keep
+    failing are restored eventually.
+    """
+
+    def __init__(self, conn, config=None):
+        config = config or {}
+        self.conn = conn
+        self.prefix = config.get("FLAP_DAMPING_PREFIX", "flap_damping")
+        self.sample_interval = float(config.get("FLAP_SAMPLE_INTERVAL", 30))
+        self.confirm_failures = int(config.get("FLAP_CONFIRM_FAILURES", 3))
+        self.confirm_window = int(config.get("FLAP_CONFIRM_WINDOW", 5))
+        self.penalty = float(config.get("FLAP_PENALTY", 1000))
+        self.half_life = float(config.get("FLAP_HALF_LIFE", 900))
+        self.suppress_limit = float(config.get("FLAP_SUPPRESS_LIMIT", 3000))
+        self.reuse_limit = float(config.get("FLAP_REUSE_LIMIT", 750))
+        self.max_penalty = float(config.get("FLAP_MAX_PENALTY", 6000))
+        self.ttl = int(config.get("FLAP_HISTORY_TTL", 86400))
+
+    def observe(self, failing, passing):
+        """
+        Records a sample for the failing and passing addresses, returning the
+        set of failing addresses whose failure is confirmed and the set of
+        suppressed addresses.
+        """
+        addresses = list(failing) + [address for address in passing if address not in failing]
+        if not addresses:
+            return set(), set()
+        with self.conn.pipeline() as pipe:
+            for address in addresses:
+                pipe.hgetall(self._key(address))
+            states = pipe.execute()
+        now = time.time()
+        confirmed, suppressed = set(), set()
+        with self.conn.pipeline() as pipe:
+            for address, state in zip(addresses, states):
+                failed = address in failing
+                if not state and not failed:
+                    continue
+                state = self._update(address, state, failed, now)
+                pipe.hmset(self._key(address), state)
+                pipe.expire(self._key(address), self.ttl)
+                if state["suppressed"] == "1":
+                    suppressed.add(address)
+                elif failed and state["history"].count("1") >= self.confirm_failures:
+                    confirmed.add(address)
+            pipe.execute()
+        return confirmed, suppressed
+
+    def _penalty(self, state, now):
+        if not state.get("penalty"):
+            return 0.0
+        elapsed = max(now - float(state["updated"]), 0)
+        return float(state["penalty"]) * 0.5 ** (elapsed / self.half_life)
+
+    def _update(self, address, state, failed, now):
+        history = state.get("history", "")
+        sample = "1" if failed else "0"
+        bucket = str(int(now // self.sample_interval))
+        if history and state.get("bucket") == bucket:
+            history = history[:-1] + sample
+        else:
+            history = (history + sample)[-self.confirm_window:]
+        penalty = self._penalty(state, now)
+        if failed and state.get("failing") != "1":
+            penalty = min(penalty + self.penalty, self.max_penalty)
+        was_suppressed = state.get("suppressed") == "1"
+        suppressed = penalty >= self.suppress_limit or (was_suppressed and penalty >= self.reuse_limit)
+        if suppressed and not was_suppressed:
+            logging.warning("flap_damping: machine {} is flapping, suppressing restores".format(address))
+        elif was_suppressed and not suppressed:
+            logging.warning("flap_damping: machine {} stopped flapping".format(address))
+        return {"history": history, "bucket": bucket, "failing": sample, "penalty": penalty,
+                "updated": now, "suppressed": "1" if suppressed else "0"}
+
+    def _key(self, address):
+        return "{}:node:{}".format(self.prefix, address)
@@ -0,0 +1,28 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+
+from rpaas import config_store, tasks, scheduler
+
+
+class GarbageCollector(scheduler.JobScheduler):
+    """
+    GarbageCollector is a job that periodically adds a task to the queue
+    removing resources of instances that no longer exist.
+
+    It should run on the scheduler role, as it depends on environment
+    variables for working.
+    """
+
+    name = "garbage_collector"
+    schedule_key = "GC_SCHEDULE"
+
+    def __init__(self, config=None, *args, **kwargs):
+        super(GarbageCollector, self).__init__(*args, **kwargs)
+        self.config = config or dict(os.environ)
+        self.interval = int(self.config.get("GC_RUN_INTERVAL", 3600))
+
+    def run_job(self):
+        tasks.CollectGarbageTask().delay(config_store.reference(self.config))
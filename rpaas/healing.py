@@ -2,47 +2,172 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import json
+import logging
 import os
+import threading
 import time
-from rpaas import scheduler, tasks
+
+import redis
+
+from rpaas import config_store, consul_manager, flap_damping, scheduler, tasks
 
 
 class RestoreMachine(scheduler.JobScheduler):
     """
-    RestoreMachine is a thread for execute restore machine jobs.
+    RestoreMachine is a job for execute restore machine jobs.
 
     """
 
+    name = "restore_machine"
+    schedule_key = "RESTORE_MACHINE_SCHEDULE"
+
     def __init__(self, config=None, *args, **kwargs):
         super(RestoreMachine, self).__init__(*args, **kwargs)
         self.config = config or dict(os.environ)
         self.interval = int(self.config.get("RESTORE_MACHINE_RUN_INTERVAL", 30))
-        self.last_run_key = self.config.get("RESTORE_MACHINE_LAST_RUN_KEY", "restore_machine:last_run")
 
-    def run(self):
-        self.running = True
-        while self.running:
-            if self.try_lock():
-                tasks.RestoreMachineTask().delay(self.config)
-            time.sleep(self.interval / 2)
+    def run_job(self):
+        tasks.RestoreMachineTask().delay(config_store.reference(self.config))
 
 
-class CheckMachine(scheduler.JobScheduler):
+class CheckMachine(threading.Thread):
     """
-    CheckMachine detects machines where checks as marked 'critical' on
-    Consul and creates tasks to be consumed by RestoreMachine.
+    CheckMachine detects machines where checks aren't passing on Consul
+    and creates tasks to be consumed by RestoreMachine.
+
+    It watches Consul checks with blocking queries (see
+    ConsulManager.critical_nodes) and only dispatches the machines whose
+    state changed since the last observed index. Failures go through flap damping (see FlapDamping), so only
+    sustained failures of machines that aren't flapping are dispatched.
+    The last observed state is kept on Redis, so a newly elected scheduler
+    process doesn't dispatch the same changes again. It's only stored once
+    the changes are dispatched.
+
+    Every CHECK_MACHINE_RESYNC_INTERVAL seconds all failing and passing
+    machines are dispatched again, so changes lost along the way (e.g. a
+    failed CheckMachineTask) are eventually repaired. The stored state is
+    reset when the Consul index moves backwards.
 
+    leader, when given, is called before dispatching and nothing is
+    dispatched unless it returns True, so a scheduler process that lost its
+    leadership during a blocking query doesn't dispatch along with the new
+    leader. stop doesn't wait more than CHECK_MACHINE_STOP_TIMEOUT seconds
+    for the running query.
     """
 
-    def __init__(self, config=None, *args, **kwargs):
+    def __init__(self, config=None, leader=None, *args, **kwargs):
         super(CheckMachine, self).__init__(*args, **kwargs)
+        self.daemon = True
         self.config = config or dict(os.environ)
+        self.leader = leader
+        self.stopping = False
+        self.stop_timeout = float(self.config.get("CHECK_MACHINE_STOP_TIMEOUT", 5))
+        self.conn = tasks.app.broker_connection().channel().client
         self.interval = int(self.config.get("CHECK_MACHINE_RUN_INTERVAL", 30))
-        self.last_run_key = self.config.get("CHECK_MACHINE_LAST_RUN_KEY", "check_machine:last_run")
+        self.resync_interval = float(self.config.get("CHECK_MACHINE_RESYNC_INTERVAL", self.interval))
+        self.state_key = self.config.get("CHECK_MACHINE_STATE_KEY", "check_machine:state")
+        self.wait = self.config.get("CHECK_MACHINE_WAIT", "{}s".format(self.interval))
+        self.min_query_interval = float(self.config.get("CHECK_MACHINE_MIN_QUERY_INTERVAL", 1))
+        self.consul_manager = consul_manager.ConsulManager(self.config)
+        self.damping = flap_damping.FlapDamping(self.conn, self.config)
+        self.nodes = {}
+        self.last_resync = time.time()
 
     def run(self):
         self.running = True
+        index = None
         while self.running:
-            if self.try_lock():
-                tasks.CheckMachineTask().delay(self.config)
-            time.sleep(self.interval / 2)
+            started = time.time()
+            try:
+                new_index, critical_nodes = self.consul_manager.critical_nodes(index=index, wait=self.wait)
+                self.check_nodes(new_index, critical_nodes)
+            except Exception as e:
+                logging.error("check_machine: error watching consul checks: {}".format(e))
+                index = None
+                time.sleep(self.interval / 2)
+                continue
+            if index is not None and int(new_index) < int(index):
+                index = None
+            else:
+                index = new_index
+            elapsed = time.time() - started
+            if elapsed < self.min_query_interval:
+                time.sleep(self.min_query_interval - elapsed)
+
+    def stop(self):
+        self.stopping = True
+        self.running = False
+        self.join(self.stop_timeout)
+        if self.is_alive():
+            logging.warning("check_machine: stopped while waiting for consul, leaving the query behind")
+
+    def check_nodes(self, index, critical_nodes):
+        now = time.time()
+        resync = now - self.last_resync >= self.resync_interval
+        if resync or set(critical_nodes) - set(self.nodes):
+            self.nodes = self.consul_manager.service_nodes()
+        failing = {}
+        for node in critical_nodes:
+            if node in self.nodes:
+                failing[self.nodes[node]["address"]] = self.nodes[node]["instance"]
+        passing = [node["address"] for node in self.nodes.itervalues() if node["address"] not in failing]
+        confirmed, _ = self.damping.observe(failing, passing)
+        failing = dict((address, instance) for address, instance in failing.iteritems()
+                       if address in confirmed)
+
+        def dispatch(previous_failing):
+            if previous_failing is None:
+                if not self.nodes:
+                    self.nodes = self.consul_manager.service_nodes()
+                recovered = [node["address"] for node in self.nodes.itervalues()
+                             if node["address"] not in failing]
+                tasks.CheckMachineTask().delay(config_store.reference(self.config), failing, recovered)
+                return
+            new_failing = {}
+            for address, instance in failing.iteritems():
+                if address not in previous_failing:
+                    new_failing[address] = instance
+            recovered = [address for address in previous_failing if address not in failing]
+            if new_failing or recovered:
+                tasks.CheckMachineTask().delay(config_store.reference(self.config), new_failing, recovered)
+
+        if self.stopping or (self.leader is not None and not self.leader()):
+            logging.warning("check_machine: not the scheduler leader anymore, skipping dispatch")
+            return
+        if self._update_state(int(index), failing, dispatch, resync) and resync:
+            self.last_resync = now
+
+    def _update_state(self, index, failing, dispatch, resync=False):
+        """
+        Dispatches the changes to the failing machines seen at index and
+        stores them, returning whether they were stored.
+
+        dispatch is called with the previously stored failing machines, or
+        with None when every machine must be dispatched: on resync, when
+        there's no previous state or when the index moved backwards. It isn't
+        called when this index was already handled with the same failing
+        machines.
+        """
+        with self.conn.pipeline() as pipe:
+            try:
+                pipe.watch(self.state_key)
+                state = pipe.get(self.state_key)
+                previous_failing = None
+                if state and not resync:
+                    state = json.loads(state)
+                    if state["index"] > index:
+                        logging.warning("check_machine: consul index moved backwards from {} to {}, "
+                                        "resetting state".format(state["index"], index))
+                    elif state["index"] == index and state["failing"] == failing:
+                        pipe.unwatch()
+                        return False
+                    else:
+                        previous_failing = state["failing"]
+                dispatch(previous_failing)
+                pipe.multi()
+                pipe.set(self.state_key, json.dumps({"index": index, "failing": failing}))
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
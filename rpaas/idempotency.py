@@ -0,0 +1,75 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import functools
+import hashlib
+import json
+import os
+
+import flask
+
+from rpaas import tasks
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+def key_ttl():
+    return int(os.environ.get("IDEMPOTENCY_KEY_TTL", 86400))
+
+
+def pending_ttl():
+    return int(os.environ.get("IDEMPOTENCY_PENDING_TTL", 300))
+
+
+def request_fingerprint(request):
+    data = json.dumps(sorted(request.form.items(multi=True)))
+    return hashlib.sha1(data).hexdigest()
+
+
+def idempotent(fn):
+    """
+    Makes a view replay its original response when called again with the
+    same Idempotency-Key header, instead of running again.
+
+    Successful responses are kept on Redis for IDEMPOTENCY_KEY_TTL seconds.
+    Failed requests release the key, so they can be retried. While the view
+    runs the key is only held for IDEMPOTENCY_PENDING_TTL seconds, so a key
+    left behind by a process that died mid-request is released soon.
+    """
+    @functools.wraps(fn)
+    def decorated(*args, **kwargs):
+        key = flask.request.headers.get(HEADER)
+        if not key:
+            return fn(*args, **kwargs)
+        conn = tasks.app.backend.client
+        redis_key = "idempotency:{}:{}:{}".format(flask.request.method, flask.request.path, key)
+        fingerprint = request_fingerprint(flask.request)
+        pending = json.dumps({"fingerprint": fingerprint})
+        if not conn.set(redis_key, pending, ex=pending_ttl(), nx=True):
+            stored = conn.get(redis_key)
+            if stored is None:
+                return decorated(*args, **kwargs)
+            stored = json.loads(stored)
+            if stored["fingerprint"] != fingerprint:
+                return "{} already used with a different request".format(HEADER), 422
+            if "status" not in stored:
+                return "a request with this {} is still running".format(HEADER), 409
+            response = flask.Response(response=stored["data"], status=stored["status"],
+                                      mimetype=stored["mimetype"])
+            response.headers[REPLAYED_HEADER] = "true"
+            return response
+        try:
+            response = flask.make_response(fn(*args, **kwargs))
+        except Exception:
+            conn.delete(redis_key)
+            raise
+        if 200 <= response.status_code < 300:
+            conn.set(redis_key, json.dumps({"fingerprint": fingerprint, "status": response.status_code,
+                                            "mimetype": response.mimetype, "data": response.data}),
+                     ex=key_ttl())
+        else:
+            conn.delete(redis_key)
+        return response
+    return decorated
@@ -0,0 +1,131 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import logging
+import os
+import signal
+import sys
+import time
+
+from rpaas import check_option_enable, lease, tasks
+
+
+def start_jobs(config, leader=None):
+    """
+    Starts the periodic jobs enabled by the RUN_* settings, returning them.
+
+    leader tells whether the process still holds the scheduler leadership,
+    it's checked by the jobs that dispatch work outside of the Scheduler.
+    """
+    jobs = []
+    if check_option_enable(config.get("RUN_LE_RENEWER")):
+        from rpaas.ssl_plugins.le_renewer import LeRenewer
+        jobs.append(LeRenewer(config))
+    if check_option_enable(config.get("RUN_RESTORE_MACHINE")):
+        from rpaas.healing import RestoreMachine
+        jobs.append(RestoreMachine(config))
+    if check_option_enable(config.get("RUN_GARBAGE_COLLECTOR")):
+        from rpaas.garbage_collector import GarbageCollector
+        jobs.append(GarbageCollector(config))
+    if check_option_enable(config.get("RUN_RECONCILER")):
+        from rpaas.reconciler import Reconciler
+        jobs.append(Reconciler(config))
+    if check_option_enable(config.get("RUN_RESTORE_MACHINE")) and \
+       check_option_enable(config.get("RUN_CHECK_MACHINE")):
+        from rpaas.healing import CheckMachine
+        jobs.append(CheckMachine(config, leader=leader))
+    for job in jobs:
+        job.start()
+    return jobs
+
+
+def stop_jobs(jobs):
+    for job in jobs:
+        try:
+            job.stop()
+        except Exception as e:
+            logging.error("scheduler: error stopping {}: {}".format(type(job).__name__, e))
+
+
+class SchedulerRole(object):
+    """
+    SchedulerRole runs the periodic jobs of the deployment in the scheduler
+    processes (RPAAS_ROLE=scheduler).
+
+    Scheduler processes compete for a lease on Redis. The one holding it
+    starts the jobs and renews it every third of SCHEDULER_LEADER_TTL, the
+    others stand by and take over once it expires. A leader that fails to
+    renew its lease stops the jobs, but a job may still be running when
+    another process is elected (e.g. CheckMachine waiting on a Consul
+    blocking query). Such jobs check is_leader before dispatching, which
+    turns False a third of SCHEDULER_LEADER_TTL before the lease expires.
+    """
+
+    def __init__(self, config=None, conn=None):
+        self.config = config or dict(os.environ)
+        conn = conn or tasks.app.broker_connection().channel().client
+        ttl = int(self.config.get("SCHEDULER_LEADER_TTL", 30))
+        key = self.config.get("SCHEDULER_LEADER_KEY", "rpaas_scheduler:leader")
+        self.lease = lease.Lease(conn, key, ttl)
+        self.interval = ttl / 3.0
+        self.jobs = None
+        self.held_until = 0
+
+    @property
+    def leader(self):
+        return self.jobs is not None
+
+    def is_leader(self):
+        return time.time() < self.held_until - self.interval
+
+    def step(self):
+        now = time.time()
+        if self.leader:
+            try:
+                renewed = self.lease.renew()
+            except Exception as e:
+                logging.error("scheduler: error renewing leadership: {}".format(e))
+                renewed = False
+            if not renewed:
+                logging.warning("scheduler: lost leadership, stopping jobs")
+                self.held_until = 0
+                stop_jobs(self.jobs)
+                self.jobs = None
+            else:
+                self.held_until = now + self.lease.ttl
+        elif self.lease.acquire():
+            logging.info("scheduler: elected leader, starting jobs")
+            self.held_until = now + self.lease.ttl
+            self.jobs = start_jobs(self.config, self.is_leader)
+
+    def run(self):
+        while True:
+            try:
+                self.step()
+            except Exception as e:
+                logging.error("scheduler: error electing leader: {}".format(e))
+            time.sleep(self.interval)
+
+    def stop(self):
+        if self.leader:
+            self.held_until = 0
+            stop_jobs(self.jobs)
+            self.jobs = None
+            self.lease.release()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    role = SchedulerRole()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        role.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        role.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import logging
+import threading
+import time
+import uuid
+
+import redis
+
+
+class RestoreLeases(object):
+    """
+    RestoreLeases controls which machines are being restored.
+
+    Each machine being restored holds a lease on Redis, which expires unless
+    its holder keeps renewing it with heartbeats. A lease is only granted
+    while fewer than RESTORE_MACHINE_MAX_CONCURRENCY machines are being
+    restored, fewer than RESTORE_MACHINE_ZONE_CONCURRENCY machines of the
+    same zone and fewer than RESTORE_MACHINE_INSTANCE_CONCURRENCY machines of
+    the same instance.
+
+    Leases are granted when restores are dispatched, for
+    RESTORE_LEASE_DISPATCH_TTL seconds so they cover the wait on the queue,
+    and renewed for RESTORE_LEASE_TTL seconds at a time once the restore
+    starts.
+    """
+
+    def __init__(self, conn, config=None):
+        config = config or {}
+        self.conn = conn
+        self.ttl = int(config.get("RESTORE_LEASE_TTL", 60))
+        self.dispatch_ttl = int(config.get("RESTORE_LEASE_DISPATCH_TTL", 900))
+        self.max_concurrency = int(config.get("RESTORE_MACHINE_MAX_CONCURRENCY", 5))
+        self.zone_concurrency = int(config.get("RESTORE_MACHINE_ZONE_CONCURRENCY", 3))
+        self.instance_concurrency = int(config.get("RESTORE_MACHINE_INSTANCE_CONCURRENCY", 1))
+        self.prefix = config.get("RESTORE_LEASE_PREFIX", "restore_lease")
+
+    def acquire(self, host, instance, zone=None):
+        now = time.time()
+        lease_key = self._lease_key(host)
+        all_key, instance_key = self._all_key(), self._instance_key(instance)
+        limits = [(all_key, self.max_concurrency), (instance_key, self.instance_concurrency)]
+        if zone is not None:
+            limits.append((self._zone_key(zone), self.zone_concurrency))
+        for key, _ in limits:
+            self.conn.zremrangebyscore(key, "-inf", now)
+        token = uuid.uuid4().hex
+        with self.conn.pipeline() as pipe:
+            try:
+                pipe.watch(lease_key, *[key for key, _ in limits])
+                if pipe.exists(lease_key) or any(pipe.zcard(key) >= limit for key, limit in limits):
+                    pipe.unwatch()
+                    return None
+                pipe.multi()
+                self._store(pipe, host, instance, zone, token, self.dispatch_ttl)
+                pipe.execute()
+                return token
+            except redis.WatchError:
+                return None
+
+    def renew(self, host, instance, token, zone=None):
+        lease_key = self._lease_key(host)
+        with self.conn.pipeline() as pipe:
+            try:
+                pipe.watch(lease_key)
+                if pipe.get(lease_key) != token:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                self._store(pipe, host, instance, zone, token, self.ttl)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def release(self, host, instance, token, zone=None):
+        lease_key = self._lease_key(host)
+        with self.conn.pipeline() as pipe:
+            try:
+                pipe.watch(lease_key)
+                if pipe.get(lease_key) != token:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.delete(lease_key)
+                pipe.zrem(self._all_key(), host)
+                pipe.zrem(self._instance_key(instance), host)
+                if zone is not None:
+                    pipe.zrem(self._zone_key(zone), host)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def heartbeat(self, host, instance, token, zone=None):
+        def renew():
+            try:
+                renewed = self.renew(host, instance, token, zone)
+            except Exception as e:
+                logging.error("restore_lease: error renewing lease of {}: {}".format(host, e))
+                renewed = False
+            if not renewed:
+                logging.warning("restore_lease: lost lease of {}".format(host))
+            return renewed
+        heartbeat = Heartbeat(renew, self.ttl / 3.0)
+        heartbeat.start()
+        return heartbeat
+
+    def _store(self, pipe, host, instance, zone, token, ttl):
+        expires = time.time() + ttl
+        pipe.set(self._lease_key(host), token, ex=ttl)
+        pipe.zadd(self._all_key(), **{host: expires})
+        pipe.zadd(self._instance_key(instance), **{host: expires})
+        if zone is not None:
+            pipe.zadd(self._zone_key(zone), **{host: expires})
+
+    def _lease_key(self, host):
+        return "{}:host:{}".format(self.prefix, host)
+
+    def _all_key(self):
+        return "{}:all".format(self.prefix)
+
+    def _instance_key(self, instance):
+        return "{}:instance:{}".format(self.prefix, instance)
+
+    def _zone_key(self, zone):
+        return "{}:zone:{}".format(self.prefix, zone)
+
+
+class Heartbeat(threading.Thread):
+    """
+    Heartbeat calls renew every interval seconds until it is stopped or
+    renew returns False.
+    """
+
+    def __init__(self, renew, interval):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.renew = renew
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.renew():
+                break
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Lease(object):
+    """
+    Lease is a single named lease on Redis, held by at most one process at a
+    time. It expires after ttl seconds unless its holder renews it.
+    """
+
+    def __init__(self, conn, key, ttl):
+        self.conn = conn
+        self.key = key
+        self.ttl = int(ttl)
+        self.token = uuid.uuid4().hex
+
+    def acquire(self):
+        return bool(self.conn.set(self.key, self.token, ex=self.ttl, nx=True))
+
+    def renew(self):
+        with self.conn.pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+                if pipe.get(self.key) != self.token:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.expire(self.key, self.ttl)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def release(self):
+        with self.conn.pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+                if pipe.get(self.key) != self.token:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.delete(self.key)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+class LeaseLock(Lease):
+    """
+    LeaseLock is a Lease held by a task while it runs.
+
+    Acquiring it returns a fencing token, which increases on every
+    acquisition of the key, and starts a heartbeat renewing it every third of
+    its ttl, so it's held for as long as the task runs and expires ttl
+    seconds after its holder dies. Tasks store the fencing token along with
+    their side effects and check held before each of them, so a holder that
+    lost the lock can't overwrite the work of the next one.
+
+    renewed, when set, is called after every heartbeat that renews the lock.
+    """
+
+    def __init__(self, conn, key, ttl, renewed=None):
+        super(LeaseLock, self).__init__(conn, key, ttl)
+        self.renewed = renewed
+        self.fence = None
+        self.heartbeat = None
+
+    @property
+    def held(self):
+        return self.heartbeat is not None and self.heartbeat.is_alive()
+
+    def acquire(self):
+        if not super(LeaseLock, self).acquire():
+            return None
+        self.fence = self.conn.incr(self._fence_key())
+        self.heartbeat = Heartbeat(self._renew, self.ttl / 3.0)
+        self.heartbeat.start()
+        return self.fence
+
+    def release(self):
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+            self.heartbeat = None
+        return super(LeaseLock, self).release()
+
+    def _renew(self):
+        try:
+            renewed = self.renew()
+        except Exception as e:
+            logging.error("lease: error renewing lock {}: {}".format(self.key, e))
+            renewed = False
+        if not renewed:
+            logging.warning("lease: lost lock {} (fence {})".format(self.key, self.fence))
+        elif self.renewed is not None:
+            try:
+                self.renewed()
+            except Exception as e:
+                logging.error("lease: error after renewing lock {}: {}".format(self.key, e))
+        return renewed
+
+    def _fence_key(self):
+        return "{}:fence".format(self.key)
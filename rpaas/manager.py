@@ -8,16 +8,19 @@ import copy
 import datetime
 import os
 import socket
+import uuid
 
 import hm.managers.cloudstack  # NOQA
 import hm.lb_managers.networkapi_cloudstack  # NOQA
 from hm.model.load_balancer import LoadBalancer
 
-from rpaas import consul_manager, nginx, ssl, ssl_plugins, storage, tasks
+from rpaas import acme_scheduler, config_store, consul_manager, nginx, ssl, ssl_plugins, storage, tasks
 
 PENDING = "pending"
 FAILURE = "failure"
 
+BATCH_OPERATIONS = ("scale", "purge", "renew_certificate")
+
 
 class Manager(object):
 
@@ -51,35 +54,31 @@ class Manager(object):
         self.consul_manager.write_healthcheck(name)
         self.storage.store_instance_metadata(name, **metadata)
         self._add_tags(name, config, consul_token)
-        task = tasks.NewInstanceTask().delay(config, name)
+        task = tasks.NewInstanceTask().delay(config_store.reference(config, plan_name), name)
         self.task_manager.update(name, task.task_id)
 
     def _add_tags(self, instance_name, config, consul_token):
-        tags = ["rpaas_service:" + self.service_name,
-                "rpaas_instance:" + instance_name,
-                "consul_token:" + consul_token]
-        extra_tags = config.get("INSTANCE_EXTRA_TAGS", "")
-        if extra_tags:
-            del config["INSTANCE_EXTRA_TAGS"]
-            tags.append(extra_tags)
-        config["HOST_TAGS"] = ",".join(tags)
+        tasks.add_host_tags(config, self.service_name, instance_name, consul_token)
 
     def remove_instance(self, name):
         self.task_manager.create(name)
         metadata = self.storage.find_instance_metadata(name)
         config = copy.deepcopy(self.config)
+        plan_name = None
         if metadata and "plan_name" in metadata:
             plan = self.storage.find_plan(metadata["plan_name"])
             if plan:
+                plan_name = plan.name
                 config.update(plan.config)
         if metadata and metadata.get("consul_token"):
             self.consul_manager.destroy_token(metadata["consul_token"])
         self.consul_manager.destroy_instance(name)
+        acme_scheduler.AcmeScheduler(tasks.app.backend.client, self.config).cancel(name)
         self.storage.decrement_quota(name)
         self.storage.remove_task(name)
         self.storage.remove_binding(name)
         self.storage.remove_instance_metadata(name)
-        tasks.RemoveInstanceTask().delay(config, name)
+        tasks.RemoveInstanceTask().delay(config_store.reference(config, plan_name), name)
 
     def restore_machine_instance(self, name, machine, cancel_task=False):
         task_name = "restore_{}".format(machine)
@@ -94,7 +93,8 @@ class Manager(object):
         if machine_data is None:
             raise InstanceMachineNotFoundError()
         self.task_manager.create({"_id": task_name, "host": machine,
-                                 "instance": name, "created": datetime.datetime.utcnow()})
+                                 "instance": name, "created": datetime.datetime.utcnow()},
+                                 expires=False)
 
     def bind(self, name, app_host):
         self.task_manager.ensure_ready(name)
@@ -179,6 +179,30 @@ class Manager(object):
                 node_status_return[node]['address'] = hostnames[node]
         return node_status_return
 
+    def current_task(self, name):
+        task = None
+        for task in self.storage.find_task(name):
+            break
+        if task is None:
+            raise tasks.TaskNotFoundError("No task running for {}".format(name))
+        progress = {}
+        for key in ("operation", "plan_name", "host_manager", "desired_quantity", "task_id"):
+            if task.get(key) is not None:
+                progress[key] = task[key]
+        if task.get("started"):
+            progress["started"] = task["started"].isoformat()
+        progress["steps"] = []
+        for step in task.get("steps") or []:
+            step = dict(step)
+            for key in ("start", "end"):
+                if step.get(key):
+                    step[key] = step[key].isoformat()
+            progress["steps"].append(step)
+        acme_queue = acme_scheduler.AcmeScheduler(tasks.app.backend.client, self.config).status(name)
+        if acme_queue is not None:
+            progress["acme_queue"] = acme_queue
+        return progress
+
     def update_certificate(self, name, cert, key):
         self.task_manager.ensure_ready(name)
         lb = LoadBalancer.find(name)
@@ -200,10 +224,17 @@ class Manager(object):
         return lb.address
 
     def scale_instance(self, name, quantity):
-        self.task_manager.ensure_ready(name)
         if quantity <= 0:
             raise ScaleError("Can't have 0 instances")
-        self.task_manager.create(name)
+        if self.task_manager.update_target(name, quantity):
+            return
+        self.task_manager.ensure_ready(name)
+        try:
+            self.task_manager.create({"_id": name, "desired_quantity": quantity})
+        except storage.DuplicateError:
+            if self.task_manager.update_target(name, quantity):
+                return
+            raise tasks.NotReadyError("Async task still running")
         config = copy.deepcopy(self.config)
         metadata = self.storage.find_instance_metadata(name)
         if not metadata or "consul_token" not in metadata:
@@ -214,7 +245,8 @@ class Manager(object):
             plan = self.storage.find_plan(metadata["plan_name"])
             config.update(plan.config or {})
         self._add_tags(name, config, metadata["consul_token"])
-        task = tasks.ScaleInstanceTask().delay(config, name, quantity)
+        config_ref = config_store.reference(config, metadata.get("plan_name"))
+        task = tasks.ScaleInstanceTask().delay(config_ref, name, quantity)
         self.task_manager.update(name, task.task_id)
 
     def add_route(self, name, path, destination, content):
@@ -244,6 +276,9 @@ class Manager(object):
     def list_healings(self, quantity):
         return self.storage.list_healings(quantity)
 
+    def collect_garbage(self, dry_run=False):
+        tasks.CollectGarbageTask().delay(config_store.reference(self.config), dry_run=dry_run)
+
     def purge_location(self, name, path):
         self.task_manager.ensure_ready(name)
         path = path.strip()
@@ -316,7 +351,8 @@ class Manager(object):
         if plugin == 'le':
             try:
                 self.task_manager.create(name)
-                task = tasks.DownloadCertTask().delay(self.config, name, plugin, csr, key, domain)
+                task = tasks.DownloadCertTask().delay(config_store.reference(self.config), name,
+                                                      plugin, csr, key, domain)
                 self.task_manager.update(name, task.task_id)
                 return ''
             except Exception:
@@ -328,6 +364,94 @@ class Manager(object):
             self.update_certificate(name, cert, key)
             return ''
 
+    def renew_certificate(self, name):
+        self.task_manager.ensure_ready(name)
+        cert = None
+        for cert in self.storage.find_le_certificates({"name": name}):
+            break
+        if cert is None:
+            raise SslError("{} has no Let's Encrypt certificate".format(name))
+        self.task_manager.create(name)
+        config = copy.deepcopy(self.config)
+        metadata = self.storage.find_instance_metadata(name) or {}
+        if "plan_name" in metadata:
+            plan = self.storage.find_plan(metadata["plan_name"])
+            config.update(plan.config or {})
+        task = tasks.RenewCertTask().delay(config_store.reference(config, metadata.get("plan_name")),
+                                           name, cert["domain"])
+        self.task_manager.update(name, task.task_id)
+
+    def start_batch(self, operation, selector, params=None, concurrency=None):
+        params = params or {}
+        if operation not in BATCH_OPERATIONS:
+            raise BatchError("invalid operation {}".format(operation))
+        if operation == "scale":
+            try:
+                if int(params.get("quantity")) <= 0:
+                    raise ValueError()
+            except (TypeError, ValueError):
+                raise BatchError("quantity must be an integer value greather than 0")
+        if operation == "purge" and not params.get("path"):
+            raise BatchError("missing path")
+        concurrency = int(concurrency or self.config.get("BATCH_CONCURRENCY", 10))
+        if concurrency <= 0:
+            raise BatchError("concurrency must be an integer value greather than 0")
+        names = self._select_instances(selector)
+        if not names:
+            raise BatchError("no instances match the selector")
+        batch = {"_id": uuid.uuid4().hex, "operation": operation, "params": params,
+                 "selector": selector, "concurrency": concurrency, "total": len(names),
+                 "pending": names, "running": [], "succeeded": [], "failed": [],
+                 "status": "running", "created": datetime.datetime.utcnow()}
+        self.storage.store_batch(batch)
+        config_ref = config_store.reference(self.config)
+        for _ in xrange(min(concurrency, len(names))):
+            tasks.BatchTask().delay(config_ref, batch["_id"])
+        return batch["_id"]
+
+    def _select_instances(self, selector):
+        selected = None
+        if selector.get("instances"):
+            selected = set(selector["instances"])
+        if selector.get("team"):
+            used, _ = self.storage.find_team_quota(selector["team"])
+            selected = set(used) if selected is None else selected & set(used)
+        if selector.get("plan"):
+            names = self.storage.instance_names(self.storage.instance_metadata_collection,
+                                                query={"plan_name": selector["plan"]})
+            selected = names if selected is None else selected & names
+        if selected is None:
+            raise BatchError("selector requires instances, team or plan")
+        return sorted(selected)
+
+    def batch_status(self, id):
+        batch = self.storage.find_batch(id)
+        status = {"id": batch["_id"], "operation": batch["operation"], "params": batch["params"],
+                  "selector": batch["selector"], "concurrency": batch["concurrency"],
+                  "status": batch["status"], "total": batch["total"],
+                  "pending": len(batch["pending"]), "running": batch["running"],
+                  "succeeded": len(batch["succeeded"]), "failed": batch["failed"],
+                  "created": batch["created"].isoformat()}
+        if batch.get("finished"):
+            status["finished"] = batch["finished"].isoformat()
+        return status
+
+    def run_batch_item(self, operation, name, params):
+        """
+        Runs operation on name, returning True when it goes on in a task
+        that holds the instance until it finishes.
+        """
+        if operation == "scale":
+            self.scale_instance(name, int(params["quantity"]))
+            return True
+        if operation == "purge":
+            self.purge_location(name, params["path"])
+            return False
+        if operation == "renew_certificate":
+            self.renew_certificate(name)
+            return True
+        raise BatchError("invalid operation {}".format(operation))
+
     def revoke_ssl(self, name, plugin='default'):
         lb = LoadBalancer.find(name)
         if lb is None:
@@ -366,6 +490,10 @@ class SslError(Exception):
     pass
 
 
+class BatchError(Exception):
+    pass
+
+
 class InstanceMachineNotFoundError(Exception):
     pass
 
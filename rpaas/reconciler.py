@@ -0,0 +1,28 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+
+from rpaas import config_store, tasks, scheduler
+
+
+class Reconciler(scheduler.JobScheduler):
+    """
+    Reconciler is a job that periodically adds a task to the queue
+    repairing drift between bindings on Mongo and the Consul KV tree.
+
+    It should run on the scheduler role, as it depends on environment
+    variables for working.
+    """
+
+    name = "reconciler"
+    schedule_key = "RECONCILE_SCHEDULE"
+
+    def __init__(self, config=None, *args, **kwargs):
+        super(Reconciler, self).__init__(*args, **kwargs)
+        self.config = config or dict(os.environ)
+        self.interval = int(self.config.get("RECONCILE_RUN_INTERVAL", 600))
+
+    def run_job(self):
+        tasks.ReconcileBindingsTask().delay(config_store.reference(self.config))
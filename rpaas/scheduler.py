@@ -2,55 +2,252 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import calendar
 import datetime
+import logging
 import os
 import threading
-
-import redis
+import time
 
 from rpaas import tasks
 
-DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Claims the first due job among the ones in ARGV[3..], moving its score
+# to ARGV[1] + ARGV[2] so no other process claims it while it's being
+# rescheduled. Returns the job name and its previous score.
+CLAIM_SCRIPT = """
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1])
+local names = {}
+for i = 3, #ARGV do
+    names[ARGV[i]] = true
+end
+for _, name in ipairs(due) do
+    if names[name] then
+        local score = redis.call('zscore', KEYS[1], name)
+        redis.call('zadd', KEYS[1], ARGV[1] + ARGV[2], name)
+        return {name, score}
+    end
+end
+return {}
+"""
+
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+class IntervalSchedule(object):
 
+    def __init__(self, seconds):
+        self.seconds = float(seconds)
+        if self.seconds <= 0:
+            raise ValueError("interval must be greater than 0")
 
-class JobScheduler(threading.Thread):
+    def next_after(self, timestamp):
+        return timestamp + self.seconds
+
+
+class CronSchedule(object):
     """
-    Generic Job Scheduler.
+    CronSchedule accepts five field cron expressions (minute, hour, day of
+    month, month and day of week) in UTC, with lists, ranges and steps.
+    """
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("invalid cron expression {!r}".format(expression))
+        values = [self._parse_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS)]
+        self.minutes, self.hours, self.days, self.months, self.weekdays = values
+        if 7 in self.weekdays:
+            self.weekdays.remove(7)
+            self.weekdays.add(0)
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def next_after(self, timestamp):
+        moment = datetime.datetime.utcfromtimestamp(int(timestamp) // 60 * 60)
+        moment += datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=366 * 4)
+        while moment < limit:
+            if moment.month not in self.months or not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return float(calendar.timegm(moment.utctimetuple()))
+        raise ValueError("cron expression never matches")
+
+    def _day_matches(self, moment):
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def _parse_field(self, field, low, high):
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/", 1)
+                step = int(step)
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = [int(v) for v in part.split("-", 1)]
+            else:
+                start = end = int(part)
+            if start < low or end > high or start > end or step <= 0:
+                raise ValueError("invalid cron field {!r}".format(field))
+            values.update(range(start, end + 1, step))
+        return values
+
 
-    It should run on the API role, as it depends on environment variables for
-    working.
+def parse_schedule(value):
+    """
+    Returns the schedule for value, which is either an interval in seconds
+    or a cron expression.
+    """
+    try:
+        return IntervalSchedule(float(value))
+    except ValueError:
+        return CronSchedule(str(value))
+
+
+class Scheduler(threading.Thread):
+    """
+    Scheduler runs the periodic jobs of the process.
+
+    The next run of every job is kept in a Redis sorted set shared by all
+    scheduler processes. Due jobs are claimed atomically with a Lua script, so
+    each run happens in only one process, and the thread sleeps until the
+    next job is due (at most SCHEDULER_MAX_SLEEP seconds, so it notices
+    jobs rescheduled by other processes).
     """
 
     def __init__(self, config=None, *args, **kwargs):
-        super(JobScheduler, self).__init__(*args, **kwargs)
+        super(Scheduler, self).__init__(*args, **kwargs)
         self.daemon = True
         self.config = config or dict(os.environ)
-        self.interval = int(self.config.get("JOB_SCHEDULER_RUN_INTERVAL", 30))
-        self.last_run_key = self.config.get("JOB_SCHEDULER_LAST_RUN_KEY", "job_scheduler:last_run")
+        self.key = self.config.get("SCHEDULER_KEY", "rpaas_scheduler:jobs")
+        self.claim_timeout = int(self.config.get("SCHEDULER_CLAIM_TIMEOUT", 60))
+        self.max_sleep = float(self.config.get("SCHEDULER_MAX_SLEEP", 30))
         self.conn = tasks.app.broker_connection().channel().client
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+
+    def add_job(self, name, schedule, fn):
+        with self.lock:
+            self.jobs[name] = (schedule, fn)
+        if self.conn.zscore(self.key, name) is None:
+            self.conn.zadd(self.key, **{name: time.time()})
 
-    def try_lock(self):
-        interval_delta = datetime.timedelta(seconds=self.interval)
-        with self.conn.pipeline() as pipe:
+    def remove_job(self, name):
+        with self.lock:
+            self.jobs.pop(name, None)
+            return len(self.jobs)
+
+    def run_pending(self):
+        """
+        Runs the due jobs, returning how many seconds to wait for the next
+        one.
+        """
+        while True:
+            with self.lock:
+                jobs = dict(self.jobs)
+            if not jobs:
+                return self.max_sleep
+            now = time.time()
+            claimed = self.conn.eval(CLAIM_SCRIPT, 1, self.key, now, self.claim_timeout, *jobs.keys())
+            if not claimed:
+                break
+            name, score = claimed[0], float(claimed[1])
+            schedule, fn = jobs[name]
+            next_run = schedule.next_after(score)
+            if next_run <= now:
+                next_run = schedule.next_after(now)
+            self.conn.zadd(self.key, **{name: next_run})
             try:
-                now = datetime.datetime.utcnow()
-                pipe.watch(self.last_run_key)
-                last_run = pipe.get(self.last_run_key)
-                if last_run:
-                    last_run_date = datetime.datetime.strptime(last_run, DATETIME_FORMAT)
-                    if now - last_run_date < interval_delta:
-                        pipe.unwatch()
-                        return False
-                pipe.multi()
-                pipe.set(self.last_run_key, now.strftime(DATETIME_FORMAT))
-                pipe.execute()
-                return True
-            except redis.WatchError:
-                return False
+                fn()
+            except Exception as e:
+                logging.error("scheduler: error running job {}: {}".format(name, e))
+        scores = [s for s in (self.conn.zscore(self.key, job) for job in jobs) if s is not None]
+        if not scores:
+            return self.max_sleep
+        return max(min(scores) - time.time(), 0)
 
     def run(self):
-        raise NotImplementedError()
+        self.running = True
+        while self.running:
+            try:
+                wait = self.run_pending()
+            except Exception as e:
+                logging.error("scheduler: error claiming jobs: {}".format(e))
+                wait = self.max_sleep
+            self.wakeup.wait(min(wait, self.max_sleep))
+            self.wakeup.clear()
 
     def stop(self):
         self.running = False
-        self.join()
+        self.wakeup.set()
+        if self.is_alive():
+            self.join()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def add_job(name, schedule, fn):
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+            _scheduler.add_job(name, schedule, fn)
+            _scheduler.start()
+        else:
+            _scheduler.add_job(name, schedule, fn)
+            _scheduler.wakeup.set()
+
+
+def remove_job(name):
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is not None and _scheduler.remove_job(name) == 0:
+            _scheduler.stop()
+            _scheduler = None
+
+
+class JobScheduler(object):
+    """
+    Generic Job Scheduler.
+
+    Subclasses define run_job, which is called by the process Scheduler on
+    every run of their schedule. The schedule is the *_SCHEDULE setting of
+    the job (an interval in seconds or a cron expression) or, when it's not
+    set, its interval.
+
+    It should run on the scheduler role (see rpaas.jobs), as it depends on
+    environment variables for working.
+    """
+
+    name = "job_scheduler"
+    schedule_key = "JOB_SCHEDULER_SCHEDULE"
+
+    def __init__(self, config=None, *args, **kwargs):
+        self.config = config or dict(os.environ)
+        self.interval = int(self.config.get("JOB_SCHEDULER_RUN_INTERVAL", 30))
+
+    def schedule(self):
+        return parse_schedule(self.config.get(self.schedule_key) or self.interval)
+
+    def start(self):
+        add_job(self.name, self.schedule(), self.run_job)
+
+    def stop(self):
+        remove_job(self.name)
+
+    def run_job(self):
+        raise NotImplementedError()
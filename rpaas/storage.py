@@ -23,6 +23,10 @@ class DuplicateError(Exception):
     pass
 
 
+class BatchNotFoundError(Exception):
+    pass
+
+
 class MongoDBStorage(storage.MongoDBStorage):
     hcs_collections = "hcs"
     tasks_collection = "tasks"
@@ -32,6 +36,9 @@ class MongoDBStorage(storage.MongoDBStorage):
     quota_collection = "quota"
     le_certificates_collection = "le_certificates"
     healing_collection = "healing"
+    gc_reports_collection = "gc_reports"
+    config_versions_collection = "config_versions"
+    batches_collection = "batches"
 
     def store_hc(self, hc):
         self.db[self.hcs_collections].update({"_id": hc["_id"]}, hc, upsert=True)
@@ -46,16 +53,83 @@ class MongoDBStorage(storage.MongoDBStorage):
         return self.db[self.healing_collection].insert({"instance": instance, "machine": machine,
                                                         "start_time": datetime.datetime.utcnow()})
 
-    def update_healing(self, id, status):
-        self.db[self.healing_collection].update({"_id": id},
-                                                {"$set": {"status": status,
-                                                          "end_time": datetime.datetime.utcnow()}})
+    def update_healing(self, id, status, **fields):
+        fields.update({"status": status, "end_time": datetime.datetime.utcnow()})
+        self.db[self.healing_collection].update({"_id": id}, {"$set": fields})
 
     def list_healings(self, quantity):
         coll = self.healing_collection
         healings = self.db[coll].find({}, {'_id': 0}).sort("start_time", -1).limit(quantity)
         return [healing for healing in healings]
 
+    def store_gc_report(self, report):
+        return self.db[self.gc_reports_collection].insert(report)
+
+    def update_gc_report(self, id, data):
+        self.db[self.gc_reports_collection].update({"_id": id}, {"$set": data})
+
+    def list_gc_reports(self, quantity):
+        coll = self.gc_reports_collection
+        reports = self.db[coll].find({}, {'_id': 0}).sort("start_time", -1).limit(quantity)
+        return [report for report in reports]
+
+    def store_batch(self, batch):
+        self.db[self.batches_collection].insert(batch)
+
+    def find_batch(self, id):
+        batch = self.db[self.batches_collection].find_one({"_id": id})
+        if batch is None:
+            raise BatchNotFoundError()
+        return batch
+
+    def next_batch_item(self, id):
+        while True:
+            batch = self.db[self.batches_collection].find_one({"_id": id}, {"pending": 1})
+            if not batch or not batch["pending"]:
+                return None
+            name = batch["pending"][0]
+            result = self.db[self.batches_collection].update({"_id": id, "pending": name},
+                                                             {"$pull": {"pending": name},
+                                                              "$addToSet": {"running": name}})
+            if result["n"] == 1:
+                return name
+
+    def finish_batch_item(self, id, name, error=None):
+        if error is None:
+            update = {"$pull": {"running": name}, "$push": {"succeeded": name}}
+        else:
+            update = {"$pull": {"running": name}, "$push": {"failed": {"name": name, "error": error}}}
+        self.db[self.batches_collection].update({"_id": id}, update)
+        self.db[self.batches_collection].update({"_id": id, "pending": [], "running": [],
+                                                 "status": "running"},
+                                                {"$set": {"status": "finished",
+                                                          "finished": datetime.datetime.utcnow()}})
+
+    def find_live_instances(self):
+        live = self.instance_names(self.instance_metadata_collection)
+        live.update(self.instance_names(self.quota_collection, "used"))
+        live.update(self.instance_names(self.tasks_collection, query={"host": {"$exists": False}}))
+        return live
+
+    def instance_names(self, collection, key="_id", query=None):
+        return set(name for name in self.db[collection].find(query or {}).distinct(key) if name)
+
+    def remove_instances_data(self, collection, names, key="_id", query=None):
+        query = dict(query or {})
+        query[key] = {"$in": list(names)}
+        self.db[collection].remove(query)
+
+    def store_config_version(self, version, config, plan_name=None, environ=None):
+        doc = {"_id": version, "config": config, "plan_name": plan_name, "environ": environ or [],
+               "published": datetime.datetime.utcnow()}
+        self.db[self.config_versions_collection].update({"_id": version}, doc, upsert=True)
+
+    def ensure_config_versions_index(self, ttl):
+        self.db[self.config_versions_collection].ensure_index('published', expireAfterSeconds=ttl)
+
+    def find_config_version(self, version):
+        return self.db[self.config_versions_collection].find_one({"_id": version})
+
     def store_task(self, name):
         try:
             if isinstance(name, dict):
@@ -68,12 +142,70 @@ class MongoDBStorage(storage.MongoDBStorage):
     def remove_task(self, query):
         self.db[self.tasks_collection].remove(query)
 
+    def add_task_step(self, name, step):
+        self.db[self.tasks_collection].update({'_id': name}, {'$push': {'steps': step}})
+
+    def update_task_target(self, name, quantity):
+        result = self.db[self.tasks_collection].update(
+            {'_id': name, 'desired_quantity': {'$exists': True},
+             'expire_at': {'$not': {'$lt': datetime.datetime.utcnow()}}},
+            {'$set': {'desired_quantity': quantity}})
+        return result['n'] == 1
+
+    def remove_task_target(self, name, quantity=None):
+        if quantity is None:
+            quantity = {'$exists': False}
+        result = self.db[self.tasks_collection].remove({'_id': name, 'desired_quantity': quantity})
+        return result['n'] == 1
+
+    def store_restore_tasks(self, machines):
+        now = datetime.datetime.utcnow()
+        for address, instance in machines.iteritems():
+            task_name = "restore_{}".format(address)
+            self.db[self.tasks_collection].update(
+                {'_id': task_name},
+                {'$setOnInsert': {'host': address, 'instance': instance, 'created': now}},
+                upsert=True)
+
+    def remove_restore_tasks(self, addresses):
+        task_names = ["restore_{}".format(address) for address in addresses]
+        self.db[self.tasks_collection].remove({'_id': {'$in': task_names}})
+
     def update_task(self, name, task_id_or_spec):
         if isinstance(task_id_or_spec, dict):
             self.db[self.tasks_collection].update({'_id': name}, {'$set': task_id_or_spec})
         else:
             self.db[self.tasks_collection].update({'_id': name}, {'$set': {'task_id': task_id_or_spec}})
 
+    def fence_task(self, name, fence, task_id=None, **fields):
+        """
+        Stores the fencing token of the lock held on the task, along with
+        fields, returning False when the task holds a newer one, belongs to
+        another async task than task_id or doesn't exist anymore (e.g. it was
+        cancelled or taken over).
+        """
+        query = {'_id': name, 'fence': {'$not': {'$gt': fence}}}
+        if task_id is not None:
+            query['task_id'] = {'$in': [None, task_id]}
+        fields['fence'] = fence
+        result = self.db[self.tasks_collection].update(query, {'$set': fields})
+        return result['n'] == 1
+
+    def heartbeat_task(self, name, expire_at, fence=None, **fields):
+        query = {'_id': name}
+        if fence is not None:
+            query['fence'] = fence
+        fields.update({'heartbeat': datetime.datetime.utcnow(), 'expire_at': expire_at})
+        result = self.db[self.tasks_collection].update(query, {'$set': fields})
+        return result['n'] == 1
+
+    def remove_expired_task(self, name, expire_at):
+        result = self.db[self.tasks_collection].remove({'_id': name, 'expire_at': expire_at})
+        return result['n'] == 1
+
+    def ensure_tasks_index(self):
+        self.db[self.tasks_collection].ensure_index('expire_at', expireAfterSeconds=0)
+
     def find_task(self, query):
         if isinstance(query, dict):
             return self.db[self.tasks_collection].find(query)
@@ -88,9 +220,21 @@ class MongoDBStorage(storage.MongoDBStorage):
     def find_instance_metadata(self, instance_name):
         return self.db[self.instance_metadata_collection].find_one({'_id': instance_name})
 
+    def find_instances_metadata(self, instance_names):
+        return self.db[self.instance_metadata_collection].find({'_id': {'$in': list(instance_names)}})
+
     def find_host_id(self, name):
         return self.db[self.hosts_collection].find_one({'dns_name': name})
 
+    def find_host_ids(self, names):
+        return self.db[self.hosts_collection].find({'dns_name': {'$in': list(names)}})
+
+    def find_hosts_by_group(self, groups):
+        return self.db[self.hosts_collection].find({'group': {'$in': list(groups)}})
+
+    def find_load_balancers(self, names):
+        return self.db[self.lb_collection].find({'_id': {'$in': list(names)}})
+
     def remove_instance_metadata(self, instance_name):
         self.db[self.instance_metadata_collection].remove({'_id': instance_name})
 
@@ -127,6 +271,10 @@ class MongoDBStorage(storage.MongoDBStorage):
             raise PlanNotFoundError()
         return self._plan_from_dict(plan_dict)
 
+    def find_plans(self, names):
+        plan_list = self.db[self.plans_collection].find({'_id': {'$in': list(names)}})
+        return [self._plan_from_dict(p) for p in plan_list]
+
     def list_plans(self):
         plan_list = self.db[self.plans_collection].find()
         return [self._plan_from_dict(p) for p in plan_list]
@@ -169,6 +317,9 @@ class MongoDBStorage(storage.MongoDBStorage):
     def find_binding(self, name):
         return self.db[self.bindings_collection].find_one({'_id': name})
 
+    def find_bindings(self, names):
+        return self.db[self.bindings_collection].find({'_id': {'$in': list(names)}})
+
     def replace_binding_path(self, name, path, destination=None, content=None):
         try:
             self.delete_binding_path(name, path)
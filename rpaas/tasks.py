@@ -2,14 +2,22 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import collections
+import contextlib
 import copy
 import datetime
+import hashlib
 import logging
 import os
+import random
+import socket
 import sys
+import threading
+import time
 from urlparse import urlparse
 
-from celery import Celery, Task
+from celery import Celery, Task, signals
+from kombu import Queue
 import hm.managers.cloudstack  # NOQA
 import hm.lb_managers.cloudstack  # NOQA
 import hm.lb_managers.networkapi_cloudstack  # NOQA
@@ -18,7 +26,8 @@ from hm import config
 from hm.model.host import Host
 from hm.model.load_balancer import LoadBalancer
 
-from rpaas import consul_manager, hc, nginx, ssl, ssl_plugins, storage, celery_sentinel
+from rpaas import (acme_scheduler, celery_sentinel, circuit_breaker, config_store, consul_manager, hc,
+                   lease, nginx, ssl, ssl_plugins, storage)
 
 possible_redis_envs = ['SENTINEL_ENDPOINT', 'DBAAS_SENTINEL_ENDPOINT', 'REDIS_ENDPOINT']
 
@@ -49,6 +58,7 @@ def setup_redis_url():
         options = {
             'service_name': path_parts[1],
             'password': url.password,
+            'read_from_slaves': os.environ.get('SENTINEL_READ_FROM_SLAVES') in ('True', 'true', '1'),
         }
         host_parts = url.netloc.split('@')
         servers = host_parts[len(host_parts) - 1].split(',')
@@ -65,6 +75,39 @@ def setup_redis_url():
     return env_val, {}
 
 
+QUEUES = ["provisioning", "healing", "certificates", "housekeeping"]
+
+ROUTES = {
+    "rpaas.tasks.NewInstanceTask": "provisioning",
+    "rpaas.tasks.RemoveInstanceTask": "provisioning",
+    "rpaas.tasks.ScaleInstanceTask": "provisioning",
+    "rpaas.tasks.RestoreMachineTask": "healing",
+    "rpaas.tasks.RestoreHostTask": "healing",
+    "rpaas.tasks.CheckMachineTask": "healing",
+    "rpaas.tasks.DownloadCertTask": "certificates",
+    "rpaas.tasks.RevokeCertTask": "certificates",
+    "rpaas.tasks.RenewCertsTask": "certificates",
+    "rpaas.tasks.RenewCertTask": "certificates",
+    "rpaas.tasks.CollectGarbageTask": "housekeeping",
+    "rpaas.tasks.ReconcileBindingsTask": "housekeeping",
+    "rpaas.tasks.BatchTask": "housekeeping",
+}
+
+
+def visibility_timeout(conf=None):
+    return int(config.get_config("BROKER_VISIBILITY_TIMEOUT", 3600, conf))
+
+
+def max_countdown(conf=None):
+    """
+    Returns the longest countdown a task can be scheduled with. The Redis
+    transport redelivers messages that are not acknowledged within the
+    visibility timeout, including ETA tasks still waiting for their time, so
+    longer waits must be split into shorter ones.
+    """
+    return int(visibility_timeout(conf) * 0.9)
+
+
 def initialize_celery():
     redis_url, broker_options = setup_redis_url()
     app = Celery('tasks', broker=redis_url, backend=redis_url)
@@ -72,8 +115,13 @@ def initialize_celery():
         CELERY_TASK_SERIALIZER='json',
         CELERY_RESULT_SERIALIZER='json',
         CELERY_ACCEPT_CONTENT=['json'],
-        BROKER_TRANSPORT_OPTIONS=broker_options,
+        BROKER_TRANSPORT_OPTIONS=dict(broker_options, visibility_timeout=visibility_timeout()),
         CELERY_SENTINEL_BACKEND_SETTINGS=broker_options,
+        CELERY_QUEUES=[Queue(name, routing_key=name) for name in QUEUES],
+        CELERY_DEFAULT_QUEUE="provisioning",
+        CELERY_ROUTES=dict((task, {"queue": queue, "routing_key": queue})
+                           for task, queue in ROUTES.iteritems()),
+        CELERYD_PREFETCH_MULTIPLIER=int(os.environ.get("CELERY_PREFETCH_MULTIPLIER", 4)),
     )
     ssl_plugins.register_plugins()
     return app
@@ -91,67 +139,274 @@ class TaskNotFoundError(Exception):
 
 
 class TaskManager(object):
+    """
+    TaskManager keeps the tasks collection entries that block operations on
+    an instance while an async task runs on it.
+
+    Workers running the task hold a LeaseLock on it (TASK_LOCK_PREFIX,
+    renewed for TASK_LOCK_TTL seconds at a time) and its fencing token is
+    stored in the entry, so the entry is only removed by its latest holder.
+
+    Entries carry their owner (the API or worker process that last took
+    them), the time of its last heartbeat and an expiration. Queued entries
+    expire TASK_QUEUE_TTL seconds after they're created, long enough for the
+    async task to wait in the queue. Once a worker takes them they expire
+    TASK_TTL seconds after its last heartbeat, and workers heartbeat along
+    with their lock. Expired entries were abandoned (e.g. by a worker that
+    died or never got the lock): they're taken over by the next operation on
+    the instance and removed by a TTL index, which is created once per
+    process and database.
+    """
+
+    _indexed = set()
+    _index_lock = threading.Lock()
 
     def __init__(self, config=None):
+        config = config or {}
         self.storage = storage.MongoDBStorage(config)
+        self.lock_prefix = config.get("TASK_LOCK_PREFIX", "task_lock")
+        self.lock_ttl = int(config.get("TASK_LOCK_TTL", 60))
+        self.ttl = int(config.get("TASK_TTL", 600))
+        self.queue_ttl = int(config.get("TASK_QUEUE_TTL", 3600))
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+        self._ensure_index()
+
+    def _ensure_index(self):
+        with self._index_lock:
+            if self.storage.db.name not in self._indexed:
+                self.storage.ensure_tasks_index()
+                self._indexed.add(self.storage.db.name)
 
     def ensure_ready(self, name):
-        task = self.storage.find_task(name)
-        if task.count() >= 1:
-            raise NotReadyError("Async task still running")
+        for task in self.storage.find_task(name):
+            if not self._abandoned(task):
+                raise NotReadyError("Async task still running")
+            if self.storage.remove_expired_task(name, task["expire_at"]):
+                logging.warning("task {} of {} expired at {}, taking it over".format(
+                    name, task.get("owner"), task["expire_at"]))
 
     def remove(self, name):
-        try:
-            self.ensure_ready(name)
-        except NotReadyError:
-            self.storage.remove_task(name)
-        else:
+        if self.storage.find_task(name).count() == 0:
             raise TaskNotFoundError("Task {} not found for removal".format(name))
+        self.storage.remove_task(name)
+
+    def create(self, name, expires=True):
+        """
+        Creates the entry of the task, expiring TASK_QUEUE_TTL seconds later
+        unless a worker takes it (see lock). Entries created with
+        expires=False, like restore tasks, never expire.
+        """
+        task = dict(name) if isinstance(name, dict) else {"_id": name}
+        if expires:
+            now = datetime.datetime.utcnow()
+            task.update({"owner": self.owner, "heartbeat": now,
+                         "expire_at": now + datetime.timedelta(seconds=self.queue_ttl)})
+        self.storage.store_task(task)
 
-    def create(self, name):
-        self.storage.store_task(name)
+    def heartbeat(self, name, fence=None, ttl=None):
+        expire_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl or self.ttl)
+        return self.storage.heartbeat_task(name, expire_at, fence, owner=self.owner)
 
     def update(self, name, task_id):
         self.storage.update_task(name, task_id)
 
+    def update_target(self, name, quantity):
+        return self.storage.update_task_target(name, quantity)
+
+    def lock(self, name, conn, task_id=None):
+        """
+        Acquires the lock of the task of the instance for the async task
+        task_id, storing its fencing token in the task and heartbeating it
+        while the lock is held. Returns None when another worker holds it or
+        the task was taken over by another async task.
+        """
+        task_lock = lease.LeaseLock(conn, "{}:{}".format(self.lock_prefix, name), self.lock_ttl)
+        fence = task_lock.acquire()
+        if fence is None:
+            return None
+        now = datetime.datetime.utcnow()
+        if not self.storage.fence_task(name, fence, task_id, owner=self.owner, heartbeat=now,
+                                       expire_at=now + datetime.timedelta(seconds=self.ttl)):
+            task_lock.release()
+            return None
+        task_lock.renewed = lambda: self.heartbeat(name, fence)
+        return task_lock
+
+    def _abandoned(self, task):
+        expire_at = task.get("expire_at")
+        return expire_at is not None and expire_at < datetime.datetime.utcnow()
+
+
+class ResourceCache(object):
+    """
+    LRU cache of the collaborators built by BaseManagerTask.init_config,
+    keyed by config fingerprint.
+
+    It is only enabled in worker processes, so each worker process builds
+    its managers, storage and Mongo connections once per config.
+    """
+
+    def __init__(self, size=32):
+        self.size = size
+        self.enabled = False
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def reset(self):
+        with self.lock:
+            self.items.clear()
+
+
+resource_cache = ResourceCache(int(os.environ.get("RPAAS_WORKER_CACHE_SIZE", 32)))
+
+
+@signals.worker_init.connect
+def enable_resource_cache(**kwargs):
+    resource_cache.enabled = True
+
+
+@signals.worker_process_init.connect
+def reset_resource_cache(**kwargs):
+    resource_cache.reset()
+    config_store.reset()
+
+
+def add_host_tags(config, service_name, instance_name, consul_token):
+    """
+    Sets HOST_TAGS in config, tagging the hosts created with it as hosts of
+    the instance, along with INSTANCE_EXTRA_TAGS.
+    """
+    tags = ["rpaas_service:" + service_name,
+            "rpaas_instance:" + instance_name,
+            "consul_token:" + consul_token]
+    extra_tags = config.get("INSTANCE_EXTRA_TAGS", "")
+    if extra_tags:
+        del config["INSTANCE_EXTRA_TAGS"]
+        tags.append(extra_tags)
+    config["HOST_TAGS"] = ",".join(tags)
+
 
 class BaseManagerTask(Task):
     ignore_result = True
     store_errors_even_if_ignored = True
 
     def init_config(self, config=None):
+        config = config_store.resolve(config)
         self.config = config
-        self.nginx_manager = nginx.Nginx(config)
-        self.consul_manager = consul_manager.ConsulManager(config)
-        self.host_manager_name = self._get_conf("HOST_MANAGER", "cloudstack")
-        self.lb_manager_name = self._get_conf("LB_MANAGER", "networkapi_cloudstack")
-        self.task_manager = TaskManager(config)
         self.redis_client = app.backend.client
-        self.hc = hc.Dumb()
-        self.storage = storage.MongoDBStorage(config)
+        self.task_lock = None
+        resources = None
+        if resource_cache.enabled:
+            fingerprint = config_store.version(config)
+            resources = resource_cache.get(fingerprint)
+            if resources is None:
+                resources = self._build_resources(config)
+                resource_cache.set(fingerprint, resources)
+        else:
+            resources = self._build_resources(config)
+        self.__dict__.update(resources)
+
+    def _build_resources(self, config):
+        resources = {
+            "nginx_manager": nginx.Nginx(config),
+            "consul_manager": consul_manager.ConsulManager(config),
+            "host_manager_name": self._get_conf("HOST_MANAGER", "cloudstack"),
+            "lb_manager_name": self._get_conf("LB_MANAGER", "networkapi_cloudstack"),
+            "task_manager": TaskManager(config),
+            "hc": hc.Dumb(),
+            "storage": storage.MongoDBStorage(config),
+        }
         hc_url = self._get_conf("HCAPI_URL", None)
         if hc_url:
-            self.hc = hc.HCAPI(self.storage,
-                               url=hc_url,
-                               user=self._get_conf("HCAPI_USER"),
-                               password=self._get_conf("HCAPI_PASSWORD"),
-                               hc_format=self._get_conf("HCAPI_FORMAT", "http://{}:8080/"))
+            resources["hc"] = hc.HCAPI(resources["storage"],
+                                       url=hc_url,
+                                       user=self._get_conf("HCAPI_USER"),
+                                       password=self._get_conf("HCAPI_PASSWORD"),
+                                       hc_format=self._get_conf("HCAPI_FORMAT", "http://{}:8080/"))
+        return resources
 
     def _get_conf(self, key, default=config.undefined):
         return config.get_config(key, default, self.config)
 
-    def _add_host(self, name, lb=None):
+    def _start_progress(self, name, operation):
+        metadata = self.storage.find_instance_metadata(name) or {}
+        self.storage.update_task(name, {"operation": operation,
+                                        "plan_name": metadata.get("plan_name"),
+                                        "host_manager": self.host_manager_name,
+                                        "started": datetime.datetime.utcnow()})
+
+    @contextlib.contextmanager
+    def _locked(self, name):
+        task_lock = self.task_manager.lock(name, self.redis_client, self.request.id)
+        if task_lock is None:
+            raise NotReadyError("Async task of {} running on another worker".format(name))
+        self.task_lock = task_lock
+        try:
+            yield task_lock
+        finally:
+            self.task_lock = None
+            task_lock.release()
+
+    def _finish_task(self, name):
+        query = {"_id": name}
+        if self.task_lock is not None:
+            query["fence"] = self.task_lock.fence
+        self.storage.remove_task(query)
+
+    @contextlib.contextmanager
+    def _step(self, name, step, **data):
+        if self.task_lock is not None and not self.task_lock.held:
+            raise NotReadyError("Lost the lock of the async task of {}".format(name))
+        event = dict(data, step=step, start=datetime.datetime.utcnow())
+        try:
+            yield event
+            event["status"] = "success"
+        except Exception:
+            event["status"] = "failure"
+            raise
+        finally:
+            event["end"] = datetime.datetime.utcnow()
+            event["duration"] = (event["end"] - event["start"]).total_seconds()
+            logging.info("{} step {} {} in {}s: {}".format(name, step, event["status"],
+                                                           event["duration"], data))
+            try:
+                self.storage.add_task_step(name, event)
+            except Exception as e:
+                logging.error("Error storing step {} of {}: {}".format(step, name, e))
+
+    def _add_host(self, name, lb=None, finish_task=True):
         healthcheck_timeout = int(self._get_conf("RPAAS_HEALTHCHECK_TIMEOUT", 600))
-        host = Host.create(self.host_manager_name, name, self.config)
+        with self._step(name, "vm_created", host_manager=self.host_manager_name) as step:
+            host = Host.create(self.host_manager_name, name, self.config)
+            step["host"] = host.dns_name
         created_lb = None
         try:
             if not lb:
-                lb = created_lb = LoadBalancer.create(self.lb_manager_name, name, self.config)
-                self.hc.create(name)
-            lb.add_host(host)
-            self.nginx_manager.wait_healthcheck(host.dns_name, timeout=healthcheck_timeout)
-            self.hc.add_url(name, host.dns_name)
-            self.storage.remove_task(name)
+                with self._step(name, "lb_created", lb_manager=self.lb_manager_name):
+                    lb = created_lb = LoadBalancer.create(self.lb_manager_name, name, self.config)
+                    self.hc.create(name)
+            with self._step(name, "added_to_lb", host=host.dns_name):
+                lb.add_host(host)
+            with self._step(name, "healthy", host=host.dns_name):
+                self.nginx_manager.wait_healthcheck(host.dns_name, timeout=healthcheck_timeout)
+            with self._step(name, "hc_registered", host=host.dns_name):
+                self.hc.add_url(name, host.dns_name)
+            if finish_task:
+                self._finish_task(name)
         except:
             exc_info = sys.exc_info()
             rollback = self._get_conf("RPAAS_ROLLBACK_ON_ERROR", "0") in ("True", "true", "1")
@@ -175,25 +430,32 @@ class BaseManagerTask(Task):
             except Exception as e:
                 logging.error("Error in rollback trying to remove healthcheck: {}".format(e))
             raise exc_info[0], exc_info[1], exc_info[2]
+        return host
 
-    def _delete_host(self, name, host, lb=None):
+    def _delete_host(self, name, host, lb=None, finish_task=True):
         try:
             node_name = self.consul_manager.node_hostname(host.dns_name)
-            host.destroy()
+            with self._step(name, "vm_destroyed", host=host.dns_name):
+                host.destroy()
             if lb is not None:
-                lb.remove_host(host)
+                with self._step(name, "removed_from_lb", host=host.dns_name):
+                    lb.remove_host(host)
             if node_name is not None:
                 self.consul_manager.remove_node(name, node_name)
-            self.hc.remove_url(name, host.dns_name)
+            with self._step(name, "hc_unregistered", host=host.dns_name):
+                self.hc.remove_url(name, host.dns_name)
         finally:
-            self.storage.remove_task(name)
+            if finish_task:
+                self._finish_task(name)
 
 
 class NewInstanceTask(BaseManagerTask):
 
     def run(self, config, name):
         self.init_config(config)
-        self._add_host(name)
+        with self._locked(name):
+            self._start_progress(name, "new_instance")
+            self._add_host(name)
 
 
 class RemoveInstanceTask(BaseManagerTask):
@@ -210,68 +472,135 @@ class RemoveInstanceTask(BaseManagerTask):
 
 
 class ScaleInstanceTask(BaseManagerTask):
+    """
+    ScaleInstanceTask converges the number of hosts of an instance to the
+    desired quantity stored in its task document.
+
+    The desired quantity is read again after each host is added or removed,
+    so scale requests made while the task is running only change its
+    target. The task document is removed once the instance reaches the
+    latest target.
+    """
 
     def run(self, config, name, quantity):
         try:
             self.init_config(config)
-            lb = LoadBalancer.find(name, self.config)
-            if lb is None:
-                raise storage.InstanceNotFoundError()
-            diff = quantity - len(lb.hosts)
-            if diff == 0:
-                return
-            for i in xrange(abs(diff)):
-                if diff > 0:
-                    self._add_host(name, lb=lb)
-                else:
-                    self._delete_host(name, lb.hosts[i], lb)
-        finally:
+        except:
             self.storage.remove_task(name)
+            raise
+        with self._locked(name):
+            try:
+                lb = LoadBalancer.find(name, self.config)
+                if lb is None:
+                    raise storage.InstanceNotFoundError()
+                self._start_progress(name, "scale")
+                current = len(lb.hosts)
+                deleted = []
+                target = quantity
+                while True:
+                    desired = self._desired_quantity(name)
+                    if desired is not None:
+                        target = desired
+                    if current == target:
+                        if self.storage.remove_task_target(name, desired) or desired is None:
+                            return
+                        continue
+                    if current < target:
+                        self._add_host(name, lb=lb, finish_task=False)
+                        current += 1
+                    else:
+                        host = [h for h in lb.hosts if h not in deleted][0]
+                        deleted.append(host)
+                        self._delete_host(name, host, lb, finish_task=False)
+                        current -= 1
+            except:
+                self._finish_task(name)
+                raise
+
+    def _desired_quantity(self, name):
+        for task in self.storage.find_task(name):
+            return task.get("desired_quantity")
+        return None
 
 
 class RestoreMachineTask(BaseManagerTask):
+    """
+    RestoreMachineTask dispatches due restore tasks. Each machine is
+    restored by its own RestoreHostTask, holding a lease on the machine
+    while it runs, so machines are restored in parallel within the limits
+    of RestoreLeases.
+
+    Due machines are admitted by priority: machines of the instances with
+    the largest share of failing machines first, then the oldest failures.
+    Nothing is admitted while the healing CircuitBreaker is open.
+
+    Only one dispatcher runs at a time, holding the RESTORE_LOCK_NAME
+    LeaseLock. Its fencing token is stored in the restore tasks it
+    dispatches, so a dispatcher that lost the lock can't dispatch a task
+    again after a newer one did.
+    """
 
     def run(self, config):
         self.init_config(config)
         lock_name = self.config.get("RESTORE_LOCK_NAME", "restore_lock")
-        healthcheck_timeout = int(self._get_conf("RPAAS_HEALTHCHECK_TIMEOUT", 600))
         restore_delay = int(self.config.get("RESTORE_MACHINE_DELAY", 5))
         created_in = datetime.datetime.utcnow() - datetime.timedelta(minutes=restore_delay)
         restore_query = {"_id": {"$regex": "restore_.+"}, "created": {"$lte": created_in}}
-        if self._redis_lock(lock_name, timeout=(healthcheck_timeout + 60)):
-            for task in self.storage.find_task(restore_query):
-                try:
-                    start_time = datetime.datetime.utcnow()
-                    self._restore_machine(task, config, healthcheck_timeout)
-                    elapsed_time = datetime.datetime.utcnow() - start_time
-                    self._redis_extend_lock(extra_time=elapsed_time.seconds)
-                except Exception as e:
-                    self.storage.update_task(task['_id'], {"last_attempt": datetime.datetime.utcnow()})
-                    self._redis_unlock()
-                    raise e
-            self._redis_unlock()
+        restore_lock = lease.LeaseLock(self.redis_client, lock_name,
+                                       int(self.config.get("RESTORE_LOCK_TTL", 60)))
+        if restore_lock.acquire() is not None:
+            try:
+                breaker = circuit_breaker.CircuitBreaker(self.redis_client, self.config)
+                leases = lease.RestoreLeases(self.redis_client, self.config)
+                failure_instances = self._failure_instances()
+                restore_tasks = [task for task in self.storage.find_task(restore_query)
+                                 if task['instance'] not in failure_instances]
+                hosts = dict((host['dns_name'], host)
+                             for host in self.storage.find_host_ids([task['host'] for task in restore_tasks]))
+                for task in self._prioritize(restore_tasks):
+                    if not restore_lock.held:
+                        logging.warning("restore_machine: lost the restore lock, stopping")
+                        break
+                    if not breaker.allow():
+                        logging.warning("restore_machine: circuit breaker is open, healing paused")
+                        break
+                    zone = self._host_zone(hosts.get(task['host']))
+                    token = leases.acquire(task['host'], task['instance'], zone)
+                    if token is None:
+                        continue
+                    if self.storage.fence_task(task['_id'], restore_lock.fence):
+                        RestoreHostTask().delay(config, task['_id'], token, zone, restore_lock.fence)
+                    else:
+                        leases.release(task['host'], task['instance'], token, zone)
+            finally:
+                restore_lock.release()
+
+    def _prioritize(self, restore_tasks):
+        instances = set(task['instance'] for task in restore_tasks)
+        if not instances:
+            return []
+        failing = collections.Counter(task['instance'] for task in self.storage.find_task(
+            {"_id": {"$regex": "restore_.+"}, "instance": {"$in": list(instances)}}))
+        sizes = collections.Counter(host['group'] for host in self.storage.find_hosts_by_group(instances))
+
+        def priority(task):
+            instance = task['instance']
+            return (-failing[instance] / float(max(sizes[instance], 1)), task['created'])
+        return sorted(restore_tasks, key=priority)
+
+    def _host_zone(self, host):
+        if host is None:
+            return None
+        alternative_id = host.get('alternative_id', 0)
+        zone = self.config.get("CLOUDSTACK_ZONE_ID_{}".format(alternative_id),
+                               self.config.get("CLOUDSTACK_ZONE_ID", alternative_id))
+        return "{}:{}".format(host.get('manager'), zone)
 
-    def _restore_machine(self, task, config, healthcheck_timeout):
+    def _failure_instances(self, instance=None):
         retry_failure_delay = int(self.config.get("RESTORE_MACHINE_FAILURE_DELAY", 5))
-        restore_dry_mode = self.config.get("RESTORE_MACHINE_DRY_MODE", False) in ("True", "true", "1")
         retry_failure_query = {"_id": {"$regex": "restore_.+"}, "last_attempt": {"$ne": None}}
-        if task['instance'] not in self._failure_instances(retry_failure_query, retry_failure_delay):
-            host = self.storage.find_host_id(task['host'])
-            if not restore_dry_mode:
-                healing_id = self.storage.store_healing(task['instance'], task['host'])
-                try:
-                    Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
-                                    "manager": host['manager']}, conf=config).restore()
-                    Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
-                                    "manager": host['manager']}, conf=config).start()
-                    self.nginx_manager.wait_healthcheck(task['host'], timeout=healthcheck_timeout)
-                    self.storage.update_healing(healing_id, "success")
-                except Exception as e:
-                    self.storage.update_healing(healing_id, str(e.message))
-                    raise e
-            self.storage.remove_task({"_id": task['_id']})
-
-    def _failure_instances(self, retry_failure_query, retry_failure_delay):
+        if instance is not None:
+            retry_failure_query["instance"] = instance
         failure_instances = set()
         for task in self.storage.find_task(retry_failure_query):
             retry_failure = task['last_attempt'] + datetime.timedelta(minutes=retry_failure_delay)
@@ -279,67 +608,467 @@ class RestoreMachineTask(BaseManagerTask):
                 failure_instances.add(task['instance'])
         return failure_instances
 
-    def _redis_lock(self, lock_name, timeout):
-        self.redis_lock = self.redis_client.lock(name=lock_name, timeout=timeout,
-                                                 blocking_timeout=1)
-        return self.redis_lock.acquire(blocking=False)
 
-    def _redis_unlock(self):
-        self.redis_lock.release()
+class RestoreHostTask(RestoreMachineTask):
+    """
+    RestoreHostTask restores one machine, renewing its lease with heartbeats
+    until the machine is healthy or the restore fails.
 
-    def _redis_extend_lock(self, extra_time):
-        self.redis_lock.extend(extra_time)
+    The restore is aborted, without counting as a failure, when the lease
+    expired while the task was queued, when a heartbeat fails to renew it
+    or when the restore task was dispatched again with a newer fence. The
+    lease and the fence are checked before every action on the machine.
+    Replacements of machines of instances running another operation (e.g.
+    a scale) are postponed to the next pass, also without counting as a
+    failure.
+
+    RESTORE_MACHINE_POLICY chooses how the machine is healed: "restore"
+    (the default) restores and restarts the same VM, "replace" adds a new
+    host to the instance and destroys the broken one instead, and
+    "restore_then_replace" replaces the machine when restoring it fails or
+    it isn't healthy within RESTORE_MACHINE_RESTORE_TIMEOUT seconds. The
+    path taken is stored in the healing record.
+    """
+
+    def run(self, config, task_id, token, zone=None, fence=None):
+        self.init_config(config)
+        healthcheck_timeout = int(self._get_conf("RPAAS_HEALTHCHECK_TIMEOUT", 600))
+        task = None
+        for task in self.storage.find_task(task_id):
+            break
+        if task is None:
+            return
+        leases = lease.RestoreLeases(self.redis_client, self.config)
+        if not leases.renew(task['host'], task['instance'], token, zone):
+            logging.warning("restore_machine: lease of {} expired while queued, "
+                            "skipping".format(task['host']))
+            return
+        heartbeat = leases.heartbeat(task['host'], task['instance'], token, zone)
+
+        def check_lease():
+            if not heartbeat.is_alive() or not self._fenced(task_id, fence):
+                raise lease.LeaseLostError("lost the restore lease of {}".format(task['host']))
+        try:
+            if task['instance'] not in self._failure_instances(task['instance']):
+                self._restore_machine(task, self.config, healthcheck_timeout, check_lease)
+        except lease.LeaseLostError as e:
+            logging.warning("restore_machine: {}, aborting".format(e))
+        except NotReadyError as e:
+            logging.warning("restore_machine: instance {} is busy, postponing the restore of {}: {}".format(
+                task['instance'], task['host'], e))
+        except Exception:
+            self.storage.update_task(task['_id'], {"last_attempt": datetime.datetime.utcnow()})
+            raise
+        finally:
+            heartbeat.stop()
+            leases.release(task['host'], task['instance'], token, zone)
+
+    def _fenced(self, task_id, fence):
+        if fence is None:
+            return True
+        for task in self.storage.find_task(task_id):
+            return task.get('fence') == fence
+        return False
+
+    def _restore_machine(self, task, config, healthcheck_timeout, check_lease=lambda: None):
+        restore_dry_mode = self.config.get("RESTORE_MACHINE_DRY_MODE", False) in ("True", "true", "1")
+        policy = self.config.get("RESTORE_MACHINE_POLICY", "restore")
+        host = self.storage.find_host_id(task['host'])
+        if not restore_dry_mode:
+            check_lease()
+            breaker = circuit_breaker.CircuitBreaker(self.redis_client, self.config)
+            healing_id = self.storage.store_healing(task['instance'], task['host'])
+            path = "replace" if policy == "replace" else "restore"
+            fields = {}
+            try:
+                if path == "restore":
+                    if policy == "restore_then_replace":
+                        healthcheck_timeout = int(self.config.get("RESTORE_MACHINE_RESTORE_TIMEOUT",
+                                                                  healthcheck_timeout))
+                    try:
+                        Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
+                                        "manager": host['manager']}, conf=config).restore()
+                        check_lease()
+                        Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
+                                        "manager": host['manager']}, conf=config).start()
+                        self.nginx_manager.wait_healthcheck(task['host'], timeout=healthcheck_timeout)
+                    except lease.LeaseLostError:
+                        raise
+                    except Exception as e:
+                        if policy != "restore_then_replace":
+                            raise
+                        logging.error("restore_machine: error restoring {}, replacing it: {}".format(
+                            task['host'], e))
+                        path = "restore_then_replace"
+                        fields["restore_error"] = str(e)
+                if path != "restore":
+                    check_lease()
+                    fields["replacement"] = self._replace_machine(task, host, config)
+                self.storage.update_healing(healing_id, "success", path=path, **fields)
+            except lease.LeaseLostError as e:
+                self.storage.update_healing(healing_id, "aborted: {}".format(e), path=path, **fields)
+                raise
+            except NotReadyError as e:
+                self.storage.update_healing(healing_id, "postponed: {}".format(e), path=path, **fields)
+                raise
+            except Exception as e:
+                self.storage.update_healing(healing_id, str(e.message), path=path, **fields)
+                breaker.record(False)
+                raise e
+            breaker.record(True)
+        self.storage.remove_task({"_id": task['_id']})
+
+    def _replace_machine(self, task, host, config):
+        """
+        Adds a new host to the instance of task, then destroys its broken
+        host, returning the address of the new one.
+
+        The new host is created with the config of the instance (its plan
+        and host tags) while holding the task of the instance, so no other
+        operation changes its hosts meanwhile.
+        """
+        name = task['instance']
+        instance_config = self._instance_config(name)
+        self.task_manager.ensure_ready(name)
+        try:
+            self.task_manager.create({"_id": name, "task_id": self.request.id})
+        except storage.DuplicateError:
+            raise NotReadyError("Async task still running")
+        restore_config = self.config
+        self.config = instance_config
+        try:
+            with self._locked(name):
+                try:
+                    lb = LoadBalancer.find(name, instance_config)
+                    if lb is None:
+                        raise storage.InstanceNotFoundError()
+                    replacement = self._add_host(name, lb, finish_task=False)
+                    self._delete_host(name, Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
+                                                            "manager": host['manager']}, conf=config),
+                                      lb, finish_task=False)
+                    return replacement.dns_name
+                finally:
+                    self._finish_task(name)
+        except NotReadyError:
+            self.storage.remove_task({"_id": name, "task_id": self.request.id, "fence": {"$exists": False}})
+            raise
+        finally:
+            self.config = restore_config
+
+    def _instance_config(self, name):
+        config = copy.deepcopy(self.config)
+        metadata = self.storage.find_instance_metadata(name) or {}
+        if "consul_token" not in metadata:
+            metadata["consul_token"] = self.consul_manager.generate_token(name)
+            self.storage.store_instance_metadata(name, **metadata)
+        if "plan_name" in metadata:
+            plan = self.storage.find_plan(metadata["plan_name"])
+            config.update(plan.config or {})
+        add_host_tags(config, self.consul_manager.service_name, name, metadata["consul_token"])
+        return config
 
 
 class CheckMachineTask(BaseManagerTask):
+    """
+    CheckMachineTask creates restore tasks for machines failing on Consul and
+    removes them for machines that recovered.
 
-    def run(self, config):
+    It may receive only the machines whose state changed, as a mapping of
+    failing addresses to instance names and a list of recovered addresses.
+    When called without them it checks every machine of the service.
+    """
+
+    def run(self, config, failing=None, recovered=None):
         self.init_config(config)
-        for node in self.consul_manager.service_healthcheck():
-            node_fail = False
-            address = node['Node']['Address']
-            if not self._check_machine_exists(address):
+        if failing is None and recovered is None:
+            failing, recovered = self._check_all_machines()
+        failing = failing or {}
+        existing_machines = self._existing_machines(failing.keys())
+        restore_machines = {}
+        for address, service_instance in failing.iteritems():
+            if address not in existing_machines:
                 logging.error("check_machine: machine {} not found".format(address))
                 continue
-            service_instance = self.config['RPAAS_SERVICE_NAME']
-            for tag in node['Service']['Tags']:
-                if self.config['RPAAS_SERVICE_NAME'] in tag:
-                    continue
-                service_instance = tag
+            restore_machines[address] = service_instance
+        if restore_machines:
+            self.storage.store_restore_tasks(restore_machines)
+        if recovered:
+            self.storage.remove_restore_tasks(recovered)
+
+    def _check_all_machines(self):
+        failing = {}
+        recovered = []
+        for node in self.consul_manager.service_healthcheck():
+            address = node['Node']['Address']
+            node_fail = False
             for check in node['Checks']:
                 if check['Status'] != 'passing':
                     node_fail = True
                     break
-            task_name = "restore_{}".format(address)
             if node_fail:
-                try:
-                    self.task_manager.ensure_ready(task_name)
-                    self.task_manager.create({"_id": task_name, "host": address,
-                                              "instance": service_instance,
-                                              "created": datetime.datetime.utcnow()})
-                except:
-                    pass
+                failing[address] = self.consul_manager.instance_from_tags(node['Service']['Tags'])
             else:
+                recovered.append(address)
+        return failing, recovered
+
+    def _existing_machines(self, addresses):
+        if not addresses:
+            return set()
+        return set(host['dns_name'] for host in self.storage.find_host_ids(addresses))
+
+
+class CollectGarbageTask(BaseManagerTask):
+    """
+    CollectGarbageTask removes resources left behind by instances that no
+    longer exist, usually after partial failures removing them.
+
+    Each backend is listed in bulk and diffed against the live instances,
+    read from the metadata, quota and tasks collections. The live instances
+    are read after the backends, and again right before each batch is
+    removed, so resources of an instance created meanwhile are never taken
+    for orphans. Orphans are removed in batches of GC_BATCH_SIZE items,
+    sleeping GC_BATCH_INTERVAL seconds between batches. In dry run mode
+    orphans are only reported.
+    """
+
+    def run(self, config, dry_run=None):
+        self.init_config(config)
+        if dry_run is None:
+            dry_run = self._get_conf("GC_DRY_RUN", "0") in ("True", "true", "1")
+        self.batch_size = int(self._get_conf("GC_BATCH_SIZE", 20))
+        self.batch_interval = float(self._get_conf("GC_BATCH_INTERVAL", 1))
+        report = {"start_time": datetime.datetime.utcnow(), "dry_run": dry_run}
+        report_id = self.storage.store_gc_report(report)
+        try:
+            orphans = self._find_orphans()
+            removed = {}
+            if not dry_run:
+                removed = self._remove_orphans(orphans)
+            self.storage.update_gc_report(report_id, {
+                "orphans": dict((kind, sorted(items)) for kind, items in orphans.iteritems()),
+                "removed": removed,
+                "status": "success",
+                "end_time": datetime.datetime.utcnow(),
+            })
+        except Exception as e:
+            self.storage.update_gc_report(report_id, {"status": str(e),
+                                                      "end_time": datetime.datetime.utcnow()})
+            raise
+
+    def _find_orphans(self):
+        storage = self.storage
+        found = {
+            "bindings": storage.instance_names(storage.bindings_collection),
+            "le_certificates": storage.instance_names(storage.le_certificates_collection),
+            "restore_tasks": storage.instance_names(storage.tasks_collection, "instance",
+                                                    {"host": {"$exists": True}}),
+            "hcs": storage.instance_names(storage.hcs_collections),
+            "load_balancers": storage.instance_names(storage.lb_collection),
+            "hosts": storage.instance_names(storage.hosts_collection, "group"),
+            "consul_instances": self.consul_manager.list_instances(),
+        }
+        tokens = self.consul_manager.list_tokens()
+        service_nodes = self.consul_manager.service_nodes()
+        live = storage.find_live_instances()
+        orphans = dict((kind, names - live) for kind, names in found.iteritems())
+        orphans["consul_tokens"] = set(name for name in tokens if name not in live)
+        self.orphan_tokens = dict((name, tokens[name]) for name in orphans["consul_tokens"])
+        orphans["consul_nodes"] = set(node for node, data in service_nodes.iteritems()
+                                      if data["instance"] not in live and
+                                      data["instance"] != self.consul_manager.service_name)
+        self.orphan_nodes = dict((node, service_nodes[node]["instance"])
+                                 for node in orphans["consul_nodes"])
+        return orphans
+
+    def _remove_orphans(self, orphans):
+        storage = self.storage
+        removed = {}
+        for kind, collection in (("bindings", storage.bindings_collection),
+                                 ("le_certificates", storage.le_certificates_collection)):
+            removed[kind] = self._remove_in_batches(
+                orphans[kind], lambda batch, coll=collection: storage.remove_instances_data(coll, batch))
+        removed["restore_tasks"] = self._remove_in_batches(
+            orphans["restore_tasks"],
+            lambda batch: storage.remove_instances_data(storage.tasks_collection, batch, "instance",
+                                                        {"host": {"$exists": True}}))
+        removed["hosts"] = self._remove_in_batches(orphans["hosts"], self._destroy_hosts)
+        removed["load_balancers"] = self._remove_in_batches(orphans["load_balancers"],
+                                                            self._destroy_load_balancers)
+        removed["hcs"] = self._remove_in_batches(orphans["hcs"], self._each(self.hc.destroy))
+        removed["consul_nodes"] = self._remove_in_batches(
+            orphans["consul_nodes"],
+            self._each(lambda node: self.consul_manager.remove_node(self.orphan_nodes[node], node)),
+            instance=self.orphan_nodes.get)
+        removed["consul_tokens"] = self._remove_in_batches(
+            orphans["consul_tokens"],
+            self._each(lambda name: self.consul_manager.destroy_token(self.orphan_tokens[name])))
+        removed["consul_instances"] = self._remove_in_batches(
+            orphans["consul_instances"], self._each(self.consul_manager.destroy_instance))
+        return removed
+
+    def _remove_in_batches(self, items, remove_batch, instance=lambda item: item):
+        items = sorted(items)
+        removed = 0
+        for start in xrange(0, len(items), self.batch_size):
+            if start > 0 and self.batch_interval > 0:
+                time.sleep(self.batch_interval)
+            live = self.storage.find_live_instances()
+            batch = [item for item in items[start:start + self.batch_size] if instance(item) not in live]
+            if not batch:
+                continue
+            try:
+                count = remove_batch(batch)
+                removed += len(batch) if count is None else count
+            except Exception as e:
+                logging.error("gc: error removing {}: {}".format(batch, e))
+        return removed
+
+    def _each(self, remove):
+        def remove_batch(batch):
+            removed = 0
+            for item in batch:
                 try:
-                    self.task_manager.remove(task_name)
-                except:
-                    pass
+                    remove(item)
+                    removed += 1
+                except Exception as e:
+                    logging.error("gc: error removing {}: {}".format(item, e))
+            return removed
+        return remove_batch
+
+    def _destroy_hosts(self, groups):
+        hosts = list(self.storage.find_hosts_by_group(groups))
+        return self._each(lambda host: Host.from_dict(host, conf=self.config).destroy())(hosts)
+
+    def _destroy_load_balancers(self, names):
+        lbs = list(self.storage.find_load_balancers(names))
+        return self._each(lambda lb: LoadBalancer.from_dict(lb, conf=self.config).destroy())(lbs)
+
+
+class ReconcileBindingsTask(BaseManagerTask):
+    """
+    ReconcileBindingsTask repairs drift between the bindings stored on Mongo
+    and the locations and certificates stored on Consul.
+
+    When called without instance names it splits all bound instances in
+    batches of RECONCILE_BATCH_SIZE and adds one task per batch to the
+    queue. Each batch reads its bindings with a single query and each
+    instance with a single recursive KV read, and only keys whose content
+    differ are written. Certificates of instances using LE are managed on
+    Consul only, so they are left untouched.
+
+    Instances with a running task are skipped. Before repairing, the binding
+    and the Consul entries are read again, and only the keys that still
+    differ the same way are repaired, so routes changed by the API between
+    the two reads aren't reverted. Expected contents are generated from the
+    current location template, so changing it rewrites every instance.
+    """
+
+    def run(self, config, names=None):
+        self.init_config(config)
+        if names is None:
+            names = sorted(self.storage.instance_names(self.storage.bindings_collection))
+            batch_size = int(self._get_conf("RECONCILE_BATCH_SIZE", 100))
+            for start in xrange(0, len(names), batch_size):
+                ReconcileBindingsTask().delay(config, names[start:start + batch_size])
+            return
+        le_instances = self.storage.instance_names(self.storage.le_certificates_collection,
+                                                   query={"_id": {"$in": names}})
+        busy_instances = self.storage.instance_names(self.storage.tasks_collection,
+                                                     query={"_id": {"$in": names}})
+        for binding in self.storage.find_bindings(names):
+            name = binding["_id"]
+            if name in busy_instances:
+                logging.info("reconcile: skipping {}, it has a running task".format(name))
+                continue
+            try:
+                self._reconcile(name, binding, name not in le_instances)
+            except Exception as e:
+                logging.error("reconcile: error reconciling {}: {}".format(name, e))
+
+    def _reconcile(self, name, binding, with_certificate):
+        expected, current = self._entries(name, binding, with_certificate)
+        if self._digest(expected) == self._digest(current):
+            return
+        binding = self.storage.find_binding(name)
+        if binding is None:
+            return
+        rechecked_expected, rechecked_current = self._entries(name, binding, with_certificate)
+        for key, value in expected.iteritems():
+            value = self._encode(value)
+            if self._encode(current.get(key)) == value or \
+               self._encode(rechecked_expected.get(key)) != value or \
+               self._encode(rechecked_current.get(key)) != self._encode(current.get(key)):
+                continue
+            logging.warning("reconcile: writing {}".format(key))
+            self.consul_manager.put_key(key, expected[key])
+        for key in current:
+            if key in expected or key in rechecked_expected or key not in rechecked_current:
+                continue
+            logging.warning("reconcile: removing {}".format(key))
+            self.consul_manager.delete_key(key)
 
-    def _check_machine_exists(self, address):
-        machine_data = self.storage.find_host_id(address)
-        if machine_data is None:
-            return False
-        return True
+    def _entries(self, name, binding, with_certificate):
+        expected = self.consul_manager.binding_entries(name, binding, with_certificate)
+        current = self.consul_manager.instance_entries(name)
+        if not (with_certificate and binding.get("cert") and binding.get("key")):
+            current = dict((key, value) for key, value in current.iteritems()
+                           if self.consul_manager.is_location_key(name, key))
+        return expected, current
+
+    def _digest(self, entries):
+        digest = hashlib.sha1()
+        for key in sorted(entries):
+            digest.update(self._encode(key))
+            digest.update("\0")
+            digest.update(self._encode(entries[key]) or "")
+            digest.update("\0")
+        return digest.hexdigest()
+
+    def _encode(self, value):
+        if isinstance(value, unicode):
+            return value.encode("utf-8")
+        return value
 
 
 class DownloadCertTask(BaseManagerTask):
+    """
+    DownloadCertTask issues the certificate of domain, deferring itself
+    while the ACME rate limits don't allow it. The task entry of the
+    instance, created by the manager for this task, is kept alive while
+    deferred and removed once it's done.
+    """
+
+    owns_task_entry = True
 
     def run(self, config, name, plugin, csr, key, domain):
+        deferred = False
+        scheduler = None
         try:
             self.init_config(config)
-            ssl.generate_crt(self.config, name, plugin, csr, key, domain)
+            if plugin == "le":
+                email = os.environ.get('RPAAS_PLUGIN_LE_EMAIL', 'admin@' + domain)
+                scheduler = acme_scheduler.AcmeScheduler(self.redis_client, self.config)
+                scheduler.enqueue(name, domain, email)
+                wait = scheduler.acquire(name, domain, email)
+                if wait > 0:
+                    deferred = True
+                    wait = min(wait, max_countdown(self.config))
+                    if self.owns_task_entry:
+                        self.task_manager.heartbeat(name, ttl=wait + self.task_manager.ttl)
+                    raise self.retry(countdown=wait, max_retries=None)
+            try:
+                ssl.generate_crt(self.config, name, plugin, csr, key, domain)
+            except Exception:
+                if scheduler is not None:
+                    scheduler.record_failure(domain, email)
+                raise
+        except Exception:
+            if scheduler is not None and not deferred:
+                scheduler.cancel(name)
+            raise
         finally:
-            self.storage.remove_task(name)
+            if not deferred and self.owns_task_entry:
+                self.storage.remove_task(name)
 
 
 class RevokeCertTask(BaseManagerTask):
@@ -364,22 +1093,96 @@ class RevokeCertTask(BaseManagerTask):
 
 
 class RenewCertsTask(BaseManagerTask):
+    """
+    RenewCertsTask finds the certificates about to expire and schedules one
+    RenewCertTask for each of them, spread over LE_RENEWAL_WINDOW seconds so
+    renewals don't all hit the workers and Let's Encrypt at once. The window
+    is capped below the broker visibility timeout, see max_countdown.
+    """
 
     def run(self, config):
         self.init_config(config)
         expires_in = int(self.config.get("LE_CERTIFICATE_EXPIRATION_DAYS", 90))
+        window = float(self.config.get("LE_RENEWAL_WINDOW",
+                                       self.config.get("LE_RENEWER_RUN_INTERVAL", 86400)))
+        window = min(window, max_countdown(self.config))
         limit = datetime.datetime.utcnow() - datetime.timedelta(days=expires_in - 3)
         query = {"created": {"$lte": limit}}
-        for cert in self.storage.find_le_certificates(query):
-            metadata = self.storage.find_instance_metadata(cert["name"])
-            config = copy.deepcopy(self.config)
-            if metadata and "plan_name" in metadata:
-                plan = self.storage.find_plan(metadata["plan_name"])
-                config.update(plan.config)
-            self.renew(cert, config)
-
-    def renew(self, cert, config):
+        certs = list(self.storage.find_le_certificates(query))
+        if not certs:
+            return
+        plan_names = {}
+        for metadata in self.storage.find_instances_metadata(cert["name"] for cert in certs):
+            if "plan_name" in metadata:
+                plan_names[metadata["_id"]] = metadata["plan_name"]
+        plans = dict((plan.name, plan) for plan in self.storage.find_plans(set(plan_names.values())))
+        references = {}
+        slot = window / len(certs)
+        for i, cert in enumerate(certs):
+            plan_name = plan_names.get(cert["name"])
+            if plan_name is not None and plan_name not in plans:
+                logging.error("renew_certs: plan {} of instance {} not found".format(plan_name,
+                                                                                     cert["name"]))
+                continue
+            if plan_name not in references:
+                config = copy.deepcopy(self.config)
+                if plan_name is not None:
+                    config.update(plans[plan_name].config)
+                references[plan_name] = config_store.reference(config, plan_name)
+            countdown = slot * i + random.uniform(0, slot)
+            RenewCertTask().apply_async(kwargs={"config": references[plan_name], "name": cert["name"],
+                                                "domain": cert["domain"]},
+                                        countdown=countdown)
+
+
+class RenewCertTask(DownloadCertTask):
+    """
+    RenewCertTask renews the certificate of domain. No task entry is created
+    for renewals, so the entry of the instance, if any, belongs to another
+    task and is left alone.
+    """
+
+    owns_task_entry = False
+
+    def run(self, config, name, domain):
         key = ssl.generate_key()
-        csr = ssl.generate_csr(key, cert["domain"])
-        DownloadCertTask().delay(config=config, name=cert["name"], plugin="le",
-                                 csr=csr, key=key, domain=cert["domain"])
+        csr = ssl.generate_csr(key, domain)
+        super(RenewCertTask, self).run(config, name, "le", csr, key, domain)
+
+
+class BatchTask(BaseManagerTask):
+    """
+    BatchTask runs the operation of a batch on its instances, one at a time.
+    A batch starts as many BatchTasks as its concurrency, and each of them
+    takes the next pending instance once the previous one is done.
+    """
+
+    def run(self, config, batch_id, name=None):
+        self.init_config(config)
+        poll_interval = int(self.config.get("BATCH_POLL_INTERVAL", 10))
+        if name is not None:
+            if self.storage.find_task(name).count() > 0:
+                raise self.retry(countdown=poll_interval, max_retries=None)
+            self.storage.finish_batch_item(batch_id, name)
+        name = self.storage.next_batch_item(batch_id)
+        if name is None:
+            return
+        batch = self.storage.find_batch(batch_id)
+        try:
+            running = self._manager().run_batch_item(batch["operation"], name, batch["params"])
+        except Exception as e:
+            logging.error("batch {}: error running {} on {}: {}".format(batch_id, batch["operation"],
+                                                                        name, e))
+            self.storage.finish_batch_item(batch_id, name, error=str(e))
+            running = False
+        else:
+            if not running:
+                self.storage.finish_batch_item(batch_id, name)
+        if running:
+            BatchTask().apply_async(args=(config, batch_id, name), countdown=poll_interval)
+        else:
+            BatchTask().delay(config, batch_id)
+
+    def _manager(self):
+        from rpaas import manager
+        return manager.Manager(self.config)
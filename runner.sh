@@ -1,8 +1,32 @@
 #!/bin/sh
 
+QUEUES="provisioning,healing,certificates,housekeeping"
+
+queue_worker() {
+    queue=$1
+    concurrency=$2
+    prefetch=$3
+    CELERY_PREFETCH_MULTIPLIER=$prefetch celery -A rpaas.tasks worker -Q $queue -c $concurrency -n $queue.%h
+}
+
 case $RPAAS_ROLE in
     "worker")
-        celery -A rpaas.tasks worker
+        celery -A rpaas.tasks worker -Q celery,$QUEUES
+        ;;
+    "worker-provisioning")
+        queue_worker provisioning ${PROVISIONING_CONCURRENCY:-4} ${PROVISIONING_PREFETCH:-1}
+        ;;
+    "worker-healing")
+        queue_worker healing ${HEALING_CONCURRENCY:-2} ${HEALING_PREFETCH:-1}
+        ;;
+    "worker-certificates")
+        queue_worker certificates ${CERTIFICATES_CONCURRENCY:-2} ${CERTIFICATES_PREFETCH:-1}
+        ;;
+    "worker-housekeeping")
+        queue_worker housekeeping ${HOUSEKEEPING_CONCURRENCY:-1} ${HOUSEKEEPING_PREFETCH:-1}
+        ;;
+    "scheduler")
+        python -m rpaas.jobs
         ;;
     "flower")
         celery flower -A rpaas.tasks --address=0.0.0.0 --port=$PORT --basic_auth=$FLOWER_USER:$FLOWER_PASSWORD
@@ -0,0 +1,394 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Healing benchmark.
+
+Simulates a service with thousands of nginx machines and measures how the
+healing pipeline (CheckMachine, CheckMachineTask, RestoreMachineTask and
+RestoreHostTask) handles a fraction of them failing. It runs against a fake
+Consul HTTP server, the simulated hm managers of tests.managers, a local
+Redis and either a local mongod (MONGO_URI) or mongomock:
+
+    python -m tests.bench_healing --nodes 5000 --fail-fraction 0.05
+
+The report has the detection latency (from the failure to the restore task),
+the time to heal, the restore throughput and the contention on the restore
+lock and leases. RESTORE_*, FLAP_* and CHECK_MACHINE_* settings on the
+environment override the ones used by the simulation.
+"""
+
+import argparse
+import BaseHTTPServer
+import collections
+import contextlib
+import datetime
+import json
+import os
+import Queue
+import random
+import SocketServer
+import threading
+import time
+import urlparse
+
+import mock
+
+from hm.model.host import Host
+from hm.model.load_balancer import LoadBalancer
+
+from rpaas import healing, lease, nginx, storage, tasks
+from tests import managers
+
+tasks.app.conf.CELERY_ALWAYS_EAGER = True
+
+SERVICE_NAME = "rpaas_bench"
+OVERRIDABLE_SETTINGS = ("RESTORE_", "FLAP_", "CHECK_MACHINE_")
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class FakeConsul(object):
+    """
+    FakeConsul holds the nginx machines of the service and which of them are
+    failing their checks, waking up blocking queries on every change.
+    """
+
+    def __init__(self, service_name):
+        self.service_name = service_name
+        self.nodes = collections.OrderedDict()
+        self.critical = set()
+        self.index = 1
+        self.changed = threading.Condition()
+
+    def add_node(self, name, address, instance):
+        with self.changed:
+            self.nodes[name] = {"address": address, "instance": instance}
+            self._bump()
+
+    def remove_node(self, name):
+        with self.changed:
+            self.nodes.pop(name, None)
+            self.critical.discard(name)
+            self._bump()
+
+    def set_critical(self, names, critical=True):
+        with self.changed:
+            for name in names:
+                if critical:
+                    self.critical.add(name)
+                else:
+                    self.critical.discard(name)
+            self._bump()
+
+    def wait(self, index, timeout):
+        deadline = time.time() + timeout
+        with self.changed:
+            while self.index <= index:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.changed.wait(remaining)
+
+    def _bump(self):
+        self.index += 1
+        self.changed.notify_all()
+
+
+class ConsulHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        consul = self.server.consul
+        if url.path == "/v1/health/state/critical" and "index" in params:
+            consul.wait(int(params["index"][0]), parse_wait(params.get("wait", ["0s"])[0]))
+        with consul.changed:
+            index = consul.index
+            if url.path == "/v1/health/state/critical":
+                body = [{"Node": name, "CheckID": "service:nginx", "Status": "critical"}
+                        for name in consul.critical]
+            elif url.path == "/v1/catalog/service/nginx":
+                body = [{"Node": name, "Address": node["address"],
+                         "ServiceTags": [consul.service_name, node["instance"]]}
+                        for name, node in consul.nodes.iteritems()]
+            elif url.path == "/v1/health/service/nginx":
+                body = [{"Node": {"Node": name, "Address": node["address"]},
+                         "Service": {"Service": "nginx", "Tags": [consul.service_name, node["instance"]]},
+                         "Checks": [{"Status": "critical" if name in consul.critical else "passing"}]}
+                        for name, node in consul.nodes.iteritems()]
+            elif url.path == "/v1/catalog/nodes":
+                body = [{"Node": name, "Address": node["address"]} for name, node in consul.nodes.iteritems()]
+            else:
+                body = None
+        self._reply(200 if body is not None else 404, body, index)
+
+    def do_PUT(self):
+        url = urlparse.urlparse(self.path)
+        if url.path.startswith("/v1/agent/force-leave/"):
+            self.server.consul.remove_node(url.path.rsplit("/", 1)[1])
+        self._reply(200, True, self.server.consul.index)
+
+    do_DELETE = do_PUT
+
+    def _reply(self, status, body, index):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-Consul-Index", str(index))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class ConsulServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def parse_wait(value):
+    if value.endswith("ms"):
+        return float(value[:-2]) / 1000
+    return float(value.rstrip("s") or 0)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(round(p / 100.0 * (len(values) - 1))), len(values) - 1)]
+
+
+class HealingBenchmark(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.consul = FakeConsul(SERVICE_NAME)
+        self.server = ConsulServer(("127.0.0.1", 0), ConsulHandler)
+        self.server.consul = self.consul
+        self.config = {
+            "MONGO_DATABASE": "rpaas_bench",
+            "RPAAS_SERVICE_NAME": SERVICE_NAME,
+            "CONSUL_HOST": "127.0.0.1",
+            "CONSUL_PORT": str(self.server.server_address[1]),
+            "HOST_MANAGER": "simulated",
+            "LB_MANAGER": "simulated",
+            "RESTORE_MACHINE_DELAY": 0,
+            "RESTORE_MACHINE_POLICY": options.policy,
+            "RESTORE_LOCK_NAME": "rpaas_bench:restore_lock",
+            "RESTORE_LEASE_PREFIX": "rpaas_bench:restore_lease",
+            "RESTORE_BREAKER_PREFIX": "rpaas_bench:restore_breaker",
+            "FLAP_DAMPING_PREFIX": "rpaas_bench:flap_damping",
+            "FLAP_SAMPLE_INTERVAL": 1,
+            "CHECK_MACHINE_STATE_KEY": "rpaas_bench:check_machine:state",
+            "CHECK_MACHINE_WAIT": "1s",
+            "CHECK_MACHINE_RUN_INTERVAL": 2,
+            "CHECK_MACHINE_MIN_QUERY_INTERVAL": 0.1,
+        }
+        for key, value in os.environ.iteritems():
+            if key.startswith(OVERRIDABLE_SETTINGS) or key.startswith("MONGO"):
+                self.config[key] = value
+        self.addresses = {}
+        self.failed_at = {}
+        self.detected_at = {}
+        self.flapping = set()
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.stopping = threading.Event()
+
+    def run(self):
+        threading.Thread(target=self.server.serve_forever).start()
+        try:
+            self._clean()
+            self._setup()
+            with self._instrumented():
+                self._simulate()
+            return self._report()
+        finally:
+            self.server.shutdown()
+            self._clean()
+
+    def _setup(self):
+        lbs = {}
+        for i in xrange(self.options.nodes):
+            instance = "bench-{}".format(i // self.options.instance_size)
+            host = Host.create("simulated", instance, self.config)
+            if self.options.policy != "restore":
+                if instance not in lbs:
+                    lbs[instance] = LoadBalancer.create("simulated", instance, self.config)
+                lbs[instance].add_host(host)
+            self.addresses[host.dns_name] = "node-{}".format(i)
+            self.consul.add_node("node-{}".format(i), host.dns_name, instance)
+        for manager in (managers.SimulatedHostManager, managers.SimulatedLBManager):
+            manager.latency = self.options.restore_latency
+            manager.failure_rate = self.options.restore_failure_rate
+
+    def _simulate(self):
+        threads = [threading.Thread(target=self._worker) for _ in xrange(self.options.workers)]
+        threads += [threading.Thread(target=self._dispatcher) for _ in xrange(self.options.dispatchers)]
+        checker = healing.CheckMachine(self.config)
+        checker.start()
+        for thread in threads:
+            thread.start()
+        time.sleep(2)
+        addresses = self.addresses.keys()
+        random.shuffle(addresses)
+        failing = int(len(addresses) * self.options.fail_fraction)
+        failed, self.flapping = addresses[:failing], set(addresses[failing:failing + self.options.flapping])
+        now = time.time()
+        self.failed_at = dict((address, now) for address in failed)
+        self.consul.set_critical([self.addresses[address] for address in failed])
+        self.started = now
+        deadline = now + self.options.timeout
+        flap = True
+        while time.time() < deadline and self._healed_count() < len(failed):
+            self.consul.set_critical([self.addresses[address] for address in self.flapping], flap)
+            flap = not flap
+            time.sleep(self.options.flap_period)
+        self.finished = time.time()
+        self.stopping.set()
+        checker.stop()
+        for thread in threads:
+            thread.join()
+
+    def _worker(self):
+        while not self.stopping.is_set():
+            try:
+                args = self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            try:
+                tasks.RestoreHostTask().run(*args)
+            except Exception:
+                self._count("restore_errors")
+
+    def _dispatcher(self):
+        while not self.stopping.is_set():
+            tasks.RestoreMachineTask().run(self.config)
+            self.stopping.wait(self.options.dispatch_interval)
+
+    def _instrumented(self):
+        bench = self
+        store_restore_tasks = storage.MongoDBStorage.store_restore_tasks
+        lock_acquire = lease.LeaseLock.acquire
+        acquire = lease.RestoreLeases.acquire
+
+        def wait_healthcheck(nginx_manager, host, timeout=30):
+            time.sleep(bench.options.healthcheck_latency)
+            if host in bench.addresses:
+                bench.consul.set_critical([bench.addresses[host]], False)
+
+        def delay(task, *args):
+            bench.queue.put(args)
+
+        def store_restore_tasks_spy(storage_self, machines):
+            now = time.time()
+            with bench.lock:
+                for address in machines:
+                    bench.detected_at.setdefault(address, now)
+            return store_restore_tasks(storage_self, machines)
+
+        def lock_acquire_spy(lock):
+            fence = lock_acquire(lock)
+            bench._count("restore_lock_acquired" if fence is not None else "restore_lock_contended")
+            return fence
+
+        def acquire_spy(leases, *args, **kwargs):
+            token = acquire(leases, *args, **kwargs)
+            bench._count("leases_granted" if token is not None else "leases_denied")
+            return token
+
+        patches = [
+            mock.patch.object(nginx.Nginx, "wait_healthcheck", wait_healthcheck),
+            mock.patch.object(tasks.RestoreHostTask, "delay", delay),
+            mock.patch.object(storage.MongoDBStorage, "store_restore_tasks", store_restore_tasks_spy),
+            mock.patch.object(lease.LeaseLock, "acquire", lock_acquire_spy),
+            mock.patch.object(lease.RestoreLeases, "acquire", acquire_spy),
+        ]
+        return contextlib.nested(*patches)
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _healings(self):
+        db = storage.MongoDBStorage(self.config).db
+        return list(db[storage.MongoDBStorage.healing_collection].find())
+
+    def _healed_count(self):
+        db = storage.MongoDBStorage(self.config).db
+        return db[storage.MongoDBStorage.healing_collection].find({"status": "success"}).count()
+
+    def _report(self):
+        healed_at, failures = {}, 0
+        for event in self._healings():
+            if event.get("status") == "success":
+                healed_at[event["machine"]] = (event["end_time"] - EPOCH).total_seconds()
+            else:
+                failures += 1
+        detection = [self.detected_at[a] - t for a, t in self.failed_at.iteritems() if a in self.detected_at]
+        heal = [healed_at[a] - t for a, t in self.failed_at.iteritems() if a in healed_at]
+        elapsed = self.finished - self.started
+        lock_attempts = self.counters["restore_lock_acquired"] + self.counters["restore_lock_contended"]
+        lease_attempts = self.counters["leases_granted"] + self.counters["leases_denied"]
+        return collections.OrderedDict([
+            ("nodes", self.options.nodes),
+            ("failed", len(self.failed_at)),
+            ("detected", len(detection)),
+            ("healed", len(heal)),
+            ("elapsed", round(elapsed, 2)),
+            ("detection_latency", self._summary(detection)),
+            ("time_to_heal", self._summary(heal)),
+            ("restores_per_second", round(len(heal) / elapsed, 2) if elapsed else 0),
+            ("failed_restores", failures),
+            ("restore_errors", self.counters["restore_errors"]),
+            ("flapping_dispatched", len(self.flapping & set(self.detected_at))),
+            ("flapping_restored", len(self.flapping & set(healed_at))),
+            ("restore_lock_attempts", lock_attempts),
+            ("restore_lock_contention", round(self.counters["restore_lock_contended"] /
+                                              float(lock_attempts), 3) if lock_attempts else 0),
+            ("lease_attempts", lease_attempts),
+            ("lease_denials", self.counters["leases_denied"]),
+        ])
+
+    def _summary(self, values):
+        return collections.OrderedDict([("p50", round(percentile(values, 50), 3)),
+                                        ("p95", round(percentile(values, 95), 3)),
+                                        ("max", round(max(values), 3) if values else 0.0)])
+
+    def _clean(self):
+        storage.MongoDBStorage(self.config).db.client.drop_database(self.config["MONGO_DATABASE"])
+        conn = tasks.app.backend.client
+        for key in conn.keys("rpaas_bench:*"):
+            conn.delete(key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the healing pipeline.")
+    parser.add_argument("--nodes", type=int, default=5000)
+    parser.add_argument("--instance-size", type=int, default=2)
+    parser.add_argument("--fail-fraction", type=float, default=0.05)
+    parser.add_argument("--flapping", type=int, default=0, help="nodes flapping during the run")
+    parser.add_argument("--flap-period", type=float, default=1)
+    parser.add_argument("--workers", type=int, default=8, help="threads running RestoreHostTask")
+    parser.add_argument("--dispatchers", type=int, default=2, help="threads running RestoreMachineTask")
+    parser.add_argument("--dispatch-interval", type=float, default=1)
+    parser.add_argument("--restore-latency", type=float, default=0.1)
+    parser.add_argument("--restore-failure-rate", type=float, default=0)
+    parser.add_argument("--healthcheck-latency", type=float, default=0.1)
+    parser.add_argument("--policy", default="restore", choices=("restore", "replace", "restore_then_replace"))
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--mongomock", action="store_true", help="use mongomock instead of MONGO_URI")
+    options = parser.parse_args()
+    if options.mongomock:
+        import mongomock
+        mock.patch("pymongo.MongoClient", return_value=mongomock.MongoClient()).start()
+    print json.dumps(HealingBenchmark(options).run(), indent=2)
+
+
+if __name__ == "__main__":
+    main()
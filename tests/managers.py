@@ -2,7 +2,15 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-from rpaas import storage, manager
+import random
+import threading
+import time
+
+from hm import lb_managers, managers
+from hm.model.host import Host
+from hm.model.load_balancer import LoadBalancer
+
+from rpaas import storage, manager, tasks
 
 
 class FakeInstance(object):
@@ -16,6 +24,7 @@ class FakeInstance(object):
         self.routes = {}
         self.blocks = {}
         self.node_status = {}
+        self.task = None
 
     def bind(self, app_host):
         self.bound.append(app_host)
@@ -67,6 +76,12 @@ class FakeManager(object):
             raise storage.InstanceNotFoundError()
         return instance.node_status
 
+    def current_task(self, name):
+        index, instance = self.find_instance(name)
+        if index < 0 or instance.task is None:
+            raise tasks.TaskNotFoundError("No task running for {}".format(name))
+        return instance.task
+
     def status(self, name):
         index, instance = self.find_instance(name)
         if index < 0:
@@ -133,3 +148,73 @@ class FakeManager(object):
             raise storage.InstanceNotFoundError()
         if machine != 'foo':
             raise manager.InstanceMachineNotFoundError()
+
+
+class SimulatedFailure(Exception):
+    pass
+
+
+class SimulatedHostManager(managers.BaseManager):
+    """
+    hm host manager for simulations: every operation takes `latency` seconds
+    and fails with probability `failure_rate`.
+    """
+
+    latency = 0
+    failure_rate = 0
+    next_id = 0
+    lock = threading.Lock()
+
+    def create_host(self, name=None, alternative_id=0):
+        self._operate("create")
+        with SimulatedHostManager.lock:
+            SimulatedHostManager.next_id += 1
+            id = SimulatedHostManager.next_id
+        address = "10.{}.{}.{}".format(id >> 16 & 255, id >> 8 & 255, id & 255)
+        return Host(id=id, dns_name=address, alternative_id=alternative_id)
+
+    def restore_host(self, id):
+        self._operate("restore")
+
+    def start_host(self, id):
+        pass
+
+    def destroy_host(self, id):
+        self._operate("destroy")
+
+    def _operate(self, operation):
+        time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise SimulatedFailure("simulated {} failure".format(operation))
+
+
+class SimulatedLBManager(lb_managers.BaseLBManager):
+    """
+    hm load balancer manager for simulations, with the same latency and
+    failure rate knobs as SimulatedHostManager.
+    """
+
+    latency = 0
+    failure_rate = 0
+
+    def create_load_balancer(self, name):
+        self._operate("create_load_balancer")
+        return LoadBalancer(id=name, name=name, address="lb.{}".format(name))
+
+    def destroy_load_balancer(self, lb):
+        self._operate("destroy_load_balancer")
+
+    def attach_real(self, lb, host):
+        self._operate("attach_real")
+
+    def detach_real(self, lb, host):
+        self._operate("detach_real")
+
+    def _operate(self, operation):
+        time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise SimulatedFailure("simulated {} failure".format(operation))
+
+
+managers.register("simulated", SimulatedHostManager)
+lb_managers.register("simulated", SimulatedLBManager)
@@ -0,0 +1,195 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import celery
+import mock
+import redis
+
+from rpaas import acme_scheduler, storage, tasks
+
+tasks.app.conf.CELERY_ALWAYS_EAGER = True
+
+
+class AcmeSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = redis.StrictRedis()
+        self.config = {
+            "ACME_SCHEDULER_PREFIX": "acme_scheduler_test",
+            "ACME_ACCOUNT_ORDERS": 3,
+            "ACME_ACCOUNT_PERIOD": 300,
+            "ACME_DOMAIN_CERTIFICATES": 2,
+            "ACME_DOMAIN_PERIOD": 1000,
+            "ACME_FAILED_VALIDATIONS": 1,
+            "ACME_FAILED_VALIDATIONS_PERIOD": 60,
+        }
+        self.scheduler = acme_scheduler.AcmeScheduler(self.conn, self.config)
+        self.time_patcher = mock.patch("rpaas.acme_scheduler.time")
+        self.time = self.time_patcher.start()
+        self.time.time.return_value = 1000.0
+        self.clean()
+
+    def tearDown(self):
+        self.time_patcher.stop()
+        self.clean()
+
+    def clean(self):
+        for key in self.conn.keys("acme_scheduler_test:*"):
+            self.conn.delete(key)
+
+    def test_registered_domain(self):
+        self.assertEqual("tsuru.io", acme_scheduler.registered_domain("a.b.tsuru.io"))
+        self.assertEqual("globo.com.br", acme_scheduler.registered_domain("www.globo.com.br"))
+        self.assertEqual("tsuru.io", acme_scheduler.registered_domain("Tsuru.IO."))
+
+    def test_acquire_domain_limit(self):
+        self.assertEqual(0, self.scheduler.acquire("a", "a.tsuru.io", "admin@tsuru.io"))
+        self.assertEqual(0, self.scheduler.acquire("b", "b.tsuru.io", "admin@tsuru.io"))
+        self.assertEqual(500, self.scheduler.acquire("c", "c.tsuru.io", "admin@tsuru.io"))
+        self.assertEqual(0, self.scheduler.acquire("d", "d.globo.com", "admin@tsuru.io"))
+        self.time.time.return_value = 1500.0
+        self.assertEqual(0, self.scheduler.acquire("c", "c.tsuru.io", "admin@tsuru.io"))
+
+    def test_acquire_account_limit(self):
+        for i in range(3):
+            domain = "app{}.example{}.com".format(i, i)
+            self.assertEqual(0, self.scheduler.acquire(str(i), domain, "admin@tsuru.io"))
+        self.assertEqual(100, self.scheduler.acquire("x", "x.tsuru.io", "admin@tsuru.io"))
+        self.assertEqual(0, self.scheduler.acquire("x", "x.tsuru.io", "other@tsuru.io"))
+
+    def test_acquire_failed_validations(self):
+        self.scheduler.record_failure("a.tsuru.io", "admin@tsuru.io")
+        self.assertEqual(60, self.scheduler.acquire("a", "a.tsuru.io", "admin@tsuru.io"))
+        self.assertEqual(0, self.scheduler.acquire("b", "b.tsuru.io", "admin@tsuru.io"))
+
+    def test_acquire_removes_order(self):
+        self.scheduler.enqueue("a", "a.tsuru.io", "admin@tsuru.io")
+        self.assertIsNotNone(self.scheduler.status("a"))
+        self.assertEqual(0, self.scheduler.acquire("a", "a.tsuru.io", "admin@tsuru.io"))
+        self.assertIsNone(self.scheduler.status("a"))
+
+    def test_status(self):
+        for name in ("a", "b", "c"):
+            self.scheduler.enqueue(name, "{}.tsuru.io".format(name), "admin@tsuru.io")
+        self.scheduler.enqueue("d", "d.globo.com", "admin@tsuru.io")
+        self.assertEqual({"position": 1, "queue_depth": 4, "eta": 0}, self.scheduler.status("a"))
+        self.assertEqual({"position": 2, "queue_depth": 4, "eta": 0}, self.scheduler.status("b"))
+        self.assertEqual({"position": 3, "queue_depth": 4, "eta": 500}, self.scheduler.status("c"))
+        self.assertEqual({"position": 4, "queue_depth": 4, "eta": 100}, self.scheduler.status("d"))
+        self.assertIsNone(self.scheduler.status("e"))
+
+    def test_status_deferred_order(self):
+        self.scheduler.acquire("a", "a.tsuru.io", "admin@tsuru.io")
+        self.scheduler.acquire("b", "b.tsuru.io", "admin@tsuru.io")
+        self.scheduler.enqueue("c", "c.tsuru.io", "admin@tsuru.io")
+        self.scheduler.enqueue("d", "d.globo.com", "admin@tsuru.io")
+        self.scheduler.acquire("c", "c.tsuru.io", "admin@tsuru.io")
+        self.assertEqual({"position": 1, "queue_depth": 2, "eta": 0}, self.scheduler.status("d"))
+        self.assertEqual({"position": 2, "queue_depth": 2, "eta": 500}, self.scheduler.status("c"))
+
+    def test_cancel(self):
+        self.scheduler.enqueue("a", "a.tsuru.io", "admin@tsuru.io")
+        self.scheduler.cancel("a")
+        self.assertIsNone(self.scheduler.status("a"))
+
+    def test_stale_orders_expire(self):
+        self.scheduler.enqueue("a", "a.tsuru.io", "admin@tsuru.io")
+        self.scheduler.acquire("b", "b.tsuru.io", "admin@tsuru.io")
+        self.scheduler.acquire("c", "c.tsuru.io", "admin@tsuru.io")
+        self.scheduler.enqueue("d", "d.tsuru.io", "admin@tsuru.io")
+        self.assertEqual(500, self.scheduler.acquire("d", "d.tsuru.io", "admin@tsuru.io"))
+        self.time.time.return_value = 1000.0 + 3600
+        self.scheduler.enqueue("e", "e.globo.com", "admin@tsuru.io")
+        self.assertIsNone(self.scheduler.status("a"))
+        self.assertEqual({"position": 1, "queue_depth": 2, "eta": 0}, self.scheduler.status("d"))
+        self.assertEqual({"position": 2, "queue_depth": 2, "eta": 0}, self.scheduler.status("e"))
+        self.assertEqual(["d", "e"], sorted(self.conn.hkeys("acme_scheduler_test:orders")))
+
+
+class DownloadCertTaskTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {
+            "MONGO_DATABASE": "acme_scheduler_test",
+            "RPAAS_SERVICE_NAME": "test_rpaas_acme_scheduler",
+        }
+        self.storage = storage.MongoDBStorage(self.config)
+        self.storage.store_task("myinstance")
+
+    def tearDown(self):
+        self.storage.remove_task("myinstance")
+
+    @mock.patch("rpaas.ssl.generate_crt")
+    @mock.patch("rpaas.tasks.acme_scheduler.AcmeScheduler")
+    def test_download_cert(self, AcmeScheduler, generate_crt):
+        scheduler = AcmeScheduler.return_value
+        scheduler.acquire.return_value = 0
+        tasks.DownloadCertTask().delay(self.config, "myinstance", "le", "csr", "key", "my.tsuru.io")
+        scheduler.enqueue.assert_called_once_with("myinstance", "my.tsuru.io", "admin@my.tsuru.io")
+        generate_crt.assert_called_once_with(self.config, "myinstance", "le", "csr", "key", "my.tsuru.io")
+        self.assertEqual([], list(self.storage.find_task("myinstance")))
+
+    @mock.patch("rpaas.ssl.generate_crt")
+    @mock.patch.object(tasks.DownloadCertTask, "retry")
+    @mock.patch("rpaas.tasks.acme_scheduler.AcmeScheduler")
+    def test_download_cert_deferred(self, AcmeScheduler, retry, generate_crt):
+        AcmeScheduler.return_value.acquire.return_value = 120
+        retry.return_value = celery.exceptions.Retry()
+        tasks.DownloadCertTask().delay(self.config, "myinstance", "le", "csr", "key", "my.tsuru.io")
+        retry.assert_called_once_with(countdown=120, max_retries=None)
+        self.assertFalse(generate_crt.called)
+        self.assertFalse(AcmeScheduler.return_value.cancel.called)
+        self.assertEqual(1, len(list(self.storage.find_task("myinstance"))))
+
+    @mock.patch("rpaas.ssl.generate_crt")
+    @mock.patch.object(tasks.DownloadCertTask, "retry")
+    @mock.patch("rpaas.tasks.acme_scheduler.AcmeScheduler")
+    def test_download_cert_deferred_within_visibility_timeout(self, AcmeScheduler, retry, generate_crt):
+        AcmeScheduler.return_value.acquire.return_value = 7200
+        retry.return_value = celery.exceptions.Retry()
+        self.config["BROKER_VISIBILITY_TIMEOUT"] = 3600
+        tasks.DownloadCertTask().delay(self.config, "myinstance", "le", "csr", "key", "my.tsuru.io")
+        retry.assert_called_once_with(countdown=3240, max_retries=None)
+        self.assertFalse(generate_crt.called)
+
+    @mock.patch("rpaas.ssl.generate_crt")
+    @mock.patch("rpaas.tasks.acme_scheduler.AcmeScheduler")
+    def test_download_cert_failure(self, AcmeScheduler, generate_crt):
+        scheduler = AcmeScheduler.return_value
+        scheduler.acquire.return_value = 0
+        generate_crt.side_effect = Exception("invalid response")
+        tasks.DownloadCertTask().delay(self.config, "myinstance", "le", "csr", "key", "my.tsuru.io")
+        scheduler.record_failure.assert_called_once_with("my.tsuru.io", "admin@my.tsuru.io")
+        scheduler.cancel.assert_called_once_with("myinstance")
+        self.assertEqual([], list(self.storage.find_task("myinstance")))
+
+    @mock.patch("rpaas.ssl.generate_crt")
+    @mock.patch("rpaas.tasks.acme_scheduler.AcmeScheduler")
+    def test_renew_cert_keeps_task_entry(self, AcmeScheduler, generate_crt):
+        AcmeScheduler.return_value.acquire.return_value = 0
+        tasks.RenewCertTask().delay(self.config, "myinstance", u"my.tsuru.io")
+        self.assertTrue(generate_crt.called)
+        self.assertEqual([{"_id": "myinstance"}], list(self.storage.find_task("myinstance")))
+
+    @mock.patch("rpaas.ssl.generate_crt")
+    @mock.patch.object(tasks.RenewCertTask, "retry")
+    @mock.patch("rpaas.tasks.acme_scheduler.AcmeScheduler")
+    def test_renew_cert_deferred_keeps_task_entry(self, AcmeScheduler, retry, generate_crt):
+        AcmeScheduler.return_value.acquire.return_value = 120
+        retry.return_value = celery.exceptions.Retry()
+        tasks.RenewCertTask().delay(self.config, "myinstance", u"my.tsuru.io")
+        retry.assert_called_once_with(countdown=120, max_retries=None)
+        self.assertEqual([{"_id": "myinstance"}], list(self.storage.find_task("myinstance")))
+
+    @mock.patch("rpaas.ssl.generate_crt")
+    @mock.patch("rpaas.tasks.acme_scheduler.AcmeScheduler")
+    def test_download_cert_scheduler_failure(self, AcmeScheduler, generate_crt):
+        scheduler = AcmeScheduler.return_value
+        scheduler.acquire.side_effect = redis.ConnectionError()
+        tasks.DownloadCertTask().delay(self.config, "myinstance", "le", "csr", "key", "my.tsuru.io")
+        self.assertFalse(generate_crt.called)
+        scheduler.cancel.assert_called_once_with("myinstance")
+        self.assertEqual([], list(self.storage.find_task("myinstance")))
@@ -7,8 +7,9 @@ import json
 import unittest
 import os
 
+import mock
 from bson import json_util
-from rpaas import api, admin_api, storage
+from rpaas import api, admin_api, manager, storage
 from . import managers
 
 
@@ -52,6 +53,72 @@ class AdminAPITestCase(unittest.TestCase):
         self.assertEqual(200, resp.status_code)
         self.assertListEqual(healing_list[:20], json.loads(resp.data))
 
+    def test_list_gc_reports(self):
+        resp = self.api.get("/admin/gc")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("[]", resp.data)
+        start_time = datetime.datetime(2016, 8, 2, 10, 53, 0)
+        reports = []
+        for x in range(3):
+            data = {"start_time": start_time + datetime.timedelta(hours=x), "dry_run": True,
+                    "orphans": {"bindings": ["instance{}".format(x)]}, "status": "success"}
+            reports.append(json.loads(json.dumps(data, default=json_util.default)))
+            self.storage.db[self.storage.gc_reports_collection].insert(data)
+        reports.reverse()
+        resp = self.api.get("/admin/gc?quantity=2")
+        self.assertEqual(200, resp.status_code)
+        self.assertListEqual(reports[:2], json.loads(resp.data))
+
+    @mock.patch("rpaas.admin_api.consul_manager")
+    def test_consul_stats(self, consul_manager):
+        stats = {"clients": 1, "connections": 2, "requests": 10, "reused": 8}
+        consul_manager.connection_stats.return_value = stats
+        resp = self.api.get("/admin/consul/stats")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(stats, json.loads(resp.data))
+
+    @mock.patch("rpaas.admin_api.get_manager")
+    def test_collect_garbage(self, get_manager):
+        resp = self.api.post("/admin/gc", data={"dry_run": "true"})
+        self.assertEqual(202, resp.status_code)
+        resp = self.api.post("/admin/gc")
+        self.assertEqual(202, resp.status_code)
+        self.assertEqual([mock.call(dry_run=True), mock.call(dry_run=False)],
+                         get_manager.return_value.collect_garbage.mock_calls)
+
+    @mock.patch("rpaas.admin_api.get_manager")
+    def test_start_batch(self, get_manager):
+        get_manager.return_value.start_batch.return_value = "abc123"
+        resp = self.api.post("/admin/batches", data={"operation": "scale", "team": "team1",
+                                                     "instances": "a, b", "quantity": "2",
+                                                     "concurrency": "5"})
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual({"id": "abc123"}, json.loads(resp.data))
+        get_manager.return_value.start_batch.assert_called_once_with(
+            "scale", {"team": "team1", "instances": ["a", "b"]}, {"quantity": "2"}, "5")
+
+    @mock.patch("rpaas.admin_api.get_manager")
+    def test_start_batch_invalid(self, get_manager):
+        resp = self.api.post("/admin/batches", data={"team": "team1"})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("missing operation", resp.data)
+        get_manager.return_value.start_batch.side_effect = manager.BatchError("invalid operation destroy")
+        resp = self.api.post("/admin/batches", data={"operation": "destroy", "team": "team1"})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("invalid operation destroy", resp.data)
+
+    @mock.patch("rpaas.admin_api.get_manager")
+    def test_batch_status(self, get_manager):
+        get_manager.return_value.batch_status.return_value = {"id": "abc123", "status": "running",
+                                                              "total": 3, "succeeded": 1}
+        resp = self.api.get("/admin/batches/abc123")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({"id": "abc123", "status": "running", "total": 3, "succeeded": 1},
+                         json.loads(resp.data))
+        get_manager.return_value.batch_status.side_effect = storage.BatchNotFoundError()
+        resp = self.api.get("/admin/batches/unknown")
+        self.assertEqual(404, resp.status_code)
+
     def test_list_plans(self):
         resp = self.api.get("/admin/plans")
         self.assertEqual(200, resp.status_code)
@@ -9,10 +9,19 @@ import os
 import unittest
 from io import BytesIO
 
-from rpaas import admin_plugin, api, plugin, storage
+import redis
+from werkzeug.datastructures import MultiDict
+
+from rpaas import admin_plugin, api, idempotency, plugin, storage
 from . import managers
 
 
+class FakeRequest(object):
+
+    def __init__(self, form):
+        self.form = MultiDict(form)
+
+
 class APITestCase(unittest.TestCase):
 
     @classmethod
@@ -58,6 +67,68 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(201, resp.status_code)
         self.assertEqual("someapp", self.manager.instances[0].name)
 
+    def test_start_instance_idempotency_key(self):
+        self.addCleanup(self.clean_idempotency_keys)
+        headers = {"Idempotency-Key": "create-someapp"}
+        data = {"name": "someapp", "team": "team1"}
+        resp = self.api.post("/resources", data=data, headers=headers)
+        self.assertEqual(201, resp.status_code)
+        self.assertNotIn("Idempotent-Replayed", resp.headers)
+        resp = self.api.post("/resources", data=data, headers=headers)
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual("true", resp.headers["Idempotent-Replayed"])
+        self.assertEqual(["someapp"], [i.name for i in self.manager.instances])
+        resp = self.api.post("/resources", data={"name": "otherapp", "team": "team1"}, headers=headers)
+        self.assertEqual(422, resp.status_code)
+        self.assertEqual(["someapp"], [i.name for i in self.manager.instances])
+
+    def test_start_instance_idempotency_key_in_progress(self):
+        self.addCleanup(self.clean_idempotency_keys)
+        conn = redis.StrictRedis()
+        data = {"name": "someapp", "team": "team1"}
+        fingerprint = json.dumps({"fingerprint": idempotency.request_fingerprint(FakeRequest(data))})
+        conn.set("idempotency:POST:/resources:create-someapp", fingerprint)
+        resp = self.api.post("/resources", data=data, headers={"Idempotency-Key": "create-someapp"})
+        self.assertEqual(409, resp.status_code)
+        self.assertEqual([], self.manager.instances)
+
+    def test_start_instance_idempotency_key_ttl(self):
+        self.addCleanup(self.clean_idempotency_keys)
+        conn = redis.StrictRedis()
+        redis_key = "idempotency:POST:/resources:create-someapp"
+        new_instance = self.manager.new_instance
+        pending_ttls = []
+
+        def pending_new_instance(*args, **kwargs):
+            pending_ttls.append(conn.ttl(redis_key))
+            return new_instance(*args, **kwargs)
+        self.manager.new_instance = pending_new_instance
+        try:
+            resp = self.api.post("/resources", data={"name": "someapp", "team": "team1"},
+                                 headers={"Idempotency-Key": "create-someapp"})
+        finally:
+            self.manager.new_instance = new_instance
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual(1, len(pending_ttls))
+        self.assertTrue(0 < pending_ttls[0] <= idempotency.pending_ttl())
+        self.assertTrue(idempotency.pending_ttl() < conn.ttl(redis_key) <= idempotency.key_ttl())
+
+    def test_scale_instance_idempotency_key_failure(self):
+        self.addCleanup(self.clean_idempotency_keys)
+        headers = {"Idempotency-Key": "scale-someapp"}
+        resp = self.api.post("/resources/someapp/scale", data={"quantity": "3"}, headers=headers)
+        self.assertEqual(404, resp.status_code)
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/scale", data={"quantity": "3"}, headers=headers)
+        self.assertEqual(201, resp.status_code)
+        _, instance = self.manager.find_instance("someapp")
+        self.assertEqual(3, instance.units)
+
+    def clean_idempotency_keys(self):
+        conn = redis.StrictRedis()
+        for key in conn.keys("idempotency:*"):
+            conn.delete(key)
+
     def test_start_instance_with_plan(self):
         self.storage.db[self.storage.plans_collection].insert(
             {"_id": "small",
@@ -244,6 +315,22 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(404, resp.status_code)
         self.assertEqual("Instance not found", resp.data)
 
+    def test_current_task(self):
+        instance = self.manager.new_instance("someapp")
+        instance.task = {"operation": "scale", "desired_quantity": 3,
+                         "steps": [{"step": "vm_created", "host": "10.1.1.1", "status": "success",
+                                    "duration": 12.5}]}
+        resp = self.api.get("/resources/someapp/tasks/current")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        self.assertDictEqual(instance.task, json.loads(resp.data))
+
+    def test_current_task_not_found(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.get("/resources/someapp/tasks/current")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("No task running for someapp", resp.data)
+
     def test_status_started(self):
         self.manager.new_instance("someapp", state="anything.anything")
         resp = self.api.get("/resources/someapp/status")
@@ -0,0 +1,147 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import unittest
+
+from celery import Celery
+import mock
+from redis.exceptions import ConnectionError
+from redis.sentinel import Sentinel
+
+from rpaas import celery_sentinel
+
+
+class SentinelClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = celery_sentinel.SentinelClient([("127.0.0.1", 51111)], "mymaster")
+        self.client.pid = os.getpid()
+        self.discover_patcher = mock.patch.object(Sentinel, "discover_master",
+                                                  return_value=("10.0.0.1", 6379))
+        self.discover = self.discover_patcher.start()
+
+    def tearDown(self):
+        self.discover_patcher.stop()
+
+    def test_discover_master_cached(self):
+        self.assertEqual(("10.0.0.1", 6379), self.client.discover_master("mymaster"))
+        self.assertEqual(("10.0.0.1", 6379), self.client.discover_master("mymaster"))
+        self.discover.assert_called_once_with("mymaster")
+
+    def test_discover_master_cache_expired(self):
+        self.client.master_cache_ttl = 0
+        self.client.discover_master("mymaster")
+        self.discover.return_value = ("10.0.0.2", 6380)
+        self.assertEqual(("10.0.0.2", 6380), self.client.discover_master("mymaster"))
+        self.assertEqual(2, self.discover.call_count)
+
+    def test_switch_master(self):
+        master = self.client.master_for("mymaster")
+        slave = self.client.slave_for("mymaster")
+        self.client.discover_master("mymaster")
+        with mock.patch.object(master.connection_pool, "disconnect") as master_disconnect, \
+                mock.patch.object(slave.connection_pool, "disconnect") as slave_disconnect:
+            self.assertTrue(self.client.switch_master("mymaster 10.0.0.1 6379 10.0.0.2 6380"))
+        master_disconnect.assert_called_once_with()
+        slave_disconnect.assert_called_once_with()
+        self.assertEqual(("10.0.0.2", 6380), self.client.discover_master("mymaster"))
+        self.discover.assert_called_once_with("mymaster")
+
+    def test_switch_master_other_service(self):
+        self.client.discover_master("mymaster")
+        self.assertFalse(self.client.switch_master("other 10.0.0.1 6379 10.0.0.2 6380"))
+        self.assertEqual(("10.0.0.1", 6379), self.client.discover_master("mymaster"))
+
+    @mock.patch("rpaas.celery_sentinel.SwitchMasterWatcher")
+    def test_watcher_started_once_per_process(self, watcher):
+        self.client.pid = None
+        self.client.discover_master("mymaster")
+        self.client.discover_master("mymaster")
+        watcher.assert_called_once_with(self.client)
+        watcher.return_value.start.assert_called_once_with()
+        self.client.pid = -1
+        self.client.discover_master("mymaster")
+        self.assertEqual(2, watcher.return_value.start.call_count)
+        self.assertEqual(2, self.discover.call_count)
+
+    def test_shared_sentinel(self):
+        sentinels = [("127.0.0.1", "51111"), ("127.0.0.1", "51112")]
+        client = celery_sentinel.shared_sentinel(sentinels, "mymaster", password="mypass")
+        self.assertIs(client, celery_sentinel.shared_sentinel(list(sentinels), "mymaster", password="mypass"))
+        self.assertIsNot(client, celery_sentinel.shared_sentinel(sentinels, "other", password="mypass"))
+        self.assertEqual("mymaster", client.service_name)
+        self.assertEqual("mypass", client.connection_kwargs["password"])
+
+
+class SwitchMasterWatcherTestCase(unittest.TestCase):
+
+    @mock.patch("rpaas.celery_sentinel.StrictRedis")
+    def test_listen(self, StrictRedis):
+        client = mock.Mock()
+        sentinel = mock.Mock()
+        sentinel.connection_pool.connection_kwargs = {"host": "127.0.0.1", "port": 51111,
+                                                      "socket_timeout": 0.1}
+        pubsub = StrictRedis.return_value.pubsub.return_value
+        pubsub.listen.return_value = [{"type": "message", "data": "mymaster 10.0.0.1 6379 10.0.0.2 6380"}]
+        celery_sentinel.SwitchMasterWatcher(client)._listen(sentinel)
+        StrictRedis.assert_called_once_with(host="127.0.0.1", port=51111, socket_timeout=None,
+                                            socket_keepalive=True)
+        pubsub.subscribe.assert_called_once_with("+switch-master")
+        client.refresh_master.assert_called_once_with()
+        client.switch_master.assert_called_once_with("mymaster 10.0.0.1 6379 10.0.0.2 6380")
+        pubsub.close.assert_called_once_with()
+
+
+class RedisSentinelBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Celery("test_celery_sentinel", set_as_current=False)
+        self.app.conf.CELERY_SENTINEL_BACKEND_SETTINGS = {"service_name": "mymaster",
+                                                          "read_from_slaves": True}
+        self.backend = celery_sentinel.RedisSentinelBackend(app=self.app)
+        self.master = mock.Mock()
+        self.slave = mock.Mock()
+        self.backend._redis_connection = [self.master]
+        self.backend._redis_slave_connection = [self.slave]
+
+    def test_get_from_slave(self):
+        self.slave.get.return_value = "result"
+        self.assertEqual("result", self.backend.get("celery-task-meta-1"))
+        self.slave.get.assert_called_once_with("celery-task-meta-1")
+        self.assertFalse(self.master.get.called)
+
+    def test_get_slave_miss(self):
+        self.slave.get.return_value = None
+        self.assertIsNone(self.backend.get("celery-task-meta-1"))
+        self.assertFalse(self.master.get.called)
+
+    def test_get_slave_unavailable(self):
+        self.slave.get.side_effect = ConnectionError("no slaves")
+        self.master.get.return_value = "result"
+        self.assertEqual("result", self.backend.get("celery-task-meta-1"))
+        self.master.get.assert_called_once_with("celery-task-meta-1")
+
+    def test_get_from_master(self):
+        self.backend.sentinel_conf["read_from_slaves"] = False
+        self.master.get.return_value = "result"
+        self.assertEqual("result", self.backend.get("celery-task-meta-1"))
+        self.assertFalse(self.slave.get.called)
+
+    def test_mget_from_master(self):
+        self.backend.sentinel_conf["read_from_slaves"] = False
+        self.master.mget.return_value = ["a", "b"]
+        self.assertEqual(["a", "b"], self.backend.mget(["k1", "k2"]))
+        self.assertFalse(self.slave.mget.called)
+
+    def test_mget(self):
+        self.slave.mget.return_value = ["a", None]
+        self.assertEqual(["a", None], self.backend.mget(["k1", "k2"]))
+        self.slave.mget.assert_called_once_with(["k1", "k2"])
+        self.assertFalse(self.master.mget.called)
+
+    def test_mget_slave_unavailable(self):
+        self.slave.mget.side_effect = ConnectionError("no slaves")
+        self.master.mget.return_value = ["a", "b"]
+        self.assertEqual(["a", "b"], self.backend.mget(["k1", "k2"]))
@@ -0,0 +1,70 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+import redis
+
+from rpaas import circuit_breaker
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = redis.StrictRedis()
+        self.config = {
+            "RESTORE_BREAKER_PREFIX": "restore_breaker_test",
+            "RESTORE_BREAKER_WINDOW": 60,
+            "RESTORE_BREAKER_MIN_FAILURES": 2,
+            "RESTORE_BREAKER_FAILURE_RATE": 0.5,
+            "RESTORE_BREAKER_COOLDOWN": 300,
+        }
+        self.breaker = circuit_breaker.CircuitBreaker(self.conn, self.config)
+        self.time_patcher = mock.patch("rpaas.circuit_breaker.time")
+        self.time = self.time_patcher.start()
+        self.time.time.return_value = 1000.0
+        self.clean()
+
+    def tearDown(self):
+        self.time_patcher.stop()
+        self.clean()
+
+    def clean(self):
+        for key in self.conn.keys("restore_breaker_test:*"):
+            self.conn.delete(key)
+
+    def test_record_opens_on_failure_rate(self):
+        for success in (True, True, False, True, False):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(success)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual("open", self.breaker.state())
+        self.assertTrue(0 < self.conn.ttl("restore_breaker_test:open") <= 300)
+
+    def test_record_discards_old_outcomes(self):
+        self.breaker.record(False)
+        self.time.time.return_value = 1061.0
+        self.breaker.record(False)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertFalse(self.breaker.allow())
+
+    def test_record_half_open(self):
+        self.conn.set("restore_breaker_test:half_open", "1")
+        self.assertEqual("half_open", self.breaker.state())
+        self.breaker.record(False)
+        self.assertEqual("open", self.breaker.state())
+        self.conn.delete("restore_breaker_test:open")
+        self.breaker.record(True)
+        self.assertEqual("closed", self.breaker.state())
+
+    def test_record_ignored_while_open(self):
+        self.conn.set("restore_breaker_test:open", "1")
+        self.breaker.record(False)
+        self.breaker.record(True)
+        self.assertEqual(0, self.conn.zcard("restore_breaker_test:outcomes"))
+        self.assertFalse(self.conn.exists("restore_breaker_test:half_open"))
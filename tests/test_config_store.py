@@ -0,0 +1,113 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import os
+import unittest
+
+import mock
+
+from rpaas import config_store, storage
+
+
+class ConfigStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.environ["MONGO_DATABASE"] = "config_store_test"
+        self.storage = storage.MongoDBStorage()
+        colls = self.storage.db.collection_names(False)
+        for coll in colls:
+            self.storage.db.drop_collection(coll)
+        os.environ["CONSUL_TOKEN"] = "secret"
+        os.environ["HOSTNAME"] = "api-1"
+        config_store.reset()
+        self.plan_config = {"HOST_MANAGER": "fake", "serviceofferingid": "abcdef123456"}
+        self.config = dict(os.environ, **self.plan_config)
+
+    def tearDown(self):
+        config_store.reset()
+        del os.environ["CONSUL_TOKEN"]
+        del os.environ["HOSTNAME"]
+
+    def test_reference(self):
+        ref = config_store.reference(self.config, "small")
+        config_version = config_store.version({"config": self.plan_config, "environ": sorted(os.environ)})
+        self.assertEqual({"config_version": config_version, "plan_name": "small"}, ref)
+        stored = self.storage.find_config_version(ref["config_version"])
+        self.assertEqual(self.plan_config, stored["config"])
+        self.assertEqual(sorted(os.environ), stored["environ"])
+        self.assertEqual("small", stored["plan_name"])
+        self.assertNotIn("secret", str(ref))
+        self.assertNotIn("secret", str(stored))
+
+    def test_reference_ignores_environment(self):
+        ref = config_store.reference(self.config)
+        os.environ["HOSTNAME"] = "api-2"
+        other_ref = config_store.reference(dict(os.environ, **self.plan_config))
+        self.assertEqual(ref, other_ref)
+        self.assertEqual(1, self.storage.db[self.storage.config_versions_collection].count())
+
+    def test_reference_overridden_environment(self):
+        config = dict(self.config, CONSUL_TOKEN="plan-secret")
+        ref = config_store.reference(config)
+        stored = self.storage.find_config_version(ref["config_version"])
+        self.assertEqual(dict(self.plan_config, CONSUL_TOKEN="plan-secret"), stored["config"])
+        self.assertNotIn("CONSUL_TOKEN", stored["environ"])
+        self.assertEqual(config, config_store.resolve(ref))
+
+    @mock.patch("rpaas.storage.MongoDBStorage.ensure_config_versions_index")
+    def test_reference_expiration(self, ensure_index):
+        ref = config_store.reference(self.config)
+        config_store.reference(dict(self.config, HOST_MANAGER="other"))
+        stored = self.storage.find_config_version(ref["config_version"])
+        self.assertIsInstance(stored["published"], datetime.datetime)
+        ensure_index.assert_called_once_with(604800)
+
+    @mock.patch("time.time")
+    def test_reference_publishes_again(self, time):
+        time.return_value = 1000
+        ref = config_store.reference(self.config)
+        collection = self.storage.db[self.storage.config_versions_collection]
+        collection.remove({"_id": ref["config_version"]})
+        time.return_value = 1000 + 302400 - 1
+        config_store.reference(self.config)
+        self.assertIsNone(self.storage.find_config_version(ref["config_version"]))
+        time.return_value = 1000 + 302400
+        config_store.reference(self.config)
+        self.assertIsNotNone(self.storage.find_config_version(ref["config_version"]))
+
+    def test_reference_extra_keys(self):
+        config = dict(self.config, HOST_TAGS="rpaas_instance:x")
+        ref = config_store.reference(config)
+        other_ref = config_store.reference(dict(self.config, HOST_TAGS="rpaas_instance:y"))
+        self.assertEqual(config_store.reference(self.config)["config_version"], ref["config_version"])
+        self.assertEqual(ref["config_version"], other_ref["config_version"])
+        self.assertEqual({"HOST_TAGS": "rpaas_instance:x"}, ref["extra"])
+        self.assertEqual(config, config_store.resolve(ref))
+
+    def test_resolve_from_storage(self):
+        ref = config_store.reference(self.config)
+        config_store.reset()
+        config = config_store.resolve(ref)
+        self.assertEqual(self.config, config)
+        config["HOST_MANAGER"] = "changed"
+        self.assertEqual(self.config, config_store.resolve(ref))
+
+    def test_resolve_uses_worker_environment(self):
+        ref = config_store.reference(self.config)
+        config_store.reset()
+        os.environ["CONSUL_TOKEN"] = "worker-secret"
+        del os.environ["HOSTNAME"]
+        config = config_store.resolve(ref)
+        os.environ["HOSTNAME"] = "api-1"
+        self.assertEqual("worker-secret", config["CONSUL_TOKEN"])
+        self.assertEqual("fake", config["HOST_MANAGER"])
+        self.assertNotIn("HOSTNAME", config)
+
+    def test_resolve_not_found(self):
+        with self.assertRaises(config_store.ConfigNotFoundError):
+            config_store.resolve({"config_version": "abc123", "plan_name": None})
+
+    def test_resolve_full_config(self):
+        self.assertIs(self.config, config_store.resolve(self.config))
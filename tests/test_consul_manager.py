@@ -28,6 +28,34 @@ class ConsulManagerTestCase(unittest.TestCase):
             if token["ID"] not in (self.master_token, "anonymous"):
                 self.consul.acl.destroy(token["ID"])
 
+    def test_client_shared_between_managers(self):
+        other_manager = consul_manager.ConsulManager(os.environ)
+        self.assertIs(self.manager.client, other_manager.client)
+        self.assertIsInstance(self.manager.client.http, consul_manager.PooledHTTPClient)
+
+    def test_client_per_token(self):
+        config = dict(os.environ)
+        config["CONSUL_TOKEN"] = "other-token"
+        other_manager = consul_manager.ConsulManager(config)
+        self.assertIsNot(self.manager.client, other_manager.client)
+
+    def test_client_pool_settings(self):
+        config = dict(os.environ)
+        config.update({"CONSUL_TOKEN": "pool-settings-token", "CONSUL_POOL_SIZE": "3",
+                       "CONSUL_CONNECT_TIMEOUT": "1", "CONSUL_READ_TIMEOUT": "20"})
+        client = consul_manager.ConsulManager(config).client
+        self.assertEqual(3, client.http.adapter._pool_maxsize)
+        self.assertEqual((1.0, 20.0), client.http.timeout)
+
+    def test_connection_stats_reuse(self):
+        before = consul_manager.connection_stats()
+        for _ in range(5):
+            self.manager.write_healthcheck("myrpaas")
+        after = consul_manager.connection_stats()
+        self.assertEqual(5, after["requests"] - before["requests"])
+        self.assertLessEqual(after["connections"] - before["connections"], 1)
+        self.assertGreaterEqual(after["reused"] - before["reused"], 4)
+
     def test_generate_token(self):
         token = self.manager.generate_token("myrpaas")
         acl = self.consul.acl.info(token)
@@ -79,6 +107,94 @@ class ConsulManagerTestCase(unittest.TestCase):
         node_status = self.manager.node_status("myrpaas")
         self.assertDictEqual(node_status, {'my-server-1': 'service OK', 'my-server-2': 'service DEAD'})
 
+    def test_node_status_from_checks(self):
+        self.consul.agent.service.register("nginx", tags=["test-suite-rpaas", "myrpaas"])
+        self.addCleanup(self.consul.agent.service.deregister, "nginx")
+        self.consul.agent.check.register("rpaas-status", check=consul.Check.ttl("60s"),
+                                         service_id="nginx")
+        self.addCleanup(self.consul.agent.check.deregister, "rpaas-status")
+        self.consul.agent.check.ttl_pass("rpaas-status", notes="service OK")
+        self.consul.kv.put("test-suite-rpaas/myrpaas/status/my-server-1", "service DEAD")
+        config = dict(os.environ)
+        config["CONSUL_NODE_STATUS_MODE"] = "check"
+        manager = consul_manager.ConsulManager(config)
+        node_status = manager.node_status("myrpaas")
+        self.assertDictEqual(node_status, {'rpaas-test': 'service OK'})
+        self.assertDictEqual(manager.node_status("otherrpaas"), {})
+
+    def test_node_status_cache(self):
+        config = dict(os.environ)
+        config["CONSUL_NODE_STATUS_CACHE_TTL"] = "60"
+        manager = consul_manager.ConsulManager(config)
+        self.addCleanup(manager._invalidate_node_status, "myrpaas")
+        self.consul.kv.put("test-suite-rpaas/myrpaas/status/my-server-1", "service OK")
+        self.assertDictEqual(manager.node_status("myrpaas"), {'my-server-1': 'service OK'})
+        self.consul.kv.put("test-suite-rpaas/myrpaas/status/my-server-1", "service DEAD")
+        self.assertDictEqual(manager.node_status("myrpaas"), {'my-server-1': 'service OK'})
+        manager.remove_node("myrpaas", "my-server-2")
+        self.assertDictEqual(manager.node_status("myrpaas"), {'my-server-1': 'service DEAD'})
+
+    def test_remove_node_check_mode(self):
+        self.consul.kv.put("test-suite-rpaas/myrpaas/status/test-server", "service OK")
+        config = dict(os.environ)
+        config["CONSUL_NODE_STATUS_MODE"] = "check"
+        manager = consul_manager.ConsulManager(config)
+        manager.remove_node("myrpaas", "test-server")
+        item = self.consul.kv.get("test-suite-rpaas/myrpaas/status/test-server")
+        self.assertEqual(item[1]["Value"], "service OK")
+
+    def test_service_nodes_and_critical_nodes(self):
+        self.consul.agent.service.register("nginx", tags=["test-suite-rpaas", "myrpaas"],
+                                           check=consul.Check.ttl("60s"))
+        self.addCleanup(self.consul.agent.service.deregister, "nginx")
+        nodes = self.manager.service_nodes()
+        self.assertDictEqual(nodes, {"rpaas-test": {"address": "127.0.0.1", "instance": "myrpaas"}})
+        index, critical_nodes = self.manager.critical_nodes()
+        self.assertIn("rpaas-test", critical_nodes)
+        self.assertTrue(int(index) > 0)
+
+    def test_critical_nodes_warning_check(self):
+        self.consul.agent.service.register("nginx", tags=["test-suite-rpaas", "myrpaas"],
+                                           check=consul.Check.ttl("60s"))
+        self.addCleanup(self.consul.agent.service.deregister, "nginx")
+        self.consul.agent.check.ttl_pass("service:nginx")
+        _, critical_nodes = self.manager.critical_nodes()
+        self.assertNotIn("rpaas-test", critical_nodes)
+        self.consul.agent.check.ttl_warn("service:nginx")
+        _, critical_nodes = self.manager.critical_nodes()
+        self.assertIn("rpaas-test", critical_nodes)
+
+    def test_critical_nodes_ignores_other_services(self):
+        self.consul.agent.service.register("nginx", tags=["test-suite-rpaas", "myrpaas"],
+                                           check=consul.Check.ttl("60s"))
+        self.addCleanup(self.consul.agent.service.deregister, "nginx")
+        self.consul.agent.check.ttl_pass("service:nginx")
+        self.consul.agent.service.register("other", check=consul.Check.ttl("60s"))
+        self.addCleanup(self.consul.agent.service.deregister, "other")
+        _, critical_nodes = self.manager.critical_nodes()
+        self.assertNotIn("rpaas-test", critical_nodes)
+
+    def test_critical_nodes_node_checks(self):
+        checks = [{"Node": "vm-1", "CheckID": "serfHealth", "Status": "critical",
+                   "ServiceID": "", "ServiceName": ""},
+                  {"Node": "vm-2", "CheckID": "service:nginx", "Status": "warning",
+                   "ServiceID": "nginx", "ServiceName": "nginx", "ServiceTags": ["test-suite-rpaas", "x"]},
+                  {"Node": "vm-3", "CheckID": "service:nginx", "Status": "critical",
+                   "ServiceID": "nginx", "ServiceName": "nginx", "ServiceTags": ["other-rpaas", "y"]},
+                  {"Node": "vm-4", "CheckID": "service:other", "Status": "critical",
+                   "ServiceID": "other", "ServiceName": "other", "ServiceTags": []},
+                  {"Node": "vm-5", "CheckID": "service:nginx", "Status": "passing",
+                   "ServiceID": "nginx", "ServiceName": "nginx", "ServiceTags": ["test-suite-rpaas", "z"]}]
+        with mock.patch.object(self.manager.client.health, "state", return_value=("10", checks)) as state:
+            index, critical_nodes = self.manager.critical_nodes(index="9", wait="30s")
+        state.assert_called_once_with("any", index="9", wait="30s")
+        self.assertEqual("10", index)
+        self.assertEqual(set(["vm-1", "vm-2"]), critical_nodes)
+
+    def test_instance_from_tags(self):
+        self.assertEqual("myrpaas", self.manager.instance_from_tags(["test-suite-rpaas", "myrpaas"]))
+        self.assertEqual("test-suite-rpaas", self.manager.instance_from_tags(None))
+
     def test_write_healthcheck(self):
         self.manager.write_healthcheck("myrpaas")
         item = self.consul.kv.get("test-suite-rpaas/myrpaas/healthcheck")
@@ -119,6 +235,29 @@ class ConsulManagerTestCase(unittest.TestCase):
         item = self.consul.kv.get("test-suite-rpaas/myrpaas/locations/___admin___app_sites___")
         self.assertEqual("something nice", item[1]["Value"])
 
+    def test_binding_entries(self):
+        binding = {"paths": [{"path": "/", "destination": "http://myapp.tsuru.io"},
+                             {"path": "/admin/", "destination": None, "content": " something nice\n"}],
+                   "cert": "certificate\r\n", "key": "key"}
+        root_config = self.manager.config_manager.generate_host_config(path="/",
+                                                                       destination="http://myapp.tsuru.io")
+        expected = {"test-suite-rpaas/myrpaas/locations/ROOT": root_config,
+                    "test-suite-rpaas/myrpaas/locations/___admin___": "something nice"}
+        self.assertDictEqual(expected, self.manager.binding_entries("myrpaas", binding, False))
+        expected["test-suite-rpaas/myrpaas/ssl/cert"] = "certificate\n"
+        expected["test-suite-rpaas/myrpaas/ssl/key"] = "key"
+        self.assertDictEqual(expected, self.manager.binding_entries("myrpaas", binding))
+
+    def test_instance_entries(self):
+        self.manager.write_location("myrpaas", "/admin/", content="something nice")
+        self.manager.set_certificate("myrpaas", "certificate", "key")
+        self.manager.write_healthcheck("myrpaas")
+        self.manager.write_location("myrpaas2", "/", content="other instance")
+        expected = {"test-suite-rpaas/myrpaas/locations/___admin___": "something nice",
+                    "test-suite-rpaas/myrpaas/ssl/cert": "certificate",
+                    "test-suite-rpaas/myrpaas/ssl/key": "key"}
+        self.assertDictEqual(expected, self.manager.instance_entries("myrpaas"))
+
     def test_write_block_http_content(self):
         self.manager.write_block("myrpaas", "http",
                                  content=" something nice in http         \n")
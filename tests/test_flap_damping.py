@@ -0,0 +1,77 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+import redis
+
+from rpaas import flap_damping
+
+
+class FlapDampingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = redis.StrictRedis()
+        self.config = {
+            "FLAP_DAMPING_PREFIX": "flap_damping_test",
+            "FLAP_SAMPLE_INTERVAL": 10,
+            "FLAP_CONFIRM_FAILURES": 2,
+            "FLAP_CONFIRM_WINDOW": 3,
+            "FLAP_PENALTY": 1000,
+            "FLAP_HALF_LIFE": 100,
+            "FLAP_SUPPRESS_LIMIT": 2500,
+            "FLAP_REUSE_LIMIT": 1000,
+            "FLAP_MAX_PENALTY": 4000,
+        }
+        self.damping = flap_damping.FlapDamping(self.conn, self.config)
+        self.time_patcher = mock.patch("rpaas.flap_damping.time")
+        self.time = self.time_patcher.start()
+        self.time.time.return_value = 1000.0
+        self.clean()
+
+    def tearDown(self):
+        self.time_patcher.stop()
+        self.clean()
+
+    def clean(self):
+        for key in self.conn.keys("flap_damping_test:*"):
+            self.conn.delete(key)
+
+    def observe(self, now, failing, passing=()):
+        self.time.time.return_value = now
+        return self.damping.observe(failing, passing)
+
+    def test_observe_confirm_failures(self):
+        self.assertEqual((set(), set()), self.observe(1000, ["10.1.1.1"]))
+        self.assertEqual((set(), set()), self.observe(1005, ["10.1.1.1"]))
+        self.assertEqual((set(["10.1.1.1"]), set()), self.observe(1010, ["10.1.1.1"]))
+        self.assertEqual((set(), set()), self.observe(1020, [], ["10.1.1.1"]))
+        self.assertEqual((set(["10.1.1.1"]), set()), self.observe(1030, ["10.1.1.1"]))
+        self.assertEqual("101", self.conn.hget("flap_damping_test:node:10.1.1.1", "history"))
+
+    def test_observe_sample_replaced_in_interval(self):
+        self.observe(1000, ["10.1.1.1"])
+        self.observe(1005, [], ["10.1.1.1"])
+        self.assertEqual((set(), set()), self.observe(1010, ["10.1.1.1"]))
+        self.assertEqual("01", self.conn.hget("flap_damping_test:node:10.1.1.1", "history"))
+
+    def test_observe_ignores_unknown_passing_machines(self):
+        self.assertEqual((set(), set()), self.observe(1000, [], ["10.1.1.1"]))
+        self.assertEqual([], self.conn.keys("flap_damping_test:*"))
+
+    def test_observe_suppress_flapping(self):
+        for now in (1000, 1010, 1020):
+            self.observe(now, ["10.1.1.1"])
+            self.observe(now + 5, [], ["10.1.1.1"])
+        self.assertEqual((set(), set(["10.1.1.1"])), self.observe(1030, ["10.1.1.1"]))
+        self.assertEqual((set(), set(["10.1.1.1"])), self.observe(1100, ["10.1.1.1"]))
+        self.assertEqual((set(["10.1.1.1"]), set()), self.observe(1300, ["10.1.1.1"]))
+
+    def test_observe_max_penalty(self):
+        for now in range(1000, 1100, 10):
+            self.observe(now, ["10.1.1.1"])
+            self.observe(now + 5, [], ["10.1.1.1"])
+        penalty = float(self.conn.hget("flap_damping_test:node:10.1.1.1", "penalty"))
+        self.assertTrue(penalty <= 4000)
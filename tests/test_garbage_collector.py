@@ -0,0 +1,151 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from rpaas import storage, tasks
+
+tasks.app.conf.CELERY_ALWAYS_EAGER = True
+
+
+class CollectGarbageTaskTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {
+            "MONGO_DATABASE": "garbage_collector_test",
+            "RPAAS_SERVICE_NAME": "test_rpaas_gc",
+            "GC_BATCH_SIZE": 2,
+            "GC_BATCH_INTERVAL": 0,
+        }
+        self.storage = storage.MongoDBStorage(self.config)
+        colls = self.storage.db.collection_names(False)
+        for coll in colls:
+            self.storage.db.drop_collection(coll)
+        self.storage.store_instance_metadata("live", consul_token="abc")
+        self.storage.db[self.storage.quota_collection].insert({"_id": "team", "used": ["live", "quota-only"],
+                                                               "quota": 5})
+        self.storage.store_task("creating")
+        self.storage.store_task({"_id": "restore_10.1.1.1", "host": "10.1.1.1", "instance": "dead"})
+        self.storage.store_task({"_id": "restore_10.2.2.2", "host": "10.2.2.2", "instance": "live"})
+        self.storage.store_binding("live", "app.live")
+        self.storage.store_binding("dead", "app.dead")
+        self.storage.store_binding("dead2", "app.dead2")
+        self.storage.store_le_certificate("dead", "dead.tsuru.io")
+        self.storage.store_hc({"_id": "dead", "resource_name": "rpaas_dead"})
+        self.storage.db[self.storage.lb_collection].insert({"_id": "dead", "id": "lb-1",
+                                                            "address": "10.0.0.1", "manager": "fake"})
+        self.storage.db[self.storage.lb_collection].insert({"_id": "live", "id": "lb-2",
+                                                            "address": "10.0.0.2", "manager": "fake"})
+        self.storage.db[self.storage.hosts_collection].insert({"_id": "h1", "dns_name": "10.1.1.1",
+                                                               "manager": "fake", "group": "dead"})
+        self.storage.db[self.storage.hosts_collection].insert({"_id": "h2", "dns_name": "10.2.2.2",
+                                                               "manager": "fake", "group": "live"})
+        self.lb_patcher = mock.patch("rpaas.tasks.LoadBalancer")
+        self.host_patcher = mock.patch("rpaas.tasks.Host")
+        self.consul_patcher = mock.patch("rpaas.tasks.consul_manager.ConsulManager")
+        self.LoadBalancer = self.lb_patcher.start()
+        self.Host = self.host_patcher.start()
+        ConsulManager = self.consul_patcher.start()
+        self.consul_manager = ConsulManager.return_value
+        self.consul_manager.service_name = "test_rpaas_gc"
+        self.consul_manager.list_instances.return_value = set(["live", "creating", "dead", "dead2"])
+        self.consul_manager.list_tokens.return_value = {"live": "token-1", "dead": "token-2"}
+        self.consul_manager.service_nodes.return_value = {
+            "node-1": {"address": "10.1.1.1", "instance": "dead"},
+            "node-2": {"address": "10.2.2.2", "instance": "live"},
+            "node-3": {"address": "10.3.3.3", "instance": "test_rpaas_gc"},
+        }
+
+    def tearDown(self):
+        self.lb_patcher.stop()
+        self.host_patcher.stop()
+        self.consul_patcher.stop()
+
+    def test_collect_garbage_dry_run(self):
+        tasks.CollectGarbageTask().delay(self.config, dry_run=True)
+        reports = self.storage.list_gc_reports(10)
+        self.assertEqual(1, len(reports))
+        self.assertEqual("success", reports[0]["status"])
+        self.assertTrue(reports[0]["dry_run"])
+        self.assertDictEqual({
+            "bindings": ["dead", "dead2"],
+            "le_certificates": ["dead"],
+            "restore_tasks": ["dead"],
+            "hcs": ["dead"],
+            "load_balancers": ["dead"],
+            "hosts": ["dead"],
+            "consul_instances": ["dead", "dead2"],
+            "consul_tokens": ["dead"],
+            "consul_nodes": ["node-1"],
+        }, reports[0]["orphans"])
+        self.assertEqual({}, reports[0]["removed"])
+        self.assertIsNotNone(self.storage.find_binding("dead"))
+        self.assertFalse(self.LoadBalancer.from_dict.called)
+        self.assertFalse(self.Host.from_dict.called)
+        self.assertFalse(self.consul_manager.destroy_instance.called)
+
+    @mock.patch("rpaas.tasks.time")
+    def test_collect_garbage(self, time):
+        tasks.CollectGarbageTask().delay(self.config)
+        self.assertIsNotNone(self.storage.find_binding("live"))
+        self.assertIsNone(self.storage.find_binding("dead"))
+        self.assertIsNone(self.storage.find_binding("dead2"))
+        self.assertEqual([], list(self.storage.find_le_certificates({"name": "dead"})))
+        self.assertEqual(["restore_10.2.2.2"],
+                         [t["_id"] for t in self.storage.find_task({"host": {"$exists": True}})])
+        self.assertEqual(1, self.LoadBalancer.from_dict.call_count)
+        self.assertEqual("dead", self.LoadBalancer.from_dict.call_args[0][0]["_id"])
+        self.LoadBalancer.from_dict.return_value.destroy.assert_called_once_with()
+        self.assertEqual(1, self.Host.from_dict.call_count)
+        self.assertEqual("h1", self.Host.from_dict.call_args[0][0]["_id"])
+        self.Host.from_dict.return_value.destroy.assert_called_once_with()
+        self.consul_manager.remove_node.assert_called_once_with("dead", "node-1")
+        self.consul_manager.destroy_token.assert_called_once_with("token-2")
+        self.assertEqual([mock.call("dead"), mock.call("dead2")],
+                         self.consul_manager.destroy_instance.mock_calls)
+        reports = self.storage.list_gc_reports(10)
+        self.assertEqual(2, reports[0]["removed"]["bindings"])
+        self.assertEqual(1, reports[0]["removed"]["hosts"])
+        self.assertFalse(time.sleep.called)
+
+    @mock.patch("rpaas.tasks.time")
+    def test_collect_garbage_rate_limited(self, time):
+        self.config["GC_BATCH_SIZE"] = 1
+        self.config["GC_BATCH_INTERVAL"] = 2
+        tasks.CollectGarbageTask().delay(self.config)
+        self.assertEqual([mock.call(2.0), mock.call(2.0)], time.sleep.mock_calls)
+
+    @mock.patch("rpaas.tasks.time")
+    def test_collect_garbage_instance_created_while_listing(self, time):
+        def list_tokens():
+            self.storage.store_instance_metadata("dead", consul_token="token-2")
+            return {"live": "token-1", "dead": "token-2"}
+        self.consul_manager.list_tokens.side_effect = list_tokens
+        tasks.CollectGarbageTask().delay(self.config)
+        self.assertIsNotNone(self.storage.find_binding("dead"))
+        self.assertFalse(self.LoadBalancer.from_dict.called)
+        self.assertFalse(self.Host.from_dict.called)
+        self.assertFalse(self.consul_manager.remove_node.called)
+        self.assertFalse(self.consul_manager.destroy_token.called)
+        self.assertEqual([mock.call("dead2")], self.consul_manager.destroy_instance.mock_calls)
+
+    @mock.patch("rpaas.tasks.time")
+    def test_collect_garbage_instance_created_while_removing(self, time):
+        def remove_node(instance, node):
+            self.storage.store_instance_metadata("dead2", consul_token="token-3")
+        self.consul_manager.remove_node.side_effect = remove_node
+        self.config["GC_BATCH_SIZE"] = 1
+        tasks.CollectGarbageTask().delay(self.config)
+        self.assertEqual([mock.call("dead")], self.consul_manager.destroy_instance.mock_calls)
+        reports = self.storage.list_gc_reports(10)
+        self.assertEqual(1, reports[0]["removed"]["consul_instances"])
+
+    def test_collect_garbage_removal_errors(self):
+        self.consul_manager.destroy_instance.side_effect = [Exception("consul error"), None]
+        tasks.CollectGarbageTask().delay(self.config)
+        reports = self.storage.list_gc_reports(10)
+        self.assertEqual("success", reports[0]["status"])
+        self.assertEqual(1, reports[0]["removed"]["consul_instances"])
@@ -3,6 +3,7 @@
 # license that can be found in the LICENSE file.
 
 import datetime
+import json
 import time
 import unittest
 import redis
@@ -10,7 +11,7 @@ import redis
 from freezegun import freeze_time
 from mock import patch, call
 from rpaas import storage, tasks
-from rpaas import healing, consul_manager
+from rpaas import circuit_breaker, healing, consul_manager, lease
 from hm import managers, log
 from hm.model.host import Host
 from requests.exceptions import ConnectionError
@@ -70,15 +71,15 @@ class RestoreMachineTestCase(unittest.TestCase):
         now = datetime.datetime.utcnow()
         tasks = [
             {"_id": "restore_10.1.1.1", "host": "10.1.1.1", "instance": "foo",
-             "created": now - datetime.timedelta(minutes=8)},
+             "created": now - datetime.timedelta(minutes=15)},
             {"_id": "restore_10.2.2.2", "host": "10.2.2.2", "instance": "bar",
              "created": now - datetime.timedelta(minutes=3)},
             {"_id": "restore_10.3.3.3", "host": "10.3.3.3", "instance": "foo",
-             "created": now - datetime.timedelta(minutes=5)},
-            {"_id": "restore_10.4.4.4", "host": "10.4.4.4", "instance": "foo",
              "created": now - datetime.timedelta(minutes=10)},
+            {"_id": "restore_10.4.4.4", "host": "10.4.4.4", "instance": "foo",
+             "created": now - datetime.timedelta(minutes=8)},
             {"_id": "restore_10.5.5.5", "host": "10.5.5.5", "instance": "bar",
-             "created": now - datetime.timedelta(minutes=15)},
+             "created": now - datetime.timedelta(minutes=6)},
         ]
         FakeManager.host_id = 0
         FakeManager.hosts = ['10.1.1.1', '10.2.2.2', '10.3.3.3', '10.4.4.4', '10.5.5.5']
@@ -87,10 +88,13 @@ class RestoreMachineTestCase(unittest.TestCase):
             Host.create("fake", task['instance'], self.config)
             self.storage.store_task(task)
 
-        redis.StrictRedis().delete("restore_machine:last_run")
+        redis.StrictRedis().zrem("rpaas_scheduler:jobs", "restore_machine")
 
     def tearDown(self):
-        redis.StrictRedis().delete("restore_lock")
+        conn = redis.StrictRedis()
+        conn.delete("restore_lock", "restore_lock:fence")
+        for key in conn.keys("restore_lease:*") + conn.keys("restore_breaker:*"):
+            conn.delete(key)
         FakeManager.fail_ids = []
 
     @patch("rpaas.tasks.nginx")
@@ -133,24 +137,24 @@ class RestoreMachineTestCase(unittest.TestCase):
         time.sleep(1)
         restorer.stop()
         tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
-        self.assertListEqual(['restore_10.2.2.2', 'restore_10.3.3.3',
-                              'restore_10.4.4.4', 'restore_10.5.5.5'], tasks)
-        self.assertEqual(log.info.call_args_list, [call("Machine 0 restored")])
-        self.assertEqual(nginx_manager.wait_healthcheck.call_args_list, [call('10.1.1.1', timeout=600)])
+        self.assertListEqual(['restore_10.2.2.2', 'restore_10.3.3.3', 'restore_10.4.4.4'], tasks)
+        self.assertEqual(log.info.call_args_list, [call("Machine 0 restored"), call("Machine 4 restored")])
+        self.assertEqual(nginx_manager.wait_healthcheck.call_args_list, [call('10.1.1.1', timeout=600),
+                                                                         call('10.5.5.5', timeout=600)])
         log.reset_mock()
         nginx.reset_mock()
-        redis.StrictRedis().delete("restore_machine:last_run")
+        redis.StrictRedis().zrem("rpaas_scheduler:jobs", "restore_machine")
         restorer = healing.RestoreMachine(self.config)
         restorer.start()
         time.sleep(1)
         restorer.stop()
         tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
-        self.assertEqual(log.info.call_args_list, [call("Machine 4 restored")])
-        self.assertEqual(nginx_manager.wait_healthcheck.call_args_list, [call('10.5.5.5', timeout=600)])
+        self.assertEqual(log.info.call_args_list, [])
+        self.assertEqual(nginx_manager.wait_healthcheck.call_args_list, [])
         self.assertListEqual(['restore_10.2.2.2', 'restore_10.3.3.3', 'restore_10.4.4.4'], tasks)
         log.reset_mock()
         nginx.reset_mock()
-        redis.StrictRedis().delete("restore_machine:last_run")
+        redis.StrictRedis().zrem("rpaas_scheduler:jobs", "restore_machine")
         FakeManager.fail_ids = []
         with freeze_time("2016-02-03 12:06:00"):
             restorer = healing.RestoreMachine(self.config)
@@ -158,11 +162,11 @@ class RestoreMachineTestCase(unittest.TestCase):
             time.sleep(1)
             restorer.stop()
             tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
-            self.assertEqual(log.info.call_args_list, [call("Machine 1 restored"), call("Machine 2 restored"),
-                                                       call("Machine 3 restored")])
-            nginx_expected_calls = [call('10.2.2.2', timeout=600),
-                                    call('10.3.3.3', timeout=600),
-                                    call('10.4.4.4', timeout=600)]
+            self.assertEqual(log.info.call_args_list, [call("Machine 2 restored"), call("Machine 3 restored"),
+                                                       call("Machine 1 restored")])
+            nginx_expected_calls = [call('10.3.3.3', timeout=600),
+                                    call('10.4.4.4', timeout=600),
+                                    call('10.2.2.2', timeout=600)]
             self.assertEqual(nginx_expected_calls, nginx_manager.wait_healthcheck.call_args_list)
             self.assertListEqual(tasks, [])
 
@@ -217,45 +221,275 @@ class RestoreMachineTestCase(unittest.TestCase):
         time.sleep(1)
         restorer.stop()
         tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
-        self.assertListEqual(['restore_10.2.2.2', 'restore_10.3.3.3',
-                              'restore_10.4.4.4', 'restore_10.5.5.5'], tasks)
-        self.assertEqual(log.info.call_args_list, [call("Machine 0 restored")])
-        self.assertEqual(nginx_manager.wait_healthcheck.call_args_list, [call('10.1.1.1', timeout=600)])
+        self.assertListEqual(['restore_10.2.2.2', 'restore_10.3.3.3', 'restore_10.4.4.4'], tasks)
+        self.assertEqual(log.info.call_args_list, [call("Machine 0 restored"), call("Machine 4 restored")])
+        self.assertEqual(nginx_manager.wait_healthcheck.call_args_list, [call('10.1.1.1', timeout=600),
+                                                                         call('10.5.5.5', timeout=600)])
         self.assertTrue(redis_lock.acquire(blocking=False))
         redis_lock.release()
 
-    @patch.object(storage.MongoDBStorage, "store_healing")
-    @patch.object(storage.MongoDBStorage, "update_healing")
-    @patch.object(tasks.RestoreMachineTask, "_redis_extend_lock")
     @patch("rpaas.tasks.nginx")
     @patch("hm.log.logging")
-    def test_restore_machine_extending_time_btw_restores(self, log, nginx, extend_lock, update_healing,
-                                                         store_healing):
-        time_now = datetime.datetime.utcnow()
-        with patch.object(tasks.datetime.datetime, 'utcnow') as mock_time_now:
-            time_side_effect = []
-            for x in range(9):
-                time_side_effect.append(time_now + datetime.timedelta(seconds=10 * x))
-            mock_time_now.side_effect = time_side_effect
-            nginx_manager = nginx.Nginx.return_value
-            restorer = healing.RestoreMachine(self.config)
-            restorer.start()
-            time.sleep(1)
-            restorer.stop()
-            self.assertEqual(extend_lock.call_args_list, [call(extra_time=10), call(extra_time=10),
-                                                          call(extra_time=10)])
-            nginx_expected_calls = [call('10.1.1.1', timeout=600), call('10.3.3.3', timeout=600),
-                                    call('10.4.4.4', timeout=600), call('10.5.5.5', timeout=600)]
-            self.assertEqual(nginx_expected_calls, nginx_manager.wait_healthcheck.call_args_list)
-            tasks_restore = []
-            for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}}):
-                tasks_restore.append(task['_id'])
-            self.assertListEqual(tasks_restore, ['restore_10.2.2.2'])
+    def test_restore_machine_skip_leased_machines(self, log, nginx):
+        self.config["RESTORE_MACHINE_INSTANCE_CONCURRENCY"] = 2
+        leases = lease.RestoreLeases(redis.StrictRedis(), self.config)
+        token = leases.acquire("10.4.4.4", "foo")
+        self.assertIsNotNone(token)
+        nginx_manager = nginx.Nginx.return_value
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        nginx_expected_calls = [call('10.1.1.1', timeout=600), call('10.3.3.3', timeout=600),
+                                call('10.5.5.5', timeout=600)]
+        self.assertEqual(nginx_expected_calls, nginx_manager.wait_healthcheck.call_args_list)
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, ['restore_10.2.2.2', 'restore_10.4.4.4'])
+        self.assertTrue(leases.release("10.4.4.4", "foo", token))
+
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_skip_tasks_with_newer_fence(self, log, nginx):
+        fence = redis.StrictRedis().incr("restore_lock:fence") + 10
+        self.storage.update_task("restore_10.4.4.4", {"fence": fence})
+        nginx_manager = nginx.Nginx.return_value
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        nginx_expected_calls = [call('10.1.1.1', timeout=600), call('10.3.3.3', timeout=600),
+                                call('10.5.5.5', timeout=600)]
+        self.assertEqual(nginx_expected_calls, nginx_manager.wait_healthcheck.call_args_list)
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, ['restore_10.2.2.2', 'restore_10.4.4.4'])
+        self.assertEqual([], redis.StrictRedis().keys("restore_lease:host:*"))
+
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_priority(self, log, nginx):
+        self.storage.remove_task({"_id": "restore_10.4.4.4"})
+        nginx_manager = nginx.Nginx.return_value
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        nginx_expected_calls = [call('10.5.5.5', timeout=600), call('10.1.1.1', timeout=600),
+                                call('10.3.3.3', timeout=600)]
+        self.assertEqual(nginx_expected_calls, nginx_manager.wait_healthcheck.call_args_list)
+
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_zone_concurrency(self, log, nginx):
+        self.config["RESTORE_MACHINE_ZONE_CONCURRENCY"] = 1
+        self.config["RESTORE_MACHINE_INSTANCE_CONCURRENCY"] = 2
+        leases = lease.RestoreLeases(redis.StrictRedis(), self.config)
+        token = leases.acquire("10.9.9.9", "other", "fake:0")
+        nginx_manager = nginx.Nginx.return_value
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        self.assertEqual([], nginx_manager.wait_healthcheck.call_args_list)
+        self.assertTrue(leases.release("10.9.9.9", "other", token, "fake:0"))
+
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_circuit_breaker(self, log, nginx):
+        self.config["RESTORE_BREAKER_MIN_FAILURES"] = 1
+        FakeManager.fail_ids = [0]
+        nginx_manager = nginx.Nginx.return_value
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        self.assertEqual([], nginx_manager.wait_healthcheck.call_args_list)
+        self.assertEqual("open", circuit_breaker.CircuitBreaker(redis.StrictRedis(), self.config).state())
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(['restore_10.1.1.1', 'restore_10.2.2.2', 'restore_10.3.3.3',
+                              'restore_10.4.4.4', 'restore_10.5.5.5'], tasks)
+
+    @patch.object(tasks.RestoreHostTask, "_delete_host")
+    @patch.object(tasks.RestoreHostTask, "_add_host")
+    @patch("rpaas.tasks.LoadBalancer")
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_replace_policy(self, log, nginx, LoadBalancer, add_host, delete_host):
+        self.config["RESTORE_MACHINE_POLICY"] = "replace"
+        self.config["INSTANCE_EXTRA_TAGS"] = "env:test"
+        self.storage.db[self.storage.tasks_collection].remove({"_id": {"$ne": "restore_10.1.1.1"}})
+        self.storage.db[self.storage.plans_collection].insert({"_id": "huge", "description": "huge plan",
+                                                               "config": {"serviceofferingid": "huge"}})
+        self.storage.store_instance_metadata("foo", plan_name="huge", consul_token="foo-token")
+        instance_tasks = []
+
+        def replace_host(name, lb, finish_task=True):
+            instance_tasks.extend(self.storage.find_task("foo"))
+            return Host(id=9, dns_name="10.9.9.9")
+        add_host.side_effect = replace_host
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        self.assertEqual([], log.info.call_args_list)
+        lb = LoadBalancer.find.return_value
+        self.assertEqual(1, LoadBalancer.find.call_count)
+        self.assertEqual("foo", LoadBalancer.find.call_args[0][0])
+        instance_config = LoadBalancer.find.call_args[0][1]
+        self.assertEqual("huge", instance_config["serviceofferingid"])
+        self.assertEqual("rpaas_service:test_rpaas_machine_restore,rpaas_instance:foo,"
+                         "consul_token:foo-token,env:test", instance_config["HOST_TAGS"])
+        self.assertEqual("env:test", self.config["INSTANCE_EXTRA_TAGS"])
+        add_host.assert_called_once_with("foo", lb, finish_task=False)
+        self.assertEqual(1, len(instance_tasks))
+        self.assertIn("fence", instance_tasks[0])
+        self.assertEqual([], list(self.storage.find_task("foo")))
+        self.assertEqual(1, delete_host.call_count)
+        self.assertEqual("foo", delete_host.call_args[0][0])
+        self.assertEqual("10.1.1.1", delete_host.call_args[0][1].dns_name)
+        self.assertEqual((lb,), delete_host.call_args[0][2:])
+        event = self.storage.db[self.storage.healing_collection].find_one({"machine": "10.1.1.1"})
+        self.assertEqual("success", event["status"])
+        self.assertEqual("replace", event["path"])
+        self.assertEqual("10.9.9.9", event["replacement"])
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual([], tasks)
+
+    @patch.object(tasks.RestoreHostTask, "_delete_host")
+    @patch.object(tasks.RestoreHostTask, "_add_host")
+    @patch("rpaas.tasks.LoadBalancer")
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_restore_then_replace_policy(self, log, nginx, LoadBalancer, add_host,
+                                                         delete_host):
+        self.config["RESTORE_MACHINE_POLICY"] = "restore_then_replace"
+        self.storage.store_instance_metadata("foo", consul_token="foo-token")
+        FakeManager.fail_ids = [0]
+        add_host.return_value = Host(id=9, dns_name="10.9.9.9")
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        self.assertEqual(log.info.call_args_list, [call("Machine 2 restored"), call("Machine 3 restored"),
+                                                   call("Machine 4 restored")])
+        add_host.assert_called_once_with("foo", LoadBalancer.find.return_value, finish_task=False)
+        healings = self.storage.db[self.storage.healing_collection]
+        event = healings.find_one({"machine": "10.1.1.1"})
+        self.assertEqual("success", event["status"])
+        self.assertEqual("restore_then_replace", event["path"])
+        self.assertEqual("10.9.9.9", event["replacement"])
+        self.assertIn("iaas restore error", event["restore_error"])
+        self.assertEqual("restore", healings.find_one({"machine": "10.3.3.3"})["path"])
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(['restore_10.2.2.2'], tasks)
+
+    @patch.object(tasks.RestoreHostTask, "_delete_host")
+    @patch.object(tasks.RestoreHostTask, "_add_host")
+    @patch("rpaas.tasks.LoadBalancer")
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_replace_policy_instance_busy(self, log, nginx, LoadBalancer, add_host,
+                                                          delete_host):
+        self.config["RESTORE_MACHINE_POLICY"] = "replace"
+        self.storage.db[self.storage.tasks_collection].remove({"_id": {"$ne": "restore_10.1.1.1"}})
+        self.storage.store_instance_metadata("foo", consul_token="foo-token")
+        self.storage.store_task({"_id": "foo", "desired_quantity": 3})
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        self.assertFalse(add_host.called)
+        self.assertFalse(delete_host.called)
+        event = self.storage.db[self.storage.healing_collection].find_one({"machine": "10.1.1.1"})
+        self.assertEqual("postponed: Async task still running", event["status"])
+        self.assertEqual([{"_id": "foo", "desired_quantity": 3}], list(self.storage.find_task("foo")))
+        restore_tasks = list(self.storage.find_task({"_id": {"$regex": "restore_.+"}}))
+        self.assertListEqual(['restore_10.1.1.1'], [task['_id'] for task in restore_tasks])
+        self.assertNotIn("last_attempt", restore_tasks[0])
+        self.assertEqual([], redis.StrictRedis().keys("restore_breaker:*"))
+
+    @patch.object(tasks.RestoreHostTask, "_delete_host")
+    @patch.object(tasks.RestoreHostTask, "_add_host")
+    @patch("rpaas.tasks.LoadBalancer")
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_replace_policy_instance_locked(self, log, nginx, LoadBalancer, add_host,
+                                                            delete_host):
+        self.config["RESTORE_MACHINE_POLICY"] = "replace"
+        self.storage.db[self.storage.tasks_collection].remove({"_id": {"$ne": "restore_10.1.1.1"}})
+        self.storage.store_instance_metadata("foo", consul_token="foo-token")
+        task_lock = lease.LeaseLock(redis.StrictRedis(), "task_lock:foo", 60)
+        self.assertIsNotNone(task_lock.acquire())
+        self.addCleanup(task_lock.release)
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        self.assertFalse(add_host.called)
+        self.assertEqual([], list(self.storage.find_task("foo")))
+
+    @patch.object(lease.RestoreLeases, "heartbeat")
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_heartbeat_lease(self, log, nginx, heartbeat):
+        FakeManager.fail_ids = [4]
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        self.assertEqual(4, heartbeat.call_count)
+        self.assertEqual(["10.1.1.1", "10.3.3.3", "10.4.4.4", "10.5.5.5"],
+                         [c[0][0] for c in heartbeat.call_args_list])
+        self.assertEqual(4, heartbeat.return_value.stop.call_count)
+        leases = lease.RestoreLeases(redis.StrictRedis(), self.config)
+        for host, instance in [("10.1.1.1", "foo"), ("10.5.5.5", "bar")]:
+            token = leases.acquire(host, instance)
+            self.assertIsNotNone(token)
+            leases.release(host, instance, token)
+
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_host_lease_expired_while_queued(self, log, nginx):
+        tasks.RestoreHostTask().delay(self.config, "restore_10.1.1.1", "expired-token")
+        self.assertFalse(log.info.called)
+        self.assertFalse(nginx.Nginx.return_value.wait_healthcheck.called)
+        self.assertEqual(0, self.storage.db[self.storage.healing_collection].count())
+        self.assertEqual(1, len(list(self.storage.find_task("restore_10.1.1.1"))))
+
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_host_fence_changed(self, log, nginx):
+        leases = lease.RestoreLeases(redis.StrictRedis(), self.config)
+        token = leases.acquire("10.1.1.1", "foo")
+        self.storage.update_task("restore_10.1.1.1", {"fence": 2})
+        tasks.RestoreHostTask().delay(self.config, "restore_10.1.1.1", token, None, 1)
+        self.assertFalse(log.info.called)
+        self.assertFalse(nginx.Nginx.return_value.wait_healthcheck.called)
+        self.assertEqual(0, self.storage.db[self.storage.healing_collection].count())
+        self.assertEqual(1, len(list(self.storage.find_task("restore_10.1.1.1"))))
+        self.assertIsNone(redis.StrictRedis().get("restore_lease:host:10.1.1.1"))
+
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_host_fence_changed_after_restore(self, log, nginx):
+        leases = lease.RestoreLeases(redis.StrictRedis(), self.config)
+        token = leases.acquire("10.1.1.1", "foo")
+        self.storage.update_task("restore_10.1.1.1", {"fence": 1})
+
+        def restore_host(id):
+            self.storage.update_task("restore_10.1.1.1", {"fence": 2})
+        with patch.object(FakeManager, "restore_host", side_effect=restore_host), \
+                patch.object(FakeManager, "start_host") as start_host:
+            tasks.RestoreHostTask().delay(self.config, "restore_10.1.1.1", token, None, 1)
+        self.assertFalse(start_host.called)
+        self.assertFalse(nginx.Nginx.return_value.wait_healthcheck.called)
+        event = self.storage.db[self.storage.healing_collection].find_one({"machine": "10.1.1.1"})
+        self.assertIn("aborted", event["status"])
+        self.assertEqual(1, len(list(self.storage.find_task("restore_10.1.1.1"))))
+        self.assertEqual(0, len(redis.StrictRedis().keys("restore_breaker:*")))
 
-    @patch.object(tasks.RestoreMachineTask, "_redis_extend_lock")
     @patch("rpaas.tasks.nginx")
     @patch("hm.log.logging")
-    def test_restore_machine_store_healing_events(self, log, nginx, extend_lock):
+    def test_restore_machine_store_healing_events(self, log, nginx):
         time_now = datetime.datetime.utcnow()
 
         def healing_time(x):
@@ -270,12 +504,12 @@ class RestoreMachineTestCase(unittest.TestCase):
             restorer.start()
             time.sleep(1)
             restorer.stop()
-            expected_healings = [{'end_time': healing_time(40), 'machine': '10.1.1.1',
+            expected_healings = [{'end_time': healing_time(20), 'machine': '10.1.1.1',
+                                  'start_time': healing_time(10), 'status': 'success'},
+                                 {'end_time': healing_time(40), 'machine': '10.3.3.3',
                                   'start_time': healing_time(30), 'status': 'success'},
-                                 {'end_time': healing_time(80), 'machine': '10.3.3.3',
-                                  'start_time': healing_time(70), 'status': 'success'},
-                                 {'end_time': healing_time(120), 'machine': '10.4.4.4',
-                                  'start_time': healing_time(110), 'status': 'success'}]
+                                 {'end_time': healing_time(60), 'machine': '10.4.4.4',
+                                  'start_time': healing_time(50), 'status': 'success'}]
             foo_instances_healings = []
             filter_fields = {"status": 1, "start_time": 1, "machine": 1, "end_time": 1}
             healing_collection = self.storage.db[self.storage.healing_collection]
@@ -283,8 +517,8 @@ class RestoreMachineTestCase(unittest.TestCase):
                 del event['_id']
                 foo_instances_healings.append(event)
             self.assertListEqual(foo_instances_healings, expected_healings)
-            expected_healings = [{'end_time': healing_time(160), 'machine': '10.5.5.5',
-                                  'start_time': healing_time(150), 'status': 'iaas restore error'}]
+            expected_healings = [{'end_time': healing_time(80), 'machine': '10.5.5.5',
+                                  'start_time': healing_time(70), 'status': 'iaas restore error'}]
             bar_instances_healings = []
             for event in healing_collection.find({"instance": "bar"}, filter_fields):
                 del event['_id']
@@ -301,6 +535,8 @@ class CheckMachineTestCase(unittest.TestCase):
             "RPAAS_SERVICE_NAME": "test_rpaas_check_machine",
             "RESTORE_MACHINE_RUN_INTERVAL": 2,
             "HOST_MANAGER": "fake",
+            "FLAP_DAMPING_PREFIX": "flap_damping_test",
+            "FLAP_CONFIRM_FAILURES": 1,
         }
 
         self.storage = storage.MongoDBStorage(self.config)
@@ -321,14 +557,29 @@ class CheckMachineTestCase(unittest.TestCase):
         FakeManager.host_id = 0
         FakeManager.hosts = ['10.1.1.1', '10.2.2.2', '10.3.3.3']
 
-        redis.StrictRedis().delete("check_machine:last_run")
+        self.clean_redis()
 
     def tearDown(self):
         self.storage.db[self.storage.tasks_collection].remove()
         self.storage.db[self.storage.hosts_collection].remove()
+        self.clean_redis()
 
+    def clean_redis(self):
+        conn = redis.StrictRedis()
+        conn.delete("check_machine:state")
+        for key in conn.keys("flap_damping_test:*"):
+            conn.delete(key)
+
+    def _run_checker(self):
+        checker = healing.CheckMachine(self.config)
+        checker.start()
+        time.sleep(1)
+        checker.stop()
+
+    @patch.object(consul_manager.ConsulManager, "service_nodes")
+    @patch.object(consul_manager.ConsulManager, "critical_nodes")
     @patch.object(consul_manager.ConsulManager, "service_healthcheck")
-    def test_check_machine_instance_failures(self, service_healthcheck):
+    def test_check_machine_instance_failures(self, service_healthcheck, critical_nodes, service_nodes):
         healthcheck = [{'Node': {'Address': '10.1.1.1'},
                         'Checks': [{'CheckId': 1, 'Status': 'passing'},
                                    {'CheckId': 2, 'Status': 'critical'},
@@ -349,17 +600,156 @@ class CheckMachineTestCase(unittest.TestCase):
                                    {'CheckId': 2, 'Status': 'critical'}],
                         'Service': {'Service': 'nginx', 'Tags': ['another_rpaas', 'rpaas_04']}}]
         service_healthcheck.return_value = healthcheck
-        checker = healing.CheckMachine(self.config)
-        checker.start()
-        time.sleep(1)
-        checker.stop()
+        critical_nodes.return_value = ("10", set(["vm-1", "vm-3"]))
+        service_nodes.return_value = {"vm-1": {"address": "10.1.1.1", "instance": "rpaas_01"},
+                                      "vm-3": {"address": "10.3.3.3", "instance": "rpaas_03"}}
+        self._run_checker()
         tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
         self.assertListEqual(tasks, ['restore_10.1.1.1', 'restore_10.3.3.3'])
+        self.assertFalse(service_healthcheck.called)
+
+    @patch.object(consul_manager.ConsulManager, "service_nodes")
+    @patch.object(consul_manager.ConsulManager, "critical_nodes")
+    @patch.object(consul_manager.ConsulManager, "service_healthcheck")
+    def test_check_machine_empty_healthcheck(self, service_healthcheck, critical_nodes, service_nodes):
+        service_healthcheck.return_value = []
+        critical_nodes.return_value = ("10", set())
+        service_nodes.return_value = {}
+        self._run_checker()
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, [])
+
+    @patch.object(consul_manager.ConsulManager, "service_nodes")
+    @patch.object(consul_manager.ConsulManager, "critical_nodes")
+    @patch.object(consul_manager.ConsulManager, "service_healthcheck")
+    def test_check_machine_only_changed_nodes(self, service_healthcheck, critical_nodes, service_nodes):
+        redis.StrictRedis().set("check_machine:state",
+                                json.dumps({"index": 5, "failing": {"10.2.2.2": "rpaas_02"}}))
+        self.storage.store_task({"_id": "restore_10.2.2.2", "host": "10.2.2.2", "instance": "rpaas_02"})
+        critical_nodes.return_value = ("6", set(["vm-1", "vm-3", "other-service-node"]))
+        service_nodes.return_value = {"vm-1": {"address": "10.1.1.1", "instance": "rpaas_01"},
+                                      "vm-2": {"address": "10.2.2.2", "instance": "rpaas_02"},
+                                      "vm-3": {"address": "10.3.3.3", "instance": "rpaas_02"}}
+        self._run_checker()
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, ['restore_10.1.1.1', 'restore_10.3.3.3'])
+        self.assertEqual(self.storage.find_task("restore_10.3.3.3")[0]["instance"], "rpaas_02")
+        service_healthcheck.assert_not_called()
+        state = json.loads(redis.StrictRedis().get("check_machine:state"))
+        self.assertDictEqual(state, {"index": 6, "failing": {"10.1.1.1": "rpaas_01",
+                                                             "10.3.3.3": "rpaas_02"}})
+
+    @patch.object(consul_manager.ConsulManager, "service_nodes")
+    @patch.object(consul_manager.ConsulManager, "critical_nodes")
+    def test_check_machine_index_already_handled(self, critical_nodes, service_nodes):
+        redis.StrictRedis().set("check_machine:state",
+                                json.dumps({"index": 6, "failing": {"10.1.1.1": "rpaas_01"}}))
+        critical_nodes.return_value = ("6", set(["vm-1"]))
+        service_nodes.return_value = {"vm-1": {"address": "10.1.1.1", "instance": "rpaas_01"}}
+        self._run_checker()
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, [])
+
+    @patch.object(consul_manager.ConsulManager, "service_nodes")
+    @patch.object(consul_manager.ConsulManager, "critical_nodes")
+    def test_check_machine_index_moved_backwards(self, critical_nodes, service_nodes):
+        redis.StrictRedis().set("check_machine:state", json.dumps({"index": 7, "failing": {}}))
+        critical_nodes.return_value = ("6", set(["vm-1"]))
+        service_nodes.return_value = {"vm-1": {"address": "10.1.1.1", "instance": "rpaas_01"}}
+        self._run_checker()
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, ['restore_10.1.1.1'])
+        state = json.loads(redis.StrictRedis().get("check_machine:state"))
+        self.assertDictEqual(state, {"index": 6, "failing": {"10.1.1.1": "rpaas_01"}})
+
+    @patch.object(consul_manager.ConsulManager, "service_nodes")
+    def test_check_machine_resync(self, service_nodes):
+        self.config["CHECK_MACHINE_RESYNC_INTERVAL"] = 0
+        redis.StrictRedis().set("check_machine:state",
+                                json.dumps({"index": 6, "failing": {"10.1.1.1": "rpaas_01"}}))
+        self.storage.store_task({"_id": "restore_10.2.2.2", "host": "10.2.2.2", "instance": "rpaas_02"})
+        service_nodes.return_value = {"vm-1": {"address": "10.1.1.1", "instance": "rpaas_01"},
+                                      "vm-2": {"address": "10.2.2.2", "instance": "rpaas_02"}}
+        checker = healing.CheckMachine(self.config)
+        checker.check_nodes("6", set(["vm-1"]))
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, ['restore_10.1.1.1'])
 
-    def test_check_machine_empty_healthcheck(self):
+    @patch.object(consul_manager.ConsulManager, "service_nodes")
+    def test_check_machine_state_stored_after_dispatch(self, service_nodes):
+        redis.StrictRedis().set("check_machine:state", json.dumps({"index": 5, "failing": {}}))
+        service_nodes.return_value = {"vm-1": {"address": "10.1.1.1", "instance": "rpaas_01"}}
+        checker = healing.CheckMachine(self.config)
+        with patch("rpaas.tasks.CheckMachineTask.delay") as delay:
+            delay.side_effect = Exception("broker down")
+            with self.assertRaises(Exception):
+                checker.check_nodes("6", set(["vm-1"]))
+        state = json.loads(redis.StrictRedis().get("check_machine:state"))
+        self.assertDictEqual(state, {"index": 5, "failing": {}})
+        checker.check_nodes("6", set(["vm-1"]))
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, ['restore_10.1.1.1'])
+
+    @patch.object(consul_manager.ConsulManager, "service_nodes")
+    def test_check_machine_not_leader(self, service_nodes):
+        service_nodes.return_value = {"vm-1": {"address": "10.1.1.1", "instance": "rpaas_01"}}
+        leader = [False]
+        checker = healing.CheckMachine(self.config, leader=lambda: leader[0])
+        checker.check_nodes("6", set(["vm-1"]))
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, [])
+        self.assertIsNone(redis.StrictRedis().get("check_machine:state"))
+        leader[0] = True
+        checker.check_nodes("6", set(["vm-1"]))
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, ['restore_10.1.1.1'])
+
+    @patch.object(consul_manager.ConsulManager, "service_nodes")
+    @patch.object(consul_manager.ConsulManager, "critical_nodes")
+    def test_check_machine_stop_during_query(self, critical_nodes, service_nodes):
+        self.config["CHECK_MACHINE_STOP_TIMEOUT"] = 0.1
+        service_nodes.return_value = {"vm-1": {"address": "10.1.1.1", "instance": "rpaas_01"}}
+
+        def blocking_query(index=None, wait=None):
+            time.sleep(0.5)
+            return "6", set(["vm-1"])
+        critical_nodes.side_effect = blocking_query
         checker = healing.CheckMachine(self.config)
         checker.start()
-        time.sleep(1)
+        time.sleep(0.1)
+        started = time.time()
         checker.stop()
+        self.assertTrue(time.time() - started < 0.4)
+        time.sleep(1.5)
+        self.assertFalse(checker.is_alive())
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, [])
+
+    @patch("rpaas.flap_damping.time")
+    @patch.object(consul_manager.ConsulManager, "service_nodes")
+    def test_check_machine_confirm_failures(self, service_nodes, time):
+        self.config["FLAP_CONFIRM_FAILURES"] = 2
+        redis.StrictRedis().set("check_machine:state", json.dumps({"index": 5, "failing": {}}))
+        service_nodes.return_value = {"vm-1": {"address": "10.1.1.1", "instance": "rpaas_01"}}
+        checker = healing.CheckMachine(self.config)
+        time.time.return_value = 1000.0
+        checker.check_nodes("6", set(["vm-1"]))
+        time.time.return_value = 1010.0
+        checker.check_nodes("6", set(["vm-1"]))
         tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
         self.assertListEqual(tasks, [])
+        time.time.return_value = 1030.0
+        checker.check_nodes("6", set(["vm-1"]))
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, ['restore_10.1.1.1'])
+        time.time.return_value = 1060.0
+        checker.check_nodes("7", set())
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, [])
+
+    def test_check_machine_task_changed_nodes(self):
+        self.storage.store_task({"_id": "restore_10.2.2.2", "host": "10.2.2.2", "instance": "rpaas_02"})
+        tasks.CheckMachineTask().delay(self.config, {"10.1.1.1": "rpaas_01", "10.9.9.9": "rpaas_09"},
+                                       ["10.2.2.2"])
+        restore_tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(restore_tasks, ['restore_10.1.1.1'])
@@ -0,0 +1,127 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+import redis
+
+from rpaas import jobs
+
+
+class StartJobsTestCase(unittest.TestCase):
+
+    @mock.patch("rpaas.reconciler.Reconciler")
+    @mock.patch("rpaas.garbage_collector.GarbageCollector")
+    @mock.patch("rpaas.healing.CheckMachine")
+    @mock.patch("rpaas.healing.RestoreMachine")
+    @mock.patch("rpaas.ssl_plugins.le_renewer.LeRenewer")
+    def test_start_jobs(self, LeRenewer, RestoreMachine, CheckMachine, GarbageCollector, Reconciler):
+        config = {"RUN_LE_RENEWER": "1", "RUN_RESTORE_MACHINE": "true", "RUN_CHECK_MACHINE": "1",
+                  "RUN_GARBAGE_COLLECTOR": "0"}
+        started = jobs.start_jobs(config)
+        self.assertEqual([LeRenewer.return_value, RestoreMachine.return_value, CheckMachine.return_value],
+                         started)
+        for job in started:
+            job.start.assert_called_once_with()
+        RestoreMachine.assert_called_once_with(config)
+        self.assertFalse(GarbageCollector.called)
+        self.assertFalse(Reconciler.called)
+
+    @mock.patch("rpaas.healing.CheckMachine")
+    @mock.patch("rpaas.healing.RestoreMachine")
+    def test_start_jobs_check_machine_leader(self, RestoreMachine, CheckMachine):
+        leader = mock.Mock()
+        config = {"RUN_RESTORE_MACHINE": "1", "RUN_CHECK_MACHINE": "1"}
+        jobs.start_jobs(config, leader)
+        CheckMachine.assert_called_once_with(config, leader=leader)
+
+    @mock.patch("rpaas.healing.CheckMachine")
+    @mock.patch("rpaas.healing.RestoreMachine")
+    def test_start_jobs_check_machine_requires_restore_machine(self, RestoreMachine, CheckMachine):
+        self.assertEqual([], jobs.start_jobs({"RUN_CHECK_MACHINE": "1"}))
+        self.assertFalse(CheckMachine.called)
+
+    def test_stop_jobs(self):
+        job1, job2 = mock.Mock(), mock.Mock()
+        job1.stop.side_effect = Exception("failed to stop")
+        jobs.stop_jobs([job1, job2])
+        job1.stop.assert_called_once_with()
+        job2.stop.assert_called_once_with()
+
+
+class SchedulerRoleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = redis.StrictRedis()
+        self.config = {"SCHEDULER_LEADER_KEY": "rpaas_scheduler_test:leader", "SCHEDULER_LEADER_TTL": 30}
+        self.conn.delete("rpaas_scheduler_test:leader")
+        self.start_patcher = mock.patch("rpaas.jobs.start_jobs")
+        self.start_jobs = self.start_patcher.start()
+        self.stop_patcher = mock.patch("rpaas.jobs.stop_jobs")
+        self.stop_jobs = self.stop_patcher.start()
+
+    def tearDown(self):
+        self.start_patcher.stop()
+        self.stop_patcher.stop()
+        self.conn.delete("rpaas_scheduler_test:leader")
+
+    def test_step_single_leader(self):
+        role1 = jobs.SchedulerRole(self.config, self.conn)
+        role2 = jobs.SchedulerRole(self.config, self.conn)
+        self.assertEqual(10, role1.interval)
+        role1.step()
+        role2.step()
+        self.assertTrue(role1.leader)
+        self.assertFalse(role2.leader)
+        self.start_jobs.assert_called_once_with(self.config, role1.is_leader)
+        role1.step()
+        self.assertEqual(1, self.start_jobs.call_count)
+        self.assertTrue(0 < self.conn.ttl("rpaas_scheduler_test:leader") <= 30)
+
+    @mock.patch("rpaas.jobs.time")
+    def test_is_leader(self, time):
+        time.time.return_value = 1000
+        role = jobs.SchedulerRole(self.config, self.conn)
+        self.assertFalse(role.is_leader())
+        role.step()
+        self.assertTrue(role.is_leader())
+        time.time.return_value = 1019
+        self.assertTrue(role.is_leader())
+        time.time.return_value = 1020
+        self.assertFalse(role.is_leader())
+        role.step()
+        self.assertTrue(role.is_leader())
+        role.stop()
+        self.assertFalse(role.is_leader())
+
+    def test_step_lost_leadership(self):
+        role1 = jobs.SchedulerRole(self.config, self.conn)
+        role2 = jobs.SchedulerRole(self.config, self.conn)
+        role1.step()
+        self.conn.delete("rpaas_scheduler_test:leader")
+        role2.step()
+        self.assertTrue(role2.leader)
+        role1.step()
+        self.assertFalse(role1.leader)
+        self.assertFalse(role1.is_leader())
+        self.stop_jobs.assert_called_once_with(self.start_jobs.return_value)
+
+    def test_step_renew_error(self):
+        role = jobs.SchedulerRole(self.config, self.conn)
+        role.step()
+        with mock.patch.object(role.lease, "renew", side_effect=redis.ConnectionError("down")):
+            role.step()
+        self.assertFalse(role.leader)
+        self.stop_jobs.assert_called_once_with(self.start_jobs.return_value)
+
+    def test_stop(self):
+        role1 = jobs.SchedulerRole(self.config, self.conn)
+        role2 = jobs.SchedulerRole(self.config, self.conn)
+        role1.step()
+        role1.stop()
+        self.stop_jobs.assert_called_once_with(self.start_jobs.return_value)
+        self.assertIsNone(self.conn.get("rpaas_scheduler_test:leader"))
+        role2.step()
+        self.assertTrue(role2.leader)
@@ -9,7 +9,7 @@ import unittest
 
 import redis
 
-from rpaas import storage, tasks
+from rpaas import plan, storage, tasks
 from rpaas.ssl_plugins import le_renewer
 
 tasks.app.conf.CELERY_ALWAYS_EAGER = True
@@ -49,7 +49,10 @@ class LeRenewerTestCase(unittest.TestCase):
         ]
         for cert in certs:
             self.storage.db[self.storage.le_certificates_collection].insert(cert)
-        redis.StrictRedis().delete("le_renewer:last_run")
+        conn = redis.StrictRedis()
+        conn.zrem("rpaas_scheduler:jobs", "le_renewer")
+        for key in conn.keys("acme_scheduler:*"):
+            conn.delete(key)
 
     def tearDown(self):
         self.storage.db[self.storage.le_certificates_collection].remove()
@@ -82,3 +85,40 @@ class LeRenewerTestCase(unittest.TestCase):
                               mock.call(self.config, "instance6", "le", "domain-csr",
                                         "secret-key", "i6.tsuru.io")]
         self.assertEqual(expected_crt_calls, generate_crt.mock_calls)
+
+    @mock.patch("rpaas.ssl.generate_crt")
+    @mock.patch("rpaas.ssl.generate_csr")
+    @mock.patch("rpaas.ssl.generate_key")
+    def test_renew_certificates_plan_config(self, generate_key, generate_csr, generate_crt):
+        self.storage.store_plan(plan.Plan(name="huge", description="some huge plan",
+                                          config={"PLAN_KEY": "huge"}))
+        self.storage.store_instance_metadata("instance0", plan_name="huge")
+        self.storage.store_instance_metadata("instance1", plan_name="missing")
+        self.storage.store_instance_metadata("instance4", consul_token="abc")
+        tasks.RenewCertsTask().delay(self.config)
+        names = [c[1][1] for c in generate_crt.mock_calls]
+        self.assertEqual(["instance0", "instance4", "instance5", "instance6"], names)
+        self.assertEqual("huge", generate_crt.mock_calls[0][1][0]["PLAN_KEY"])
+        self.assertEqual(self.config, generate_crt.mock_calls[1][1][0])
+
+    @mock.patch("rpaas.tasks.random")
+    @mock.patch.object(tasks.RenewCertTask, "apply_async")
+    def test_renew_certificates_spread(self, apply_async, random):
+        random.uniform.side_effect = lambda a, b: b / 2
+        self.config["LE_RENEWAL_WINDOW"] = 100
+        tasks.RenewCertsTask().delay(self.config)
+        self.assertEqual([10, 30, 50, 70, 90],
+                         [c[2]["countdown"] for c in apply_async.mock_calls])
+        self.assertEqual(["instance0", "instance1", "instance4", "instance5", "instance6"],
+                         [c[2]["kwargs"]["name"] for c in apply_async.mock_calls])
+        self.assertEqual("i0.tsuru.io", apply_async.mock_calls[0][2]["kwargs"]["domain"])
+
+    @mock.patch("rpaas.tasks.random")
+    @mock.patch.object(tasks.RenewCertTask, "apply_async")
+    def test_renew_certificates_spread_within_visibility_timeout(self, apply_async, random):
+        random.uniform.side_effect = lambda a, b: b / 2
+        self.config["LE_RENEWAL_WINDOW"] = 86400
+        self.config["BROKER_VISIBILITY_TIMEOUT"] = 1000
+        tasks.RenewCertsTask().delay(self.config)
+        self.assertEqual([90, 270, 450, 630, 810],
+                         [c[2]["countdown"] for c in apply_async.mock_calls])
@@ -0,0 +1,192 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+import redis
+
+from rpaas import lease
+
+
+class RestoreLeasesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = redis.StrictRedis()
+        self.config = {
+            "RESTORE_LEASE_TTL": 30,
+            "RESTORE_MACHINE_MAX_CONCURRENCY": 3,
+            "RESTORE_MACHINE_INSTANCE_CONCURRENCY": 2,
+            "RESTORE_MACHINE_ZONE_CONCURRENCY": 2,
+            "RESTORE_LEASE_PREFIX": "restore_lease_test",
+        }
+        self.leases = lease.RestoreLeases(self.conn, self.config)
+        self.clean()
+
+    def tearDown(self):
+        self.clean()
+
+    def clean(self):
+        for key in self.conn.keys("restore_lease_test:*"):
+            self.conn.delete(key)
+
+    def test_acquire(self):
+        token = self.leases.acquire("10.1.1.1", "foo")
+        self.assertIsNotNone(token)
+        self.assertEqual(token, self.conn.get("restore_lease_test:host:10.1.1.1"))
+        self.assertIsNone(self.leases.acquire("10.1.1.1", "foo"))
+
+    def test_acquire_covers_dispatch(self):
+        self.config["RESTORE_LEASE_DISPATCH_TTL"] = 900
+        leases = lease.RestoreLeases(self.conn, self.config)
+        token = leases.acquire("10.1.1.1", "foo")
+        self.assertTrue(30 < self.conn.ttl("restore_lease_test:host:10.1.1.1") <= 900)
+        self.assertTrue(leases.renew("10.1.1.1", "foo", token))
+        self.assertTrue(0 < self.conn.ttl("restore_lease_test:host:10.1.1.1") <= 30)
+
+    def test_acquire_instance_concurrency(self):
+        self.assertIsNotNone(self.leases.acquire("10.1.1.1", "foo"))
+        self.assertIsNotNone(self.leases.acquire("10.1.1.2", "foo"))
+        self.assertIsNone(self.leases.acquire("10.1.1.3", "foo"))
+        self.assertIsNotNone(self.leases.acquire("10.2.2.1", "bar"))
+
+    def test_acquire_max_concurrency(self):
+        self.assertIsNotNone(self.leases.acquire("10.1.1.1", "foo"))
+        self.assertIsNotNone(self.leases.acquire("10.2.2.1", "bar"))
+        self.assertIsNotNone(self.leases.acquire("10.3.3.1", "baz"))
+        self.assertIsNone(self.leases.acquire("10.4.4.1", "qux"))
+
+    def test_acquire_zone_concurrency(self):
+        self.assertIsNotNone(self.leases.acquire("10.1.1.1", "foo", "cloudstack:zone1"))
+        self.assertIsNotNone(self.leases.acquire("10.2.2.1", "bar", "cloudstack:zone1"))
+        self.assertIsNone(self.leases.acquire("10.3.3.1", "baz", "cloudstack:zone1"))
+        token = self.leases.acquire("10.3.3.1", "baz", "cloudstack:zone2")
+        self.assertIsNotNone(token)
+        self.assertTrue(self.leases.release("10.3.3.1", "baz", token, "cloudstack:zone2"))
+        self.assertEqual(0, self.conn.zcard("restore_lease_test:zone:cloudstack:zone2"))
+
+    @mock.patch("rpaas.lease.time")
+    def test_acquire_expired_leases(self, time):
+        time.time.return_value = 1000
+        self.assertIsNotNone(self.leases.acquire("10.1.1.1", "foo"))
+        self.assertIsNotNone(self.leases.acquire("10.1.1.2", "foo"))
+        self.conn.delete("restore_lease_test:host:10.1.1.1")
+        time.time.return_value = 1901
+        self.assertIsNotNone(self.leases.acquire("10.1.1.1", "foo"))
+        self.assertIsNotNone(self.leases.acquire("10.1.1.3", "foo"))
+
+    def test_release(self):
+        token = self.leases.acquire("10.1.1.1", "foo")
+        self.assertFalse(self.leases.release("10.1.1.1", "foo", "other-token"))
+        self.assertIsNone(self.leases.acquire("10.1.1.1", "foo"))
+        self.assertTrue(self.leases.release("10.1.1.1", "foo", token))
+        self.assertIsNone(self.conn.get("restore_lease_test:host:10.1.1.1"))
+        self.assertEqual(0, self.conn.zcard("restore_lease_test:all"))
+        self.assertEqual(0, self.conn.zcard("restore_lease_test:instance:foo"))
+
+    def test_renew(self):
+        token = self.leases.acquire("10.1.1.1", "foo")
+        self.assertTrue(self.leases.renew("10.1.1.1", "foo", token))
+        self.assertFalse(self.leases.renew("10.1.1.1", "foo", "other-token"))
+        self.leases.release("10.1.1.1", "foo", token)
+        self.assertFalse(self.leases.renew("10.1.1.1", "foo", token))
+
+    def test_heartbeat(self):
+        renew = mock.Mock(side_effect=[True, True, False])
+        heartbeat = lease.Heartbeat(renew, 0.01)
+        heartbeat.start()
+        heartbeat.join(1)
+        self.assertFalse(heartbeat.is_alive())
+        self.assertEqual(3, renew.call_count)
+        heartbeat.stop()
+
+
+class LeaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = redis.StrictRedis()
+        self.conn.delete("lease_test")
+
+    def tearDown(self):
+        self.conn.delete("lease_test")
+
+    def test_acquire(self):
+        lease1 = lease.Lease(self.conn, "lease_test", 30)
+        lease2 = lease.Lease(self.conn, "lease_test", 30)
+        self.assertTrue(lease1.acquire())
+        self.assertFalse(lease2.acquire())
+        self.assertEqual(lease1.token, self.conn.get("lease_test"))
+        self.assertTrue(0 < self.conn.ttl("lease_test") <= 30)
+
+    def test_renew(self):
+        lease1 = lease.Lease(self.conn, "lease_test", 30)
+        lease2 = lease.Lease(self.conn, "lease_test", 30)
+        lease1.acquire()
+        self.assertTrue(lease1.renew())
+        self.assertFalse(lease2.renew())
+        self.conn.delete("lease_test")
+        self.assertFalse(lease1.renew())
+
+    def test_release(self):
+        lease1 = lease.Lease(self.conn, "lease_test", 30)
+        lease2 = lease.Lease(self.conn, "lease_test", 30)
+        lease1.acquire()
+        self.assertFalse(lease2.release())
+        self.assertTrue(lease1.release())
+        self.assertIsNone(self.conn.get("lease_test"))
+        self.assertTrue(lease2.acquire())
+
+
+class LeaseLockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = redis.StrictRedis()
+        self.conn.delete("lease_lock_test", "lease_lock_test:fence")
+
+    def tearDown(self):
+        self.conn.delete("lease_lock_test", "lease_lock_test:fence")
+
+    def test_acquire(self):
+        lock1 = lease.LeaseLock(self.conn, "lease_lock_test", 30)
+        lock2 = lease.LeaseLock(self.conn, "lease_lock_test", 30)
+        self.assertEqual(1, lock1.acquire())
+        self.assertIsNone(lock2.acquire())
+        self.assertTrue(lock1.held)
+        self.assertFalse(lock2.held)
+        self.assertTrue(lock1.release())
+        self.assertFalse(lock1.held)
+        self.assertEqual(2, lock2.acquire())
+        self.assertEqual(2, lock2.fence)
+        lock2.release()
+
+    def test_heartbeat(self):
+        lock = lease.LeaseLock(self.conn, "lease_lock_test", 1)
+        lock.acquire()
+        try:
+            lock.heartbeat.stopped.wait(1.5)
+            self.assertTrue(lock.held)
+            self.assertEqual(lock.token, self.conn.get("lease_lock_test"))
+        finally:
+            lock.release()
+        self.assertIsNone(self.conn.get("lease_lock_test"))
+
+    def test_lost_lock(self):
+        lock = lease.LeaseLock(self.conn, "lease_lock_test", 1)
+        lock.acquire()
+        self.conn.set("lease_lock_test", "other")
+        lock.heartbeat.join(1)
+        self.assertFalse(lock.held)
+        self.assertFalse(lock.release())
+        self.assertEqual("other", self.conn.get("lease_lock_test"))
+
+    def test_renewed(self):
+        renewed = mock.Mock(side_effect=[Exception("mongo down"), None])
+        lock = lease.LeaseLock(self.conn, "lease_lock_test", 1, renewed=renewed)
+        lock.acquire()
+        try:
+            lock.heartbeat.stopped.wait(0.85)
+            self.assertTrue(lock.held)
+            self.assertEqual(2, renewed.call_count)
+        finally:
+            lock.release()
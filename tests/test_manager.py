@@ -3,14 +3,16 @@
 # license that can be found in the LICENSE file.
 
 import copy
+import datetime
 import unittest
 import os
 
 import mock
+import redis
 
 import rpaas.manager
 from rpaas.manager import Manager, ScaleError, QuotaExceededError
-from rpaas import tasks, storage
+from rpaas import acme_scheduler, tasks, storage
 
 tasks.app.conf.CELERY_ALWAYS_EAGER = True
 
@@ -141,9 +143,12 @@ class ManagerTestCase(unittest.TestCase):
         self.storage.store_instance_metadata("x", plan_name="small", consul_token="abc-123")
         lb = self.LoadBalancer.find.return_value
         lb.hosts = [mock.Mock()]
+        scheduler = acme_scheduler.AcmeScheduler(redis.StrictRedis(), self.config)
+        scheduler.enqueue("x", "x.tsuru.io", "admin@tsuru.io")
         manager = Manager(self.config)
         manager.consul_manager = mock.Mock()
         manager.remove_instance("x")
+        self.assertIsNone(scheduler.status("x"))
         config = copy.deepcopy(self.config)
         config.update(self.plan["config"])
         self.LoadBalancer.find.assert_called_with("x", config)
@@ -416,6 +421,231 @@ content = location /x {
         with self.assertRaises(rpaas.tasks.NotReadyError):
             manager.scale_instance("x", 5)
 
+    def test_scale_instance_coalesce_running_task(self):
+        self.storage.store_task({"_id": "x", "desired_quantity": 3})
+        manager = Manager(self.config)
+        with mock.patch("rpaas.tasks.ScaleInstanceTask.delay") as delay:
+            manager.scale_instance("x", 5)
+        self.assertFalse(delay.called)
+        self.assertEqual(5, self.storage.find_task("x")[0]["desired_quantity"])
+
+    def test_scale_instance_task_locked_by_another_worker(self):
+        self.storage.store_task({"_id": "x", "desired_quantity": 5})
+        conn = redis.StrictRedis()
+        task_lock = tasks.TaskManager(self.config).lock("x", conn)
+        self.addCleanup(task_lock.release)
+        with self.assertRaises(tasks.NotReadyError):
+            tasks.ScaleInstanceTask().run(self.config, "x", 5)
+        self.assertFalse(self.Host.create.called)
+        task = self.storage.find_task("x")[0]
+        self.assertEqual(task_lock.fence, task["fence"])
+        self.assertEqual(5, task["desired_quantity"])
+
+    def test_scale_instance_task_newer_fence(self):
+        conn = redis.StrictRedis()
+        fence = conn.incr("task_lock:x:fence") + 10
+        self.storage.store_task({"_id": "x", "desired_quantity": 5, "fence": fence})
+        with self.assertRaises(tasks.NotReadyError):
+            tasks.ScaleInstanceTask().run(self.config, "x", 5)
+        self.assertFalse(self.Host.create.called)
+        self.assertIsNone(conn.get("task_lock:x"))
+        self.assertEqual(fence, self.storage.find_task("x")[0]["fence"])
+
+    def test_scale_instance_takes_over_abandoned_task(self):
+        expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        self.storage.store_task({"_id": "x", "desired_quantity": 3, "owner": "dead:1", "expire_at": expired})
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        manager = Manager(self.config)
+        with mock.patch("rpaas.tasks.ScaleInstanceTask.delay") as delay:
+            delay.return_value.task_id = "task-1"
+            manager.scale_instance("x", 5)
+        self.assertTrue(delay.called)
+        task = self.storage.find_task("x")[0]
+        self.assertEqual(5, task["desired_quantity"])
+        self.assertEqual("task-1", task["task_id"])
+        self.assertEqual(manager.task_manager.owner, task["owner"])
+        self.assertEqual(datetime.timedelta(seconds=3600), task["expire_at"] - task["heartbeat"])
+
+    def test_ensure_ready_task_running(self):
+        task_manager = tasks.TaskManager(self.config)
+        task_manager.create("x")
+        with self.assertRaises(tasks.NotReadyError):
+            task_manager.ensure_ready("x")
+        task = self.storage.find_task("x")[0]
+        self.assertEqual(task_manager.owner, task["owner"])
+        self.assertEqual(datetime.timedelta(seconds=3600), task["expire_at"] - task["heartbeat"])
+
+    def test_task_queued_expiration(self):
+        self.config["TASK_QUEUE_TTL"] = 7200
+        task_manager = tasks.TaskManager(self.config)
+        queued = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        self.storage.store_task({"_id": "x", "owner": "api:1", "heartbeat": queued,
+                                 "expire_at": queued + datetime.timedelta(seconds=task_manager.queue_ttl)})
+        with self.assertRaises(tasks.NotReadyError):
+            task_manager.ensure_ready("x")
+        task_lock = task_manager.lock("x", redis.StrictRedis())
+        self.addCleanup(task_lock.release)
+        task = self.storage.find_task("x")[0]
+        self.assertEqual(task_manager.owner, task["owner"])
+        self.assertEqual(datetime.timedelta(seconds=600), task["expire_at"] - task["heartbeat"])
+
+    def test_task_queued_expired(self):
+        task_manager = tasks.TaskManager(self.config)
+        queued = datetime.datetime.utcnow() - datetime.timedelta(hours=2)
+        self.storage.store_task({"_id": "x", "owner": "api:1", "heartbeat": queued,
+                                 "expire_at": queued + datetime.timedelta(seconds=task_manager.queue_ttl)})
+        task_manager.ensure_ready("x")
+        self.assertEqual(0, self.storage.find_task("x").count())
+
+    @mock.patch.object(storage.MongoDBStorage, "ensure_tasks_index")
+    def test_task_manager_ensures_index_once(self, ensure_tasks_index):
+        tasks.TaskManager._indexed.discard(self.storage.db.name)
+        tasks.TaskManager(self.config)
+        tasks.TaskManager(self.config)
+        ensure_tasks_index.assert_called_once_with()
+
+    def test_ensure_ready_restore_task_never_expires(self):
+        task_manager = tasks.TaskManager(self.config)
+        task_manager.create({"_id": "restore_10.1.1.1", "host": "10.1.1.1"}, expires=False)
+        task = self.storage.find_task("restore_10.1.1.1")[0]
+        self.assertNotIn("expire_at", task)
+        with self.assertRaises(tasks.NotReadyError):
+            task_manager.ensure_ready("restore_10.1.1.1")
+
+    def test_task_lock_heartbeat(self):
+        task_manager = tasks.TaskManager(self.config)
+        expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        self.storage.store_task({"_id": "x", "owner": "api:1", "expire_at": expired})
+        task_lock = task_manager.lock("x", redis.StrictRedis())
+        self.addCleanup(task_lock.release)
+        self.storage.update_task("x", {"expire_at": expired})
+        task_lock.renewed()
+        task = self.storage.find_task("x")[0]
+        self.assertEqual(task_manager.owner, task["owner"])
+        self.assertEqual(task_lock.fence, task["fence"])
+        self.assertTrue(task["expire_at"] > datetime.datetime.utcnow())
+
+    def test_task_lock_missing_task(self):
+        task_manager = tasks.TaskManager(self.config)
+        self.assertIsNone(task_manager.lock("x", redis.StrictRedis()))
+        self.assertIsNone(redis.StrictRedis().get("task_lock:x"))
+        self.assertEqual(0, self.storage.find_task("x").count())
+
+    def test_task_lock_taken_over_task(self):
+        self.storage.store_task({"_id": "x", "task_id": "task-2"})
+        task_manager = tasks.TaskManager(self.config)
+        self.assertIsNone(task_manager.lock("x", redis.StrictRedis(), "task-1"))
+        self.assertIsNone(redis.StrictRedis().get("task_lock:x"))
+        task_lock = task_manager.lock("x", redis.StrictRedis(), "task-2")
+        self.assertIsNotNone(task_lock)
+        task_lock.release()
+
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_converges_to_latest_target(self, nginx):
+        lb = self.LoadBalancer.find.return_value
+        lb.name = "x"
+        lb.hosts = [mock.Mock(), mock.Mock()]
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        manager = Manager(self.config)
+
+        def add_host(host):
+            if lb.add_host.call_count == 1:
+                manager.scale_instance("x", 5)
+        lb.add_host.side_effect = add_host
+        manager.scale_instance("x", 3)
+        self.assertEqual(3, lb.add_host.call_count)
+        self.assertEqual(0, self.storage.find_task("x").count())
+
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_progress(self, nginx):
+        lb = self.LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock()]
+        self.Host.create.return_value.dns_name = "10.1.1.1"
+        self.storage.store_instance_metadata("x", consul_token="abc-123", plan_name="small")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        manager = Manager(self.config)
+        progress = []
+
+        def wait_healthcheck(host, timeout):
+            progress.append(manager.current_task("x"))
+        nginx.Nginx.return_value.wait_healthcheck.side_effect = wait_healthcheck
+        manager.scale_instance("x", 2)
+        self.assertEqual(1, len(progress))
+        self.assertEqual("scale", progress[0]["operation"])
+        self.assertEqual("small", progress[0]["plan_name"])
+        self.assertEqual("my-host-manager", progress[0]["host_manager"])
+        self.assertEqual(2, progress[0]["desired_quantity"])
+        self.assertEqual(["vm_created", "added_to_lb"], [s["step"] for s in progress[0]["steps"]])
+        self.assertEqual(["10.1.1.1", "10.1.1.1"], [s["host"] for s in progress[0]["steps"]])
+        self.assertEqual(["success", "success"], [s["status"] for s in progress[0]["steps"]])
+        with self.assertRaises(rpaas.tasks.TaskNotFoundError):
+            manager.current_task("x")
+
+    def test_current_task_acme_queue(self):
+        self.storage.store_task("x")
+        self.addCleanup(self.storage.remove_task, "x")
+        scheduler = acme_scheduler.AcmeScheduler(redis.StrictRedis(), self.config)
+        scheduler.enqueue("x", "x.tsuru.io", "admin@tsuru.io")
+        self.addCleanup(scheduler.cancel, "x")
+        manager = Manager(self.config)
+        progress = manager.current_task("x")
+        self.assertEqual({"position": 1, "queue_depth": 1, "eta": 0}, progress["acme_queue"])
+
+    @mock.patch("rpaas.manager.nginx")
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_start_batch_purge(self, LoadBalancer, nginx):
+        LoadBalancer.find.return_value.hosts = [mock.Mock()]
+        self.storage.db[self.storage.quota_collection].insert({"_id": "team1", "used": ["a", "b", "c", "d"],
+                                                               "quota": 5})
+        for name in ("a", "c", "d", "e"):
+            self.storage.store_instance_metadata(name, plan_name="small")
+            self.addCleanup(self.storage.remove_instance_metadata, name)
+        self.storage.store_task("c")
+        self.addCleanup(self.storage.remove_task, "c")
+        manager = Manager(self.config)
+        batch_id = manager.start_batch("purge", {"team": "team1", "plan": "small"}, {"path": "/foo"},
+                                       concurrency=2)
+        status = manager.batch_status(batch_id)
+        self.assertEqual("finished", status["status"])
+        self.assertEqual(3, status["total"])
+        self.assertEqual(0, status["pending"])
+        self.assertEqual([], status["running"])
+        self.assertEqual(2, status["succeeded"])
+        self.assertEqual([{"name": "c", "error": "Async task still running"}], status["failed"])
+        self.assertEqual([mock.call("a"), mock.call("d")], LoadBalancer.find.call_args_list)
+        nginx.Nginx.return_value.purge_location.assert_called_with(
+            LoadBalancer.find.return_value.hosts[0].dns_name, "/foo")
+
+    @mock.patch.object(Manager, "scale_instance")
+    def test_start_batch_scale(self, scale_instance):
+        manager = Manager(self.config)
+        batch_id = manager.start_batch("scale", {"instances": ["b", "a"]}, {"quantity": "3"})
+        self.assertEqual([mock.call("a", 3), mock.call("b", 3)], scale_instance.mock_calls)
+        status = manager.batch_status(batch_id)
+        self.assertEqual("finished", status["status"])
+        self.assertEqual(10, status["concurrency"])
+        self.assertEqual(2, status["succeeded"])
+
+    def test_start_batch_invalid(self):
+        manager = Manager(self.config)
+        with self.assertRaises(rpaas.manager.BatchError):
+            manager.start_batch("destroy", {"instances": ["a"]})
+        with self.assertRaises(rpaas.manager.BatchError):
+            manager.start_batch("scale", {"instances": ["a"]}, {"quantity": "zero"})
+        with self.assertRaises(rpaas.manager.BatchError):
+            manager.start_batch("purge", {"instances": ["a"]})
+        with self.assertRaises(rpaas.manager.BatchError):
+            manager.start_batch("purge", {}, {"path": "/"})
+        with self.assertRaises(rpaas.manager.BatchError):
+            manager.start_batch("purge", {"plan": "huge"}, {"path": "/"})
+
+    def test_batch_status_not_found(self):
+        manager = Manager(self.config)
+        with self.assertRaises(storage.BatchNotFoundError):
+            manager.batch_status("unknown")
+
     def test_scale_instance_down(self):
         lb = self.LoadBalancer.find.return_value
         lb.hosts = [mock.Mock(), mock.Mock()]
@@ -0,0 +1,109 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from rpaas import consul_manager, storage, tasks
+
+tasks.app.conf.CELERY_ALWAYS_EAGER = True
+
+
+class ReconcileBindingsTaskTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {
+            "MONGO_DATABASE": "reconciler_test",
+            "RPAAS_SERVICE_NAME": "test_rpaas_reconciler",
+            "RECONCILE_BATCH_SIZE": 2,
+        }
+        self.storage = storage.MongoDBStorage(self.config)
+        colls = self.storage.db.collection_names(False)
+        for coll in colls:
+            self.storage.db.drop_collection(coll)
+        self.manager = consul_manager.ConsulManager(self.config)
+        self.kv = {}
+        patchers = [
+            mock.patch.object(consul_manager.ConsulManager, "instance_entries", self._instance_entries),
+            mock.patch.object(consul_manager.ConsulManager, "put_key"),
+            mock.patch.object(consul_manager.ConsulManager, "delete_key"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.put_key = consul_manager.ConsulManager.put_key
+        self.delete_key = consul_manager.ConsulManager.delete_key
+
+    def _instance_entries(self, instance_name):
+        prefix = "test_rpaas_reconciler/{}/".format(instance_name)
+        return dict((k, v) for k, v in self.kv.iteritems() if k.startswith(prefix))
+
+    def _sync(self, name):
+        binding = self.storage.find_binding(name)
+        self.kv.update(self.manager.binding_entries(name, binding))
+
+    def test_reconcile_in_sync(self):
+        self.storage.store_binding("inst1", "app1.tsuru.io")
+        self.storage.update_binding_certificate("inst1", "cert", "key")
+        self._sync("inst1")
+        tasks.ReconcileBindingsTask().delay(self.config)
+        self.assertFalse(self.put_key.called)
+        self.assertFalse(self.delete_key.called)
+
+    def test_reconcile_repairs_drift(self):
+        for name in ("inst1", "inst2", "inst3"):
+            self.storage.store_binding(name, "{}.tsuru.io".format(name))
+            self._sync(name)
+        self.storage.replace_binding_path("inst2", "/admin", None, "admin content")
+        self.storage.update_binding_certificate("inst3", "cert", "key")
+        self.kv["test_rpaas_reconciler/inst1/locations/ROOT"] = "stale"
+        self.kv["test_rpaas_reconciler/inst1/locations/___old"] = "removed route"
+        self.kv["test_rpaas_reconciler/inst1/ssl/cert"] = "le cert"
+        with mock.patch.object(tasks.ReconcileBindingsTask, "delay",
+                               side_effect=lambda *args: tasks.ReconcileBindingsTask().run(*args)) as delay:
+            tasks.ReconcileBindingsTask().run(self.config)
+        self.assertEqual([mock.call(self.config, ["inst1", "inst2"]),
+                          mock.call(self.config, ["inst3"])], delay.mock_calls)
+        root_config = self.manager.config_manager.generate_host_config("/", "inst1.tsuru.io")
+        self.assertEqual(sorted([
+            mock.call("test_rpaas_reconciler/inst1/locations/ROOT", root_config),
+            mock.call("test_rpaas_reconciler/inst2/locations/___admin", "admin content"),
+            mock.call("test_rpaas_reconciler/inst3/ssl/cert", "cert"),
+            mock.call("test_rpaas_reconciler/inst3/ssl/key", "key"),
+        ]), sorted(self.put_key.mock_calls))
+        self.delete_key.assert_called_once_with("test_rpaas_reconciler/inst1/locations/___old")
+
+    def test_reconcile_route_added_between_reads(self):
+        self.storage.store_binding("inst1", "app1.tsuru.io")
+        self._sync("inst1")
+        key = "test_rpaas_reconciler/inst1/locations/___admin"
+        self.kv[key] = "admin content"
+        find_binding = self.storage.find_binding
+
+        def add_route(name):
+            self.storage.replace_binding_path("inst1", "/admin", None, "admin content")
+            return find_binding(name)
+        with mock.patch.object(storage.MongoDBStorage, "find_binding", side_effect=add_route):
+            tasks.ReconcileBindingsTask().run(self.config, ["inst1"])
+        self.assertFalse(self.put_key.called)
+        self.assertFalse(self.delete_key.called)
+
+    def test_reconcile_skips_instances_with_tasks(self):
+        self.storage.store_binding("inst1", "app1.tsuru.io")
+        self.storage.store_task("inst1")
+        self.kv["test_rpaas_reconciler/inst1/locations/___old"] = "removed route"
+        tasks.ReconcileBindingsTask().run(self.config, ["inst1"])
+        self.assertFalse(self.put_key.called)
+        self.assertFalse(self.delete_key.called)
+
+    def test_reconcile_skips_le_certificates(self):
+        self.storage.store_binding("inst1", "app1.tsuru.io")
+        self.storage.update_binding_certificate("inst1", "old cert", "old key")
+        self.storage.store_le_certificate("inst1", "inst1.tsuru.io")
+        self._sync("inst1")
+        self.kv["test_rpaas_reconciler/inst1/ssl/cert"] = "renewed cert"
+        tasks.ReconcileBindingsTask().delay(self.config, ["inst1"])
+        self.assertFalse(self.put_key.called)
+        self.assertFalse(self.delete_key.called)
@@ -0,0 +1,115 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import calendar
+import datetime
+import unittest
+
+import mock
+import redis
+
+from rpaas import scheduler
+
+
+def timestamp(*args):
+    return float(calendar.timegm(datetime.datetime(*args).utctimetuple()))
+
+
+class ScheduleTestCase(unittest.TestCase):
+
+    def test_interval_schedule(self):
+        schedule = scheduler.parse_schedule("30")
+        self.assertIsInstance(schedule, scheduler.IntervalSchedule)
+        self.assertEqual(130, schedule.next_after(100))
+        with self.assertRaises(ValueError):
+            scheduler.IntervalSchedule(0)
+
+    def test_cron_schedule(self):
+        schedule = scheduler.parse_schedule("*/15 3 * * *")
+        self.assertIsInstance(schedule, scheduler.CronSchedule)
+        self.assertEqual(timestamp(2016, 2, 3, 3, 0),
+                         schedule.next_after(timestamp(2016, 2, 3, 2, 10, 30)))
+        self.assertEqual(timestamp(2016, 2, 3, 3, 45),
+                         schedule.next_after(timestamp(2016, 2, 3, 3, 30)))
+        self.assertEqual(timestamp(2016, 2, 4, 3, 0),
+                         schedule.next_after(timestamp(2016, 2, 3, 3, 45)))
+
+    def test_cron_schedule_days(self):
+        schedule = scheduler.CronSchedule("0 0 * 3 1-5")
+        self.assertEqual(timestamp(2016, 3, 1, 0, 0), schedule.next_after(timestamp(2016, 2, 3, 12, 0)))
+        self.assertEqual(timestamp(2016, 3, 7, 0, 0), schedule.next_after(timestamp(2016, 3, 4, 0, 0)))
+        schedule = scheduler.CronSchedule("0 0 13 * 5")
+        self.assertEqual(timestamp(2016, 2, 5, 0, 0), schedule.next_after(timestamp(2016, 2, 3, 12, 0)))
+        self.assertEqual(timestamp(2016, 2, 12, 0, 0), schedule.next_after(timestamp(2016, 2, 5, 0, 0)))
+        self.assertEqual(timestamp(2016, 2, 13, 0, 0), schedule.next_after(timestamp(2016, 2, 12, 0, 0)))
+        schedule = scheduler.CronSchedule("30 12 * * 0")
+        self.assertEqual(timestamp(2016, 2, 7, 12, 30), schedule.next_after(timestamp(2016, 2, 3, 12, 0)))
+        self.assertEqual(schedule.weekdays, scheduler.CronSchedule("30 12 * * 7").weekdays)
+
+    def test_cron_schedule_invalid(self):
+        for expression in ("* * * *", "60 * * * *", "* 5-2 * * *", "*/0 * * * *", "a * * * *"):
+            with self.assertRaises(ValueError):
+                scheduler.parse_schedule(expression)
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = redis.StrictRedis()
+        self.config = {"SCHEDULER_KEY": "rpaas_scheduler_test:jobs", "SCHEDULER_CLAIM_TIMEOUT": 60}
+        self.conn.delete("rpaas_scheduler_test:jobs")
+        self.time_patcher = mock.patch("rpaas.scheduler.time")
+        self.time = self.time_patcher.start()
+        self.time.time.return_value = 1000.0
+
+    def tearDown(self):
+        self.time_patcher.stop()
+        self.conn.delete("rpaas_scheduler_test:jobs")
+
+    def test_run_pending(self):
+        job1, job2 = mock.Mock(), mock.Mock()
+        engine = scheduler.Scheduler(self.config)
+        engine.add_job("job1", scheduler.IntervalSchedule(10), job1)
+        engine.add_job("job2", scheduler.IntervalSchedule(30), job2)
+        self.assertEqual(10, engine.run_pending())
+        self.assertEqual(1, job1.call_count)
+        self.assertEqual(1, job2.call_count)
+        self.assertEqual(1010, self.conn.zscore("rpaas_scheduler_test:jobs", "job1"))
+        self.assertEqual(1030, self.conn.zscore("rpaas_scheduler_test:jobs", "job2"))
+        self.time.time.return_value = 1004.0
+        self.assertEqual(6, engine.run_pending())
+        self.assertEqual(1, job1.call_count)
+        self.time.time.return_value = 1012.0
+        engine.run_pending()
+        self.assertEqual(2, job1.call_count)
+        self.assertEqual(1020, self.conn.zscore("rpaas_scheduler_test:jobs", "job1"))
+
+    def test_run_pending_missed_runs(self):
+        job = mock.Mock()
+        engine = scheduler.Scheduler(self.config)
+        engine.add_job("job", scheduler.IntervalSchedule(10), job)
+        self.time.time.return_value = 1055.0
+        engine.run_pending()
+        self.assertEqual(1, job.call_count)
+        self.assertEqual(1065, self.conn.zscore("rpaas_scheduler_test:jobs", "job"))
+
+    def test_run_pending_once_across_processes(self):
+        job1, job2 = mock.Mock(), mock.Mock()
+        engine1 = scheduler.Scheduler(self.config)
+        engine2 = scheduler.Scheduler(self.config)
+        engine1.add_job("job", scheduler.IntervalSchedule(10), job1)
+        engine2.add_job("job", scheduler.IntervalSchedule(10), job2)
+        engine1.run_pending()
+        engine2.run_pending()
+        self.assertEqual(1, job1.call_count + job2.call_count)
+
+    def test_run_pending_only_registered_jobs(self):
+        self.conn.zadd("rpaas_scheduler_test:jobs", other=900)
+        job = mock.Mock(side_effect=Exception("job failed"))
+        engine = scheduler.Scheduler(self.config)
+        engine.add_job("job", scheduler.IntervalSchedule(10), job)
+        engine.run_pending()
+        self.assertEqual(1, job.call_count)
+        self.assertEqual(900, self.conn.zscore("rpaas_scheduler_test:jobs", "other"))
+        self.assertEqual(1010, self.conn.zscore("rpaas_scheduler_test:jobs", "job"))
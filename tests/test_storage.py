@@ -58,6 +58,10 @@ class MongoDBStorageTestCase(unittest.TestCase):
         with self.assertRaises(storage.PlanNotFoundError):
             self.storage.find_plan("something that doesn't exist")
 
+    def test_find_plans(self):
+        plans = self.storage.find_plans(["huge", "something that doesn't exist"])
+        self.assertEqual(["huge"], [p.name for p in plans])
+
     def test_store_plan(self):
         p = plan.Plan(name="super_huge", description="very huge thing",
                       config={"serviceofferingid": "abcdef123"})
@@ -108,6 +112,26 @@ class MongoDBStorageTestCase(unittest.TestCase):
         with self.assertRaises(storage.PlanNotFoundError):
             self.storage.delete_plan("super_huge")
 
+    def test_store_restore_tasks(self):
+        self.storage.store_restore_tasks({"10.1.1.1": "instance1"})
+        task = self.storage.find_task("restore_10.1.1.1")[0]
+        self.storage.store_restore_tasks({"10.1.1.1": "instance1", "10.2.2.2": "instance2"})
+        self.assertEqual(task, self.storage.find_task("restore_10.1.1.1")[0])
+        self.assertEqual("instance2", self.storage.find_task("restore_10.2.2.2")[0]["instance"])
+        self.storage.remove_restore_tasks(["10.1.1.1", "10.3.3.3"])
+        self.assertEqual(0, self.storage.find_task("restore_10.1.1.1").count())
+        self.assertEqual(1, self.storage.find_task("restore_10.2.2.2").count())
+
+    def test_task_target(self):
+        self.assertFalse(self.storage.update_task_target("myinstance", 3))
+        self.storage.store_task({"_id": "myinstance", "desired_quantity": 2})
+        self.assertTrue(self.storage.update_task_target("myinstance", 3))
+        self.assertFalse(self.storage.remove_task_target("myinstance", 2))
+        self.assertTrue(self.storage.remove_task_target("myinstance", 3))
+        self.storage.store_task("myinstance")
+        self.assertFalse(self.storage.update_task_target("myinstance", 3))
+        self.assertTrue(self.storage.remove_task_target("myinstance"))
+
     def test_instance_metadata_storage(self):
         self.storage.store_instance_metadata("myinstance", plan="small")
         inst_metadata = self.storage.find_instance_metadata("myinstance")
@@ -7,6 +7,8 @@ import os
 import redis
 import time
 
+import mock
+
 from rpaas import tasks
 
 tasks.app.conf.CELERY_ALWAYS_EAGER = True
@@ -115,3 +117,92 @@ class TasksTestCase(unittest.TestCase):
                              'sentinel_connection_shared_{}'.format(x))
         self.assertEqual(id(app_client[0].connection_pool), id(app_client[9].connection_pool))
         self.assertEqual(self.redis_clients_manager(), 1)
+
+
+class TaskRoutesTestCase(unittest.TestCase):
+
+    def route(self, task):
+        return tasks.app.amqp.router.route({}, task.name, (), {})["queue"].name
+
+    def test_queues(self):
+        self.assertEqual(set(["provisioning", "healing", "certificates", "housekeeping"]),
+                         set(tasks.app.amqp.queues.keys()))
+
+    def test_routes(self):
+        self.assertEqual("provisioning", self.route(tasks.NewInstanceTask))
+        self.assertEqual("provisioning", self.route(tasks.ScaleInstanceTask))
+        self.assertEqual("healing", self.route(tasks.RestoreMachineTask))
+        self.assertEqual("healing", self.route(tasks.CheckMachineTask))
+        self.assertEqual("certificates", self.route(tasks.DownloadCertTask))
+        self.assertEqual("certificates", self.route(tasks.RenewCertsTask))
+        self.assertEqual("certificates", self.route(tasks.RenewCertTask))
+        self.assertEqual("healing", self.route(tasks.RestoreHostTask))
+        self.assertEqual("housekeeping", self.route(tasks.CollectGarbageTask))
+        self.assertEqual("housekeeping", self.route(tasks.BatchTask))
+
+
+class VisibilityTimeoutTestCase(unittest.TestCase):
+
+    def test_visibility_timeout(self):
+        self.assertEqual(3600, tasks.visibility_timeout({}))
+        self.assertEqual(7200, tasks.visibility_timeout({"BROKER_VISIBILITY_TIMEOUT": "7200"}))
+
+    def test_max_countdown(self):
+        self.assertEqual(3240, tasks.max_countdown({}))
+        self.assertEqual(900, tasks.max_countdown({"BROKER_VISIBILITY_TIMEOUT": 1000}))
+
+    def test_broker_transport_options(self):
+        self.assertEqual(3600, tasks.app.conf.BROKER_TRANSPORT_OPTIONS["visibility_timeout"])
+
+
+class ResourceCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tasks.resource_cache.reset()
+        self.config = {"MONGO_DATABASE": "tasks_resource_cache_test", "HOST_MANAGER": "fake"}
+
+    def tearDown(self):
+        tasks.resource_cache.enabled = False
+        tasks.resource_cache.reset()
+
+    def test_lru_eviction(self):
+        cache = tasks.ResourceCache(size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(3, cache.get("c"))
+
+    def test_init_config_without_cache(self):
+        task = tasks.BaseManagerTask()
+        task.init_config(self.config)
+        consul = task.consul_manager
+        task.init_config(self.config)
+        self.assertIsNot(consul, task.consul_manager)
+
+    def test_init_config_reuses_resources(self):
+        tasks.enable_resource_cache()
+        task = tasks.BaseManagerTask()
+        task.init_config(self.config)
+        nginx_manager, storage = task.nginx_manager, task.storage
+        self.assertEqual("fake", task.host_manager_name)
+        other_task = tasks.CheckMachineTask()
+        other_task.init_config(dict(self.config))
+        self.assertIs(nginx_manager, other_task.nginx_manager)
+        self.assertIs(storage, other_task.storage)
+        other_task.init_config(dict(self.config, HOST_MANAGER="other"))
+        self.assertIsNot(nginx_manager, other_task.nginx_manager)
+        self.assertEqual("other", other_task.host_manager_name)
+
+    def test_reset_on_worker_process_init(self):
+        tasks.enable_resource_cache()
+        task = tasks.BaseManagerTask()
+        with mock.patch.object(tasks.BaseManagerTask, "_build_resources", return_value={}) as build:
+            task.init_config(self.config)
+            task.init_config(self.config)
+            self.assertEqual(1, build.call_count)
+            tasks.reset_resource_cache()
+            task.init_config(self.config)
+            self.assertEqual(2, build.call_count)